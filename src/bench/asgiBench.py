@@ -0,0 +1,88 @@
+import time
+import asyncio
+from typing import List, Dict, Tuple, TypedDict, Optional, Any
+from starlette.types import ASGIApp
+
+
+class BenchResult(TypedDict):
+    name: str
+    n: int
+    status: int
+    cpuUsPerReq: float
+    wallUsPerReq: float
+
+
+async def requestAsgi(app: ASGIApp, method: str, path: str, body: bytes) -> Tuple[int, bytes]:
+    """
+    Call the ASGI app in-process, i.e. no socket/http client overhead is measured
+    """
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": method,
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "query_string": b"",
+        "root_path": "",
+        "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())],
+        "client": ("127.0.0.1", 50000),
+        "server": ("127.0.0.1", 8000),
+    }
+    isBodySent = False
+    status = 0
+    chunks: List[bytes] = []
+
+    async def receive():
+        nonlocal isBodySent
+        if not isBodySent:
+            isBodySent = True
+            return {"type": "http.request", "body": body, "more_body": False}
+        ## the request is never disconnected during the benchmark
+        await asyncio.sleep(3600)
+
+    async def send(message: Dict[str, Any]):
+        nonlocal status
+        if message["type"] == "http.response.start":
+            status = message["status"]
+        elif message["type"] == "http.response.body":
+            chunks.append(message.get("body", b""))
+
+    await app(scope, receive, send)
+    return status, b"".join(chunks)
+
+
+def benchAsgi(name: str, app: ASGIApp, method: str, path: str, body: bytes = b"", n: int = 1000) -> BenchResult:
+    """
+    Benchmark per-request cpu and wall time of an endpoint
+    """
+
+    async def run_():
+        ## warm up, e.g. lazy init and caches
+        status, _ = await requestAsgi(app, method, path, body)
+        cpu0, wall0 = time.process_time(), time.perf_counter()
+        for _ in range(n):
+            await requestAsgi(app, method, path, body)
+        cpu1, wall1 = time.process_time(), time.perf_counter()
+        return status, cpu1 - cpu0, wall1 - wall0
+
+    status, cpuSec, wallSec = asyncio.run(run_())
+    result: BenchResult = {
+        "name": name,
+        "n": n,
+        "status": status,
+        "cpuUsPerReq": cpuSec * 1e6 / n,
+        "wallUsPerReq": wallSec * 1e6 / n,
+    }
+    return result
+
+
+def printBenchResults(results: List[BenchResult], baselineName: Optional[str] = None):
+    baseline = next((r for r in results if r["name"] == baselineName), None)
+    for r in results:
+        speedup = f", x{baseline['cpuUsPerReq'] / r['cpuUsPerReq']:.2f}" if baseline is not None else ""
+        print(
+            f"{r['name']:<40} status={r['status']}, n={r['n']}, "
+            f"cpu={r['cpuUsPerReq']:.1f}us/req, wall={r['wallUsPerReq']:.1f}us/req{speedup}"
+        )
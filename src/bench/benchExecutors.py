@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+"""
+Benchmark job executors like-for-like, i.e. same job handler, same no. of workers
+
+Usage:
+    python src/bench/benchExecutors.py [n] [workers]
+
+Compare
+- dispatch overhead: empty job, time from submit to result in the event loop
+- throughput: CPU bound job (pure python loop, holds the GIL)
+for ThreadExecutor (MultiThreadQueueWorker), ProcessExecutor (MultiProcessManager) and InlineExecutor (asyncio.to_thread)
+- batch mode of one thread worker (e.g. the message worker): off vs batchMaxJobs=BATCH_MAX_JOBS, empty jobs
+"""
+
+import sys
+import os
+import time
+import queue
+import asyncio
+from typing import Dict, Any, List, Tuple
+
+sys.path.append(f"{os.path.dirname(__file__)}/../lib")
+
+import util as U
+from api.worker import (
+    QueueJob,
+    QueueJobResult,
+    JobExecutor,
+    ThreadExecutor,
+    ProcessExecutor,
+    InlineExecutor,
+    MultiThreadQueueWorker,
+    MultiProcessManager,
+    registerJobHandler,
+    registerBatchJobHandler,
+)
+
+EMPTY_JOB = "benchEmpty"
+CPU_JOB = "benchCpu"
+CPU_JOB_LOOPS = 200_000
+BATCH_MAX_JOBS = 32
+
+
+## NOTE: module level, thus the handlers are registered in worker processes too (fork)
+def onJobEmpty(jobResult: QueueJobResult, jobId: str, jobData: Dict[str, Any]):
+    jobResult["data"] = "done"
+
+
+def onJobsEmpty(batch: List[Tuple[QueueJobResult, str, Dict[str, Any]]]):
+    for jobResult, jobId, jobData in batch:
+        jobResult["data"] = "done"
+
+
+def onJobCpu(jobResult: QueueJobResult, jobId: str, jobData: Dict[str, Any]):
+    total = 0
+    for i in range(CPU_JOB_LOOPS):
+        total += i * i
+    jobResult["data"] = str(total)
+
+
+registerJobHandler(EMPTY_JOB, onJobEmpty)
+registerJobHandler(CPU_JOB, onJobCpu)
+registerBatchJobHandler(EMPTY_JOB, onJobsEmpty)
+
+
+def newJob(jobType: str) -> QueueJob:
+    return {
+        "createEpms": U.epochMs(),
+        "id": U.uuid(),
+        "jobType": jobType,
+        "jobData": {"tag": jobType},
+        "promise": asyncio.get_running_loop().create_future(),
+    }
+
+
+async def runJobs(executor: JobExecutor, jobType: str, n: int) -> float:
+    """
+    Returns:
+        elapsed seconds to complete n jobs submitted as fast as the executor takes them
+    """
+    startSec = time.perf_counter()
+    promises: List[asyncio.Future[QueueJobResult]] = []
+    for _ in range(n):
+        job = newJob(jobType)
+        while True:
+            try:
+                executor.submit(job)
+                break
+            except queue.Full:
+                await asyncio.sleep(0.0005)
+        promises.append(job["promise"])
+    results = await asyncio.gather(*promises)
+    elapsedSec = time.perf_counter() - startSec
+    errors = [r for r in results if r["errCode"] != ""]
+    if len(errors) > 0:
+        raise Exception(f"{executor.name} failed jobs={len(errors)}, e.g. {errors[0]}")
+    return elapsedSec
+
+
+async def runLatency(executor: JobExecutor, n: int) -> float:
+    """
+    Returns:
+        mean seconds of submit to result of an empty job, one job at a time
+    """
+    startSec = time.perf_counter()
+    for _ in range(n):
+        job = newJob(EMPTY_JOB)
+        executor.submit(job)
+        await job["promise"]
+    return (time.perf_counter() - startSec) / n
+
+
+async def newThreadExecutor(workers: int, n: int, batchMaxJobs: int = 1, batchWaitMs: float = 0) -> ThreadExecutor:
+    sharedQueue = queue.Queue(maxsize=n)
+    startedPromises = [asyncio.get_running_loop().create_future() for _ in range(workers)]
+    threadWorkers = [
+        MultiThreadQueueWorker(
+            f"benchThread{i+1}",
+            startedPromises[i],
+            {"queue": sharedQueue, "batchMaxJobs": batchMaxJobs, "batchWaitMs": batchWaitMs, "queueWorkers": workers},
+        )
+        for i in range(workers)
+    ]
+    for w in threadWorkers:
+        w.start()
+    await asyncio.gather(*startedPromises)
+    return ThreadExecutor("threads" if batchMaxJobs <= 1 else f"batch{batchMaxJobs}/{batchWaitMs}ms", threadWorkers)
+
+
+async def newProcessExecutor(workers: int, n: int) -> ProcessExecutor:
+    mpManager = MultiProcessManager("benchMp", jobQueueMaxSize=n)
+    for i in range(workers):
+        mpManager.startProcess(f"benchProcess{i+1}")
+    ## wait until the workers are running, i.e. process start time is not measured
+    executor = ProcessExecutor("processes", mpManager)
+    await runJobs(executor, EMPTY_JOB, workers * 2)
+    return executor
+
+
+async def bench(n: int, workers: int):
+    executors: List[JobExecutor] = [
+        await newThreadExecutor(workers, n),
+        await newProcessExecutor(workers, n),
+        InlineExecutor("inline", workers),
+    ]
+    print(f"jobs={n}, workers={workers}, cpuJobLoops={CPU_JOB_LOOPS}")
+    for executor in executors:
+        ## warm up (e.g. default thread pool of to_thread)
+        await runJobs(executor, EMPTY_JOB, workers * 2)
+        latencySec = await runLatency(executor, n)
+        emptySec = await runJobs(executor, EMPTY_JOB, n)
+        cpuSec = await runJobs(executor, CPU_JOB, n)
+        print(
+            f"{executor.name:>10}: dispatch latency {latencySec * 1e6:8.1f}us/job,"
+            f" empty jobs {n / emptySec:8.0f} jobs/s, cpu jobs {n / cpuSec:6.1f} jobs/s"
+        )
+    for executor in executors:
+        await executor.stop(2)
+
+    ## NOTE: workers sharing a queue take jobs as soon as they arrive, i.e. batches are tiny, thus one worker
+    print("batch mode of 1 thread worker, empty jobs")
+    for batchMaxJobs, batchWaitMs in [(1, 0), (BATCH_MAX_JOBS, 0), (BATCH_MAX_JOBS, 1)]:
+        executor = await newThreadExecutor(1, n, batchMaxJobs, batchWaitMs)
+        await runJobs(executor, EMPTY_JOB, 2)
+        latencySec = await runLatency(executor, n)
+        emptySec = await runJobs(executor, EMPTY_JOB, n)
+        print(
+            f"{executor.name:>14}: dispatch latency {latencySec * 1e6:8.1f}us/job, empty jobs {n / emptySec:8.0f} jobs/s"
+        )
+        await executor.stop(2)
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    workers = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    asyncio.run(bench(n, workers))
+
+
+if __name__ == "__main__":
+    main()
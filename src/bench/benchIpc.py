@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+"""
+Benchmark IPC of MultiProcessManager, i.e. per-job dispatch overhead of thousands of small (empty) jobs
+
+Usage:
+    python src/bench/benchIpc.py [n] [workers]
+
+Compare
+- encoding: pickle of the dicts (multiprocessing.Queue) vs the compact encoding of PipeHub (marshal tuple)
+- dispatch: transport "queue" (multiprocessing.Queue shared by all workers) vs "pipe" (a pipe per worker + selector)
+  - latency: submit to result of one job at a time
+  - throughput: n empty jobs submitted as fast as the manager takes them
+"""
+
+import sys
+import os
+import time
+import pickle
+import asyncio
+from typing import List
+
+sys.path.append(f"{os.path.dirname(__file__)}/../lib")
+
+import util as U
+from api.worker import MpQueueJob, QueueJobResult, QueueJobType, ProcessExecutor, MultiProcessManager, newJobResult
+from api.worker import encodeMpJob, decodeMpJob, encodeMpResult, decodeMpResult
+
+## NOTE: the empty job handler is registered on import, thus in worker processes too (fork)
+from benchExecutors import EMPTY_JOB, runJobs, runLatency
+
+
+def benchEncoding(n: int):
+    job: MpQueueJob = {
+        "createEpms": U.epochMs(),
+        "id": U.uuid(),
+        "jobType": QueueJobType.PDF2IMAGE,
+        "jobData": {"tag": QueueJobType.PDF2IMAGE, "pdfFilePath": "./data/regal-17pages.pdf", "dpi": 100},
+        "promise": U.uuid(),
+        "pages": 17,
+    }
+    result: QueueJobResult = {**newJobResult("pdfWorker1"), "data": "finished", "processElapsedMs": 123}
+    item = (job["id"], result)
+    codecs = [
+        ("pickle", lambda: pickle.loads(pickle.dumps(job)), lambda: pickle.loads(pickle.dumps(item)), pickle.dumps),
+        ("compact", lambda: decodeMpJob(encodeMpJob(job)), lambda: decodeMpResult(encodeMpResult(item)), None),
+    ]
+    for name, jobRoundTrip, resultRoundTrip, dumps in codecs:
+        startSec = time.perf_counter()
+        for _ in range(n):
+            jobRoundTrip()
+            resultRoundTrip()
+        elapsedSec = time.perf_counter() - startSec
+        jobBytes = len(dumps(job)) if dumps is not None else len(encodeMpJob(job))
+        resultBytes = len(dumps(item)) if dumps is not None else len(encodeMpResult(item))
+        print(
+            f"{name:>10}: job {jobBytes:4d} bytes, result {resultBytes:4d} bytes,"
+            f" encode+decode {elapsedSec / n * 1e6:6.1f}us/job"
+        )
+
+
+async def newProcessExecutor(transport: str, workers: int, n: int) -> ProcessExecutor:
+    mpManager = MultiProcessManager(f"bench-{transport}", jobQueueMaxSize=n, transport=transport)
+    for i in range(workers):
+        mpManager.startProcess(f"benchProcess{i+1}")
+    executor = ProcessExecutor(transport, mpManager)
+    ## wait until the workers are running, i.e. process start time is not measured
+    await runJobs(executor, EMPTY_JOB, workers * 2)
+    return executor
+
+
+async def bench(n: int, workers: int):
+    print(f"jobs={n}, workers={workers}")
+    benchEncoding(n)
+    executors: List[ProcessExecutor] = [
+        await newProcessExecutor("queue", workers, n),
+        await newProcessExecutor("pipe", workers, n),
+    ]
+    for executor in executors:
+        latencySec = await runLatency(executor, min(n, 1000))
+        emptySec = await runJobs(executor, EMPTY_JOB, n)
+        print(
+            f"{executor.name:>10}: dispatch latency {latencySec * 1e6:8.1f}us/job,"
+            f" empty jobs {n / emptySec:8.0f} jobs/s ({emptySec / n * 1e6:6.1f}us/job)"
+        )
+    for executor in executors:
+        await executor.stop(2)
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    workers = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    asyncio.run(bench(n, workers))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+"""
+Benchmark cost of journaling accepted jobs on the request path
+
+Usage:
+    python src/bench/benchJournal.py [n]
+
+Compare
+- commit per job: one fsync'ed transaction per accepted job (what a naive journal does)
+- group commit: JobJournal.accepted(), batches are committed by the writer thread
+"""
+
+import sys
+import os
+import time
+import json
+import sqlite3
+import asyncio
+import tempfile
+
+sys.path.append(f"{os.path.dirname(__file__)}/../lib")
+
+import util as U
+from api.worker import JobJournal, QueueJob, QueueJobType
+
+
+def newJob(loop: asyncio.AbstractEventLoop) -> QueueJob:
+    jobId = U.uuid()
+    return {
+        "createEpms": U.epochMs(),
+        "id": jobId,
+        "jobType": QueueJobType.PDF2IMAGE,
+        "jobData": {"tag": QueueJobType.PDF2IMAGE, "pdfFilePath": "./data/regal-17pages.pdf"},
+        "promise": loop.create_future(),
+    }
+
+
+def benchCommitPerJob(dbPath: str, n: int, loop: asyncio.AbstractEventLoop) -> float:
+    conn = sqlite3.connect(dbPath, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=FULL")
+    conn.execute("CREATE TABLE IF NOT EXISTS jobJournal (jobId TEXT PRIMARY KEY, acceptedEpms INTEGER, entry TEXT)")
+    startSec = time.perf_counter()
+    for _ in range(n):
+        job = newJob(loop)
+        entry = {k: v for k, v in job.items() if k != "promise"}
+        conn.execute(
+            "INSERT INTO jobJournal (jobId, acceptedEpms, entry) VALUES (?, ?, ?)",
+            (job["id"], U.epochMs(), json.dumps(entry)),
+        )
+    elapsedSec = time.perf_counter() - startSec
+    conn.close()
+    return elapsedSec
+
+
+def benchGroupCommit(dbPath: str, n: int, loop: asyncio.AbstractEventLoop):
+    journal = JobJournal(dbPath)
+    startSec = time.perf_counter()
+    for _ in range(n):
+        journal.accepted(newJob(loop), "pdfProcesses")
+    elapsedSec = time.perf_counter() - startSec
+    journal.close()
+    return elapsedSec, journal.stats()
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    loop = asyncio.new_event_loop()
+    with tempfile.TemporaryDirectory() as tmpDir:
+        perJobSec = benchCommitPerJob(f"{tmpDir}/perJob.db", n, loop)
+        groupSec, stats = benchGroupCommit(f"{tmpDir}/group.db", n, loop)
+    print(f"commit per job: {perJobSec / n * 1e6:8.1f}us/job")
+    print(f"group commit  : {groupSec / n * 1e6:8.1f}us/job, x{perJobSec / groupSec:.1f} faster, {stats}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""
+Benchmark per-request overhead of the global exception handler middleware on /hello
+
+Usage:
+    python src/bench/benchMiddleware.py [n]
+
+Compare
+- none: no middleware (reference)
+- BaseHTTPMiddleware: exception handler as it was implemented before
+- pure ASGI: ExceptionHandlerMiddleware (current)
+"""
+
+import sys
+import os
+import json
+import asyncio
+from typing import List
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+from starlette.middleware.base import BaseHTTPMiddleware
+
+sys.path.append(f"{os.path.dirname(__file__)}/../lib")
+sys.path.append(os.path.dirname(__file__))
+
+import util as U
+from asgiBench import benchAsgi, printBenchResults, BenchResult, requestAsgi
+from util.fastApi import useExceptionHandlerMiddleware
+from api import simple
+
+
+class LegacyExceptionHandlerMiddleware(BaseHTTPMiddleware):
+    async def dispatch(self, request: Request, call_next):
+        try:
+            return await call_next(request)
+        except Exception as e:
+            U.logPrefixE(f"{LegacyExceptionHandlerMiddleware.__name__}", e)
+            return JSONResponse(
+                status_code=500, content={"error": e.__class__.__name__, "messages": U.Log.toExceptionStr(e)}
+            )
+
+
+def helloApp(middleware: str) -> FastAPI:
+    app = FastAPI()
+    if middleware == "legacy":
+        app.add_middleware(LegacyExceptionHandlerMiddleware)
+    elif middleware == "current":
+        useExceptionHandlerMiddleware(app)
+    simple.initEndpoints(app)
+    return app
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    body = json.dumps({"data": "hello"}).encode()
+    results: List[BenchResult] = [
+        benchAsgi("none               /hello", helloApp("none"), "POST", "/hello", body, n),
+        benchAsgi("BaseHTTPMiddleware /hello", helloApp("legacy"), "POST", "/hello", body, n),
+        benchAsgi("pure ASGI          /hello", helloApp("current"), "POST", "/hello", body, n),
+    ]
+    printBenchResults(results, "BaseHTTPMiddleware /hello")
+
+    ## both must return the same json error output
+    errBody = json.dumps({"data": "throw"}).encode()
+    legacyOut = asyncio.run(requestAsgi(helloApp("legacy"), "POST", "/helloNoExceptionHandling", errBody))
+    currentOut = asyncio.run(requestAsgi(helloApp("current"), "POST", "/helloNoExceptionHandling", errBody))
+    print(f"error output identical={legacyOut == currentOut}, status={currentOut[0]}, body={currentOut[1].decode()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""
+Benchmark per-request cpu of the payload endpoints
+
+Usage:
+    python src/bench/benchPayload.py [nDepartments] [nPersons]
+
+Compare
+- legacy: response_model re-validation + jsonable_encoder, validating the constant sample on every call
+- current: FastJSONResponse (no re-validation) and CachedJSONResponse
+"""
+
+import sys
+import os
+import json
+from typing import List, cast
+from fastapi import FastAPI
+
+sys.path.append(f"{os.path.dirname(__file__)}/../lib")
+sys.path.append(os.path.dirname(__file__))
+
+from asgiBench import benchAsgi, printBenchResults, BenchResult
+from api import nestedPayload, dynamicPayload
+from api.nestedPayload import CompanyBM, CompanyResponseBM, sampleCompany
+from api.dynamicPayload import PayloadHeaderBody
+
+
+def legacyApp() -> FastAPI:
+    """
+    Endpoints as they were implemented before the fast path
+    """
+    app = FastAPI()
+
+    @app.post("/nestedPayload", response_model=CompanyResponseBM)
+    async def nestedPayload_(data: CompanyBM):
+        return {"data": data}
+
+    @app.post("/validateNestedPayload")
+    async def validateNestedPayload_():
+        return CompanyBM(**cast(dict, sampleCompany()))
+
+    @app.post("/payloadFull")
+    async def payloadFull_(data: PayloadHeaderBody):
+        return {"data": data}
+
+    return app
+
+
+def currentApp() -> FastAPI:
+    app = FastAPI()
+    nestedPayload.initEndpoints(app)
+    dynamicPayload.initEndpoints(app)
+    return app
+
+
+def largeCompany(nDepartments: int, nPersons: int):
+    return {
+        "name": "Swivel Software Limited",
+        "extra1": None,
+        "departments": {
+            f"D{d}": {
+                "name": f"Department {d}",
+                "region": "HKSTP",
+                "persons": [
+                    {"name": f"Person {p}", "age": 20 + p % 40, "address": {"street": f"{p} Road", "postalCode": None}}
+                    for p in range(nPersons)
+                ],
+            }
+            for d in range(nDepartments)
+        },
+    }
+
+
+def main():
+    nDepartments = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    nPersons = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    companyBody = json.dumps(largeCompany(nDepartments, nPersons)).encode()
+    payloadFullBody = json.dumps(
+        {
+            "header": {"id": "d33c425f-64c0-4d50-afe4-6eb5739a056b", "messages": ["hello", "world"]},
+            "data": {"value": 5, "extra": None},
+        }
+    ).encode()
+    print(f"nestedPayload size={len(companyBody)} bytes ({nDepartments} departments x {nPersons} persons)")
+
+    legacy, current = legacyApp(), currentApp()
+    for path, body, n in [
+        ("/nestedPayload", companyBody, 200),
+        ("/validateNestedPayload", b"", 2000),
+        ("/payloadFull", payloadFullBody, 2000),
+    ]:
+        results: List[BenchResult] = [
+            benchAsgi(f"legacy  {path}", legacy, "POST", path, body, n),
+            benchAsgi(f"current {path}", current, "POST", path, body, n),
+        ]
+        printBenchResults(results, f"legacy  {path}")
+
+
+if __name__ == "__main__":
+    main()
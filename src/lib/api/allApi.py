@@ -1,6 +1,22 @@
+from typing import Dict, Optional
 from fastapi import FastAPI
 import util as U
-from util.fastApi import useExceptionHandlerMiddleware
+from util.fastApi import useExceptionHandlerMiddleware, useRateLimitMiddleware, RateLimitRule
+
+## Default rate limit per client, e.g. 60 requests in the last min
+RATE_LIMIT_DEFAULT: RateLimitRule = {"requests": 60, "periodSec": 60}
+
+## Per-route rate limit (keyed by path prefix)
+## NOTE: pdf worker queues are small, thus a client cannot burst more than a few jobs
+RATE_LIMIT_ROUTES: Dict[str, Optional[RateLimitRule]] = {
+    "/multiThread": {"requests": 30, "periodSec": 60, "burst": 5},
+    "/multiProcess": {"requests": 30, "periodSec": 60, "burst": 5},
+    "/pdf2image": {"requests": 10, "periodSec": 60, "burst": 2},
+    ## page downloads are cheap (no python copying, 304 for repeat fetches), a document has many pages
+    "/jobs": {"requests": 600, "periodSec": 60, "burst": 100},
+    "/docs": None,
+    "/openapi.json": None,
+}
 
 
 def initAllEndpoints(app: FastAPI):
@@ -10,6 +26,11 @@ def initAllEndpoints(app: FastAPI):
 
         ## init and use global exception error handler
         useExceptionHandlerMiddleware(app)
+
+        ## init and use per-client rate limit
+        ## NOTE: middleware added last runs first, thus requests over the limit are rejected early
+        useRateLimitMiddleware(app, RATE_LIMIT_DEFAULT, RATE_LIMIT_ROUTES)
+
         from .simple import initEndpoints
 
         initEndpoints(app)
@@ -27,6 +48,12 @@ def initAllEndpoints(app: FastAPI):
         initEndpoints(app)
         from .param import initEndpoints
 
+        initEndpoints(app)
+        from .status import initEndpoints
+
+        initEndpoints(app)
+        from .jobs import initEndpoints
+
         initEndpoints(app)
     except Exception as e:
         U.throwPrefix(prefix, e)
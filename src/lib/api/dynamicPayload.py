@@ -16,7 +16,7 @@ from fastapi import FastAPI, Body, HTTPException, File, UploadFile, Form, Depend
 from pydantic import BaseModel, Field, validator
 
 import util as U
-from util.fastApi import throwHttpPrefix
+from util.fastApi import throwHttpPrefix, FastJSONResponse
 
 
 class PayloadHeader(BaseModel):
@@ -62,7 +62,7 @@ def initEndpoints(app: FastAPI):
         funcName = payloadSimple.__name__
         prefix = funcName
         try:
-            return {"data": data}
+            return FastJSONResponse({"data": data})
         except Exception as e:
             U.logPrefixE(prefix, e)
 
@@ -71,7 +71,7 @@ def initEndpoints(app: FastAPI):
         funcName = payloadOptional.__name__
         prefix = funcName
         try:
-            return {"data": data}
+            return FastJSONResponse({"data": data})
         except Exception as e:
             throwHttpPrefix(prefix, e)
 
@@ -80,6 +80,6 @@ def initEndpoints(app: FastAPI):
         funcName = payloadFull.__name__
         prefix = funcName
         try:
-            return {"data": data}
+            return FastJSONResponse({"data": data})
         except Exception as e:
             throwHttpPrefix(prefix, e)
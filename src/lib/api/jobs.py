@@ -0,0 +1,57 @@
+import os
+from http import HTTPStatus
+from typing import Callable
+from fastapi import FastAPI, HTTPException, Path
+
+import util as U
+from util.fastApi import throwHttpPrefix, StaticFileResponse
+from app import FastApiServer
+from api.worker import pdf2imageOutDirOf, pdf2imagePageNameOf, pdf2imagePreviewNameOf
+
+
+def pageResponseOf(jobId: str, pageNo: int, nameOf: Callable[[int], str]) -> StaticFileResponse:
+    """
+    Response of a rendered page file of a pdf2image job, 404 if not found
+    """
+    ## NOTE: jobId is part of the file path, it must be a uuid (no path traversal)
+    if not U.isUuid(jobId):
+        raise HTTPException(status_code=HTTPStatus.NOT_FOUND, detail=f"page not found")
+    pagePath = f"{pdf2imageOutDirOf(jobId)}/{nameOf(pageNo - 1)}"
+    try:
+        stat = os.stat(pagePath)
+    except FileNotFoundError:
+        raise HTTPException(status_code=HTTPStatus.NOT_FOUND, detail=f"page not found")
+
+    ## recently fetched outputs are evicted last
+    FastApiServer.outputStore.touch("pdf2image", jobId)
+    return StaticFileResponse(pagePath, stat, "image/png")
+
+
+def initEndpoints(app: FastAPI):
+    U.logD(f"{initEndpoints.__name__}[{__file__.split('/')[-1]}] loading...")
+
+    @app.api_route(
+        "/jobs/{jobId}/pages/{pageNo}",
+        methods=["GET", "HEAD"],
+        description="Rendered page of a pdf2image job (pageNo starts from 1), supports ETag/Last-Modified (304) and Range (206)",
+    )
+    async def getJobPage(jobId: str, pageNo: int = Path(..., ge=1)):
+        funcName = getJobPage.__name__
+        prefix = f"{funcName}[{jobId}][{pageNo}]"
+        try:
+            return pageResponseOf(jobId, pageNo, pdf2imagePageNameOf)
+        except Exception as e:
+            throwHttpPrefix(prefix, e)
+
+    @app.api_route(
+        "/jobs/{jobId}/previews/{pageNo}",
+        methods=["GET", "HEAD"],
+        description="Preview page of a progressive pdf2image job (previewDpi), same as /jobs/{jobId}/pages/{pageNo}",
+    )
+    async def getJobPreview(jobId: str, pageNo: int = Path(..., ge=1)):
+        funcName = getJobPreview.__name__
+        prefix = f"{funcName}[{jobId}][{pageNo}]"
+        try:
+            return pageResponseOf(jobId, pageNo, pdf2imagePreviewNameOf)
+        except Exception as e:
+            throwHttpPrefix(prefix, e)
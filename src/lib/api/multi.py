@@ -1,13 +1,194 @@
+import math
 import queue
+import hashlib
+from typing import Optional, Tuple, Dict, Any
 import random
 import asyncio
 from http import HTTPStatus
-from fastapi import FastAPI, Body, HTTPException, File, UploadFile, Form, Depends
+from fastapi import FastAPI, Body, HTTPException, File, UploadFile, Form, Depends, Header, Request
 
 import util as U
 from app import FastApiServer
 from util.fastApi import throwHttpPrefix
-from api.worker import MultiThreadQueueWorker, MpQueueJob, QueueJob, QueueJobResult, QueueJobType
+from .pageStream import PageStream, PageOutput
+from api.worker import MpQueueJob, QueueJob, QueueJobResult, QueueJobType, QueueJobErrCode, Flight
+from api.worker import jobPagesOf, pdf2imagePagesOf, TenantQueueFull
+from api.worker import parsePageRanges, PDF2IMAGE_MIN_DPI, PDF2IMAGE_MAX_DPI, PDF2IMAGE_MIN_SIZE, PDF2IMAGE_MAX_SIZE
+
+## Render options of pdf2image jobs, refer to QueueJobPdf2Image
+PagesBody = Body(embed=True, default=None, max_length=256, description='pages to render, e.g. "1-3,5" (default: all)')
+DpiBody = Body(embed=True, default=None, ge=PDF2IMAGE_MIN_DPI, le=PDF2IMAGE_MAX_DPI)
+SizeBody = Body(
+    embed=True, default=None, ge=PDF2IMAGE_MIN_SIZE, le=PDF2IMAGE_MAX_SIZE, description="longest side in px (thumbnail)"
+)
+GrayscaleBody = Body(embed=True, default=False)
+PreviewDpiBody = Body(
+    embed=True, default=None, ge=PDF2IMAGE_MIN_DPI, le=PDF2IMAGE_MAX_DPI, description="progressive: preview dpi"
+)
+PreviewPagesBody = Body(embed=True, default=None, ge=1, description="no. of first pages of the preview (default: all)")
+
+
+def checkWorkersReady():
+    """
+    Workers are started in background after the server starts listening, respond 503 until they are ready
+    On shutdown (drain), respond 503 so that the client retries on another instance
+    """
+    if FastApiServer.isDraining:
+        raise HTTPException(
+            status_code=HTTPStatus.SERVICE_UNAVAILABLE,
+            detail=f"Service unavailable (server is shutting down)",
+            headers={"Retry-After": "5"},
+        )
+    if FastApiServer.workersStartError != "":
+        raise HTTPException(
+            status_code=HTTPStatus.SERVICE_UNAVAILABLE,
+            detail=f"Service unavailable (workers failed to start)",
+        )
+    if not FastApiServer.isWorkersReady:
+        raise HTTPException(
+            status_code=HTTPStatus.SERVICE_UNAVAILABLE,
+            detail=f"Service unavailable (workers are starting)",
+            headers={"Retry-After": "1"},
+        )
+
+
+def checkResult(result: QueueJobResult):
+    """
+    Raise http error for error result of a job
+    """
+    if result["errCode"] == QueueJobErrCode.QUEUE_FULL:
+        raise HTTPException(status_code=HTTPStatus.SERVICE_UNAVAILABLE, detail=f"Service unavailable (job queue full)")
+    if result["errCode"] == QueueJobErrCode.SHUTDOWN:
+        raise HTTPException(
+            status_code=HTTPStatus.SERVICE_UNAVAILABLE,
+            detail=f"Service unavailable ({result['err']})",
+            headers={"Retry-After": "5"},
+        )
+    if result["errCode"] == QueueJobErrCode.TIMEOUT:
+        raise HTTPException(status_code=HTTPStatus.GATEWAY_TIMEOUT, detail=f"Job timeout ({result['err']})")
+    if result["errCode"] != "":
+        raise HTTPException(status_code=HTTPStatus.INTERNAL_SERVER_ERROR, detail=f"{result['err']}")
+
+
+def checkAdmission(job: QueueJob, pendingPages: int, activeWorkers: int, resultWaitSec: int):
+    """
+    Reject the job immediately (503 with Retry-After) if it is not expected to complete in resultWaitSec
+    Reason: do not spend worker capacity on a job whose client has given up waiting (504)
+    """
+    decision = FastApiServer.serviceTimes.admit(
+        job["jobType"], pendingPages, activeWorkers, resultWaitSec * 1000, jobPagesOf(job)
+    )
+    if not decision["isAdmitted"]:
+        raise HTTPException(
+            status_code=HTTPStatus.SERVICE_UNAVAILABLE,
+            detail=f"Service unavailable (job cannot complete in {resultWaitSec}s, expectedMs={decision['expectedMs']})",
+            headers={"Retry-After": str(decision["retryAfterSec"])},
+        )
+
+
+def tenantOf(request: Request) -> str:
+    """
+    Tenant of a request for fair queuing (refer to FairExecutor): header X-Tenant-Id, X-API-Key, otherwise the client ip
+
+    NOTE: X-Tenant-Id is trusted as it is, i.e. it is expected to be set by a gateway that authenticates the client
+    """
+    tenantId = request.headers.get("x-tenant-id", "")
+    if tenantId != "":
+        return f"tenant:{tenantId}"
+    apiKey = request.headers.get("x-api-key", "")
+    if apiKey != "":
+        ## NOTE: the key is not shown as it is (e.g. GET /status)
+        return f"key:{hashlib.sha256(apiKey.encode()).hexdigest()[:12]}"
+    return f"ip:{request.client.host if request.client is not None else 'unknown'}"
+
+
+def tenantQueueFullError(job: QueueJob, e: TenantQueueFull) -> HTTPException:
+    """
+    429 with Retry-After, i.e. the tenant is over its quota, the server is not
+    """
+    expectedMs = FastApiServer.serviceTimes.expectedMs(job["jobType"], e.queuedPages, e.maxInFlight)
+    return HTTPException(
+        status_code=HTTPStatus.TOO_MANY_REQUESTS,
+        detail=f"Too many requests (queued jobs of {e.tenant} exceed the quota)",
+        headers={"Retry-After": str(max(1, math.ceil(expectedMs / 1000)))},
+    )
+
+
+def checkPageOutput(jobType: QueueJobType, output: PageOutput, persist: bool):
+    """
+    Pages can be streamed for pdf2image jobs only, and output of a job is persisted unless it is streamed
+    """
+    if output != "json" and jobType != QueueJobType.PDF2IMAGE:
+        raise HTTPException(
+            status_code=HTTPStatus.UNPROCESSABLE_ENTITY,
+            detail=f"output={output} is only for {QueueJobType.PDF2IMAGE.value}",
+        )
+    if not persist and output == "json":
+        raise HTTPException(
+            status_code=HTTPStatus.UNPROCESSABLE_ENTITY, detail=f"persist=false requires output=zip/multipart"
+        )
+
+
+def pdf2imageOptionsOf(
+    jobType: QueueJobType,
+    pages: Optional[str],
+    dpi: Optional[int],
+    size: Optional[int],
+    grayscale: bool,
+    previewDpi: Optional[int],
+    previewPages: Optional[int],
+) -> Dict[str, Any]:
+    """
+    Render options of a pdf2image job (jobData), only options that are set, i.e. a default job has the same flight key as before
+    """
+    options: Dict[str, Any] = {}
+    if pages is not None:
+        try:
+            if len(parsePageRanges(pages)) > 0:
+                options["pages"] = pages.replace(" ", "")
+        except ValueError:
+            raise HTTPException(status_code=HTTPStatus.UNPROCESSABLE_ENTITY, detail=f"invalid pages={pages}")
+    if dpi is not None:
+        options["dpi"] = dpi
+    if size is not None:
+        options["size"] = size
+    if grayscale:
+        options["grayscale"] = True
+    if previewDpi is not None:
+        options["previewDpi"] = previewDpi
+    if previewPages is not None:
+        if previewDpi is None:
+            raise HTTPException(status_code=HTTPStatus.UNPROCESSABLE_ENTITY, detail=f"previewPages requires previewDpi")
+        options["previewPages"] = previewPages
+    if len(options) > 0 and jobType != QueueJobType.PDF2IMAGE:
+        raise HTTPException(
+            status_code=HTTPStatus.UNPROCESSABLE_ENTITY,
+            detail=f"{list(options.keys())} are only for {QueueJobType.PDF2IMAGE.value}",
+        )
+    return options
+
+
+async def findFlight(job: QueueJob, idempotencyKey: Optional[str]) -> Tuple[str, Optional[Flight]]:
+    """
+    Find the running flight of an identical pdf2image job (or the job of the same idempotency key)
+
+    NOTE: the pdf is probed once per content (PdfInfoCache), its page count and sizes are set to the job (pdfInfo, pages),
+    the page count to jobData (pdfPages) too, i.e. the worker does not probe the pdf again
+
+    Returns:
+        (flightKey, flight) flight is None if the job needs to be submitted
+    """
+    singleFlight = FastApiServer.singleFlight
+    pdfFilePath = job["jobData"]["pdfFilePath"]
+    contentHash = await singleFlight.contentHashOf(pdfFilePath)
+    pdfInfo = await FastApiServer.pdfInfos.infoOf(pdfFilePath, contentHash)
+    if pdfInfo is not None:
+        job["pdfInfo"] = pdfInfo
+        job["pages"] = pdf2imagePagesOf(job["jobData"], pdfInfo)
+    flightKey = singleFlight.flightKeyOf(contentHash, job)
+    if pdfInfo is not None:
+        job["jobData"]["pdfPages"] = pdfInfo["pages"]
+    return flightKey, singleFlight.find(flightKey, idempotencyKey or "")
 
 
 def initEndpoints(app: FastAPI):
@@ -15,13 +196,24 @@ def initEndpoints(app: FastAPI):
 
     @app.post("/multiThread")
     async def multiThread(
+        request: Request,
         data: str = Body(..., embed=True),
         jobTypeStr: str = Body(embed=True, default=QueueJobType.MESSAGE, alias="jobType"),
+        output: PageOutput = Body(embed=True, default="json"),
+        persist: bool = Body(embed=True, default=True),
+        pages: Optional[str] = PagesBody,
+        dpi: Optional[int] = DpiBody,
+        size: Optional[int] = SizeBody,
+        grayscale: bool = GrayscaleBody,
+        previewDpi: Optional[int] = PreviewDpiBody,
+        previewPages: Optional[int] = PreviewPagesBody,
+        idempotencyKey: Optional[str] = Header(default=None, alias="Idempotency-Key"),
     ):
         jobId = U.uuid()
         funcName = multiThread.__name__
         prefix = f"{funcName}[{jobId}]"
         try:
+            checkWorkersReady()
 
             ## Default job type is message if not specified
             jobType: QueueJobType = QueueJobType.MESSAGE
@@ -30,25 +222,23 @@ def initEndpoints(app: FastAPI):
             resultWaitSec = 5
 
             ## Check jobType
-            jobQueue: queue.Queue[QueueJob]
             if jobTypeStr == QueueJobType.MESSAGE:
                 jobType = QueueJobType.MESSAGE
-                jobQueue = FastApiServer.messageWorker.jobQueue()
 
             ## In case of pdf2image, it has longer result wait time, e.g. 60sec
             elif jobTypeStr == QueueJobType.PDF2IMAGE:
                 resultWaitSec = 60
                 jobType = QueueJobType.PDF2IMAGE
-
-                ## Find out queue that it is least busy from the workers
-                ## NOTE: queue can be shared by multiple workers
-                jobQueue = MultiThreadQueueWorker.leastBusyWorkers(FastApiServer.pdfWorkers).jobQueue()
             else:
                 raise HTTPException(
                     status_code=HTTPStatus.UNPROCESSABLE_ENTITY, detail=f"invalid job type={jobTypeStr}"
                 )
 
-            U.logD(f"{prefix} putting job to queue, count={jobQueue.qsize()}...")
+            checkPageOutput(jobType, output, persist)
+            renderOptions = pdf2imageOptionsOf(jobType, pages, dpi, size, grayscale, previewDpi, previewPages)
+
+            ## Executor (thread/process/inline workers) of the job type, refer to FastApiServer.JOB_EXECUTORS
+            executor = FastApiServer.executorOf(jobType)
 
             ## This is result promise that will be awaited until worker completes the task
             ## NOTE: This promise will be passed to the target worker queue
@@ -78,44 +268,101 @@ def initEndpoints(app: FastAPI):
                         "tag": jobType,
                         ## This is the test pdf file, having 17 pages
                         "pdfFilePath": f"./data/regal-17pages.pdf",
+                        **renderOptions,
                     },
                     "promise": resultPromise,
                 }
+                if not persist:
+                    job["jobData"]["persist"] = False
+            job["tenant"] = tenantOf(request)
 
-            ## Enqueue the job to target worker queue
-            ## NOTE: if putting non-block (block=False), it will throw exception if queue is already full
-            try:
-                jobQueue.put(job, block=False)
-                U.logD(f"{prefix} job successfully submitted, count={jobQueue.qsize()}")
-            except queue.Full:
-                raise HTTPException(
-                    status_code=HTTPStatus.SERVICE_UNAVAILABLE, detail=f"Service unavailable (job queue full)"
+            ## Identical pdf2image jobs share one execution
+            ## NOTE: message job is not coalesced since each one is different (random no)
+            flightKey, flight = "", None
+            if jobType == QueueJobType.PDF2IMAGE:
+                flightKey, flight = await findFlight(job, idempotencyKey)
+
+            if flight is not None:
+                U.logD(f"{prefix} joined running job[{flight.jobId}], waiters={flight.waiters}")
+            else:
+                ## Reject the job if it cannot complete before the result wait timeout
+                pendingPages, activeWorkers = executor.load()
+                checkAdmission(job, pendingPages, activeWorkers, resultWaitSec)
+
+                ## Progressive job, stage results (preview) are kept in the flight
+                stages = FastApiServer.singleFlight.collectStages(job) if "previewDpi" in renderOptions else None
+
+                ## Submit the job to the executor
+                ## NOTE: submit does not block, it throws queue.Full if the executor cannot take more jobs
+                U.logD(
+                    f"{prefix} submitting job to {executor.name}, pages={jobPagesOf(job)}, pendingPages={pendingPages}..."
                 )
+                try:
+                    executor.submit(job)
+                    U.logD(f"{prefix} job successfully submitted")
+                except TenantQueueFull as e:
+                    raise tenantQueueFullError(job, e)
+                except queue.Full:
+                    raise HTTPException(
+                        status_code=HTTPStatus.SERVICE_UNAVAILABLE, detail=f"Service unavailable (job queue full)"
+                    )
+                FastApiServer.onJobAccepted(job, executor.name, flightKey, idempotencyKey or "")
+                if flightKey != "":
+                    flight = FastApiServer.singleFlight.start(flightKey, job, idempotencyKey or "", stages)
+
+            ## Stream the pages while they are rendered
+            if output != "json":
+                return await PageStream.response(flight, job["jobData"], output, persist, resultWaitSec, checkResult)
 
             ## await for result from worker
             async with asyncio.timeout(resultWaitSec):
-                result = await resultPromise
+                if flight is not None:
+                    result = await FastApiServer.singleFlight.wait(flight)
+                else:
+                    result = await resultPromise
 
             ## display result
             U.logD(f"{prefix} result={result}")
 
             ## In case of error result
-            if result["errCode"] != "":
-                raise HTTPException(status_code=HTTPStatus.INTERNAL_SERVER_ERROR, detail=f"{result['err']}")
+            checkResult(result)
 
-            return {"data": {"id": jobId, "result": result}}
+            ## NOTE: id is the job that is actually executed (output dir), it differs from jobId if coalesced
+            resultData = {"id": flight.jobId if flight is not None else jobId, "result": result}
+            if "previewDpi" in renderOptions:
+                resultData["stages"] = flight.stages
+            return {"data": resultData}
 
         except Exception as e:
             throwHttpPrefix(prefix, e, jobId)
 
     @app.post("/multiProcess")
-    async def multiProcess(data: str = Body(..., embed=True)):
+    async def multiProcess(
+        request: Request,
+        data: str = Body(..., embed=True),
+        output: PageOutput = Body(embed=True, default="json"),
+        persist: bool = Body(embed=True, default=True),
+        pages: Optional[str] = PagesBody,
+        dpi: Optional[int] = DpiBody,
+        size: Optional[int] = SizeBody,
+        grayscale: bool = GrayscaleBody,
+        previewDpi: Optional[int] = PreviewDpiBody,
+        previewPages: Optional[int] = PreviewPagesBody,
+        idempotencyKey: Optional[str] = Header(default=None, alias="Idempotency-Key"),
+    ):
         funcName = multiThread.__name__
         prefix = f"{funcName}"
         jobId = U.uuid()
         try:
+            checkWorkersReady()
+
+            checkPageOutput(QueueJobType.PDF2IMAGE, output, persist)
+            renderOptions = pdf2imageOptionsOf(
+                QueueJobType.PDF2IMAGE, pages, dpi, size, grayscale, previewDpi, previewPages
+            )
+
             ## Submit one job to multi-process pdf2image workers
-            mpManager = FastApiServer.mpManager
+            executor = FastApiServer.executors["pdfProcesses"]
 
             ## This is result promise that will be awaited until worker completes the task
             ## NOTE: This promise will be passed to the target worker queue
@@ -130,30 +377,56 @@ def initEndpoints(app: FastAPI):
                     "tag": QueueJobType.PDF2IMAGE,
                     ## This is the test pdf file, having 17 pages
                     "pdfFilePath": f"./data/regal-17pages.pdf",
+                    **renderOptions,
                 },
                 "promise": resultPromise,
             }
+            if not persist:
+                job["jobData"]["persist"] = False
+            job["tenant"] = tenantOf(request)
 
-            try:
-                mpManager.enqueue(job)
-                U.logD(f"{prefix} job successfully submitted, jobId={job['id']}")
-            except queue.Full:
-                raise HTTPException(
-                    status_code=HTTPStatus.SERVICE_UNAVAILABLE, detail=f"Service unavailable (job queue full)"
-                )
+            ## Identical pdf2image jobs share one execution
+            flightKey, flight = await findFlight(job, idempotencyKey)
+            if flight is not None:
+                U.logD(f"{prefix} joined running job[{flight.jobId}], waiters={flight.waiters}")
+            else:
+                ## Reject the job if it cannot complete before the result wait timeout
+                pendingPages, activeWorkers = executor.load()
+                checkAdmission(job, pendingPages, activeWorkers, resultWaitSec)
+
+                ## Progressive job, stage results (preview) are kept in the flight
+                stages = FastApiServer.singleFlight.collectStages(job) if "previewDpi" in renderOptions else None
+                try:
+                    executor.submit(job)
+                    U.logD(f"{prefix} job successfully submitted, jobId={job['id']}")
+                except TenantQueueFull as e:
+                    raise tenantQueueFullError(job, e)
+                except queue.Full:
+                    raise HTTPException(
+                        status_code=HTTPStatus.SERVICE_UNAVAILABLE, detail=f"Service unavailable (job queue full)"
+                    )
+                FastApiServer.onJobAccepted(job, executor.name, flightKey, idempotencyKey or "")
+                flight = FastApiServer.singleFlight.start(flightKey, job, idempotencyKey or "", stages)
+
+            ## Stream the pages while they are rendered
+            if output != "json":
+                return await PageStream.response(flight, job["jobData"], output, persist, resultWaitSec, checkResult)
 
             ## await for result from worker
             async with asyncio.timeout(resultWaitSec):
-                result = await resultPromise
+                result = await FastApiServer.singleFlight.wait(flight)
 
             ## display result
             U.logD(f"{prefix} result={result}")
 
             ## In case of error result
-            if result["errCode"] != "":
-                raise HTTPException(status_code=HTTPStatus.INTERNAL_SERVER_ERROR, detail=f"{result['err']}")
+            checkResult(result)
 
-            return {"data": {"id": jobId, "result": result}}
+            ## NOTE: id is the job that is actually executed (output dir), it differs from jobId if coalesced
+            resultData = {"id": flight.jobId, "result": result}
+            if "previewDpi" in renderOptions:
+                resultData["stages"] = flight.stages
+            return {"data": resultData}
 
         except Exception as e:
             throwHttpPrefix(prefix, e, jobId)
@@ -17,7 +17,7 @@ from fastapi import FastAPI, Body, HTTPException, File, UploadFile, Form, Depend
 from pydantic import BaseModel, Field, validator
 
 import util as U
-from util.fastApi import throwHttpPrefix
+from util.fastApi import throwHttpPrefix, FastJSONResponse, CachedJSONResponse
 
 
 ###########################################################################
@@ -87,44 +87,52 @@ class CompanyResponse(BaseModel):
 ###########################################################################
 
 
+def sampleCompany() -> Company:
+    data: Company = {
+        "name": "Swivel Software Limited",
+        "extra1": None,
+        "extra2": None,
+        "departments": {
+            "IT": {
+                "name": "IT Department",
+                "region": "HKSTP",
+                "persons": [
+                    {
+                        "name": "Ken Chan",
+                        "age": 30,
+                        "address": {"street": "18W HKSTP Road", "postalCode": "HKG"},
+                    },
+                    {"name": "Sylvia Law", "age": 21, "address": {"street": "HKU road", "postalCode": None}},
+                ],
+            },
+            "HR": {"name": "HR Department", "region": "KWun Tong APM", "persons": []},
+        },
+    }
+    return data
+
+
 def initEndpoints(app: FastAPI):
     U.logD(f"{initEndpoints.__name__}[{__file__.split('/')[-1]}] loading...")
 
+    ## The sample company is constant, thus it is validated and serialized only once
+    sampleCompanyResponse = CachedJSONResponse(CompanyBM(**cast(dict, sampleCompany())))
+
     @app.post("/nestedPayload", response_model=CompanyResponseBM)
     async def nestedPayload(data: CompanyBM):
         funcName = nestedPayload.__name__
         prefix = funcName
         try:
-            return {"data": data}
+            ## data is already validated on input
+            ## Thus, FastJSONResponse skips re-validation (response_model) and serializes it directly
+            return FastJSONResponse({"data": data})
         except Exception as e:
             throwHttpPrefix(prefix, e)
 
-    @app.post("/validateNestedPayload")
+    @app.post("/validateNestedPayload", response_model=CompanyBM)
     async def validateNestedPayload():
         funcName = validateNestedPayload.__name__
         prefix = funcName
         try:
-            data: Company = {
-                "name": "Swivel Software Limited",
-                "extra1": None,
-                "extra2": None,
-                "departments": {
-                    "IT": {
-                        "name": "IT Department",
-                        "region": "HKSTP",
-                        "persons": [
-                            {
-                                "name": "Ken Chan",
-                                "age": 30,
-                                "address": {"street": "18W HKSTP Road", "postalCode": "HKG"},
-                            },
-                            {"name": "Sylvia Law", "age": 21, "address": {"street": "HKU road", "postalCode": None}},
-                        ],
-                    },
-                    "HR": {"name": "HR Department", "region": "KWun Tong APM", "persons": []},
-                },
-            }
-            company = CompanyBM(**cast(dict, data))
-            return company
+            return sampleCompanyResponse.response()
         except Exception as e:
             throwHttpPrefix(prefix, e)
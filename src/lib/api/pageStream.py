@@ -0,0 +1,214 @@
+import os
+import shutil
+import asyncio
+from typing import Final, AsyncIterator, Callable, Dict, Iterator, List, Literal, Tuple
+from fastapi.responses import StreamingResponse
+from starlette.types import Receive, Scope, Send
+
+import util as U
+from util.fastApi import zipStream, multipartStream
+from app import FastApiServer
+from api.worker import Flight, QueueJobResult, QueueJobPdf2Image, pdf2imageOutDirOf
+from api.worker import pdf2imagePageNameOf, pdf2imagePageIdxsOf, pdf2imagePreviewNameOf, pdf2imagePreviewIdxsOf
+
+## Response of a pdf2image job
+## - "json": result only, pages are kept in ./out/pdf2image/{id}
+## - "zip"/"multipart": pages are streamed in the response while they are rendered
+PageOutput = Literal["json", "zip", "multipart"]
+
+
+class ClosingResponse_(StreamingResponse):
+    """
+    StreamingResponse that calls onClose once the response ends, whether the body is read or not
+    (e.g. the client disconnects or sending the headers fails before the body starts)
+    """
+
+    def __init__(self, content: AsyncIterator[bytes], onClose: Callable[[], None], **kwargs):
+        super().__init__(content, **kwargs)
+        self.onClose = onClose
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            self.onClose()
+
+
+class PageStream:
+    """
+    Stream rendered pages of a pdf2image job while the job is running
+
+    NOTE:
+    - Pages are picked up from the output dir in page order, a page file appears atomically (refer to onJobPdf2image)
+      thus it works the same for thread and process workers
+    - If the job is not persisted, its output dir is removed after the last stream of the job ends
+    - Progressive job (previewDpi): preview pages are streamed first (preview-NN.png), then full quality pages
+    """
+
+    POLL_SEC: Final[float] = 0.05
+    BOUNDARY: Final[str] = "pdf2image-page"
+
+    ## jobId -> no. of streams reading the output dir
+    readers_: Dict[str, int] = {}
+
+    @classmethod
+    async def response(
+        cls,
+        flight: Flight,
+        jobData: QueueJobPdf2Image,
+        output: PageOutput,
+        isPersist: bool,
+        firstPageWaitSec: float,
+        checkResult: Callable[[QueueJobResult], None],
+    ) -> StreamingResponse:
+        """
+        Response streaming pages of the flight
+
+        Args:
+            jobData: job data of the flight, i.e. pages to stream
+            checkResult: raise http error for error result, called if the job is done before the first page
+
+        NOTE: it waits for the first page (or the job result), thus a job that fails upfront responds an http error
+        """
+        funcName = cls.response.__name__
+        prefix = f"{funcName}[{flight.jobId}]"
+
+        ## the stream is a waiter of the flight, i.e. the job is canceled if all clients are gone
+        resultTask = asyncio.ensure_future(FastApiServer.singleFlight.wait(flight))
+        firstPagePath = cls.firstPagePathOf_(flight.jobId, jobData)
+        try:
+            async with asyncio.timeout(firstPageWaitSec):
+                while not resultTask.done() and not os.path.isfile(firstPagePath):
+                    await asyncio.wait([resultTask], timeout=cls.POLL_SEC)
+            if resultTask.done():
+                checkResult(resultTask.result())
+        except BaseException:
+            ## NOTE: no body reads the output (e.g. first page timeout, the job failed upfront), a not persisted
+            ## output is removed once the job is done unless another stream of the flight reads it
+            resultTask.cancel()
+            if not isPersist and cls.readers_.get(flight.jobId, 0) == 0:
+                cls.removeOutputOnDone_(flight.jobId, flight.promise)
+            raise
+
+        ## NOTE: the reader is counted before the body starts, thus the output is kept until the body reads it.
+        ## It is released by the body on its end or by the response on its end, whichever comes first,
+        ## i.e. a client that disconnects before the body starts releases it too
+        cls.readers_[flight.jobId] = cls.readers_.get(flight.jobId, 0) + 1
+        isReleased = False
+
+        def release():
+            nonlocal isReleased
+            if not isReleased:
+                isReleased = True
+                cls.release_(flight, resultTask, isPersist)
+
+        FastApiServer.outputStore.touch("pdf2image", flight.jobId)
+        pages = cls.pages_(flight, jobData, resultTask, prefix)
+        if output == "zip":
+            body = zipStream(pages)
+            mediaType = "application/zip"
+            headers = {"Content-Disposition": f'attachment; filename="{flight.jobId}.zip"'}
+        else:
+            body = multipartStream(pages, cls.BOUNDARY, "image/png")
+            mediaType = f"multipart/mixed; boundary={cls.BOUNDARY}"
+            headers = {}
+        headers["X-Job-Id"] = flight.jobId
+        return ClosingResponse_(
+            cls.closing_(body, flight.jobId, release), release, media_type=mediaType, headers=headers
+        )
+
+    @classmethod
+    def firstPagePathOf_(cls, jobId: str, jobData: QueueJobPdf2Image) -> str:
+        previewIdx = next(pdf2imagePreviewIdxsOf(jobData), None)
+        if previewIdx is not None:
+            return f"{pdf2imageOutDirOf(jobId)}/{pdf2imagePreviewNameOf(previewIdx)}"
+        return f"{pdf2imageOutDirOf(jobId)}/{pdf2imagePageNameOf(next(pdf2imagePageIdxsOf(jobData)))}"
+
+    @classmethod
+    async def pages_(
+        cls, flight: Flight, jobData: QueueJobPdf2Image, resultTask: asyncio.Future[QueueJobResult], prefix: str
+    ) -> AsyncIterator[Tuple[str, str]]:
+        """
+        Yield (pageName, pagePath) in page order as soon as each page is written, until the job is done
+
+        NOTE: preview pages (if any) first, the preview ends once its stage result is received
+        """
+        outDir = pdf2imageOutDirOf(flight.jobId)
+        phases: List[Tuple[Iterator[int], Callable[[int], str], Callable[[], bool]]] = [
+            (
+                pdf2imagePreviewIdxsOf(jobData),
+                pdf2imagePreviewNameOf,
+                lambda: len(flight.stages) > 0 or resultTask.done(),
+            ),
+            (pdf2imagePageIdxsOf(jobData), pdf2imagePageNameOf, resultTask.done),
+        ]
+        nPages = 0
+        for pageIdxs, nameOf, isPhaseDone in phases:
+            pageIdx = next(pageIdxs, None)
+            while pageIdx is not None:
+                pagePath = f"{outDir}/{nameOf(pageIdx)}"
+                if os.path.isfile(pagePath):
+                    yield nameOf(pageIdx), pagePath
+                    nPages += 1
+                    pageIdx = next(pageIdxs, None)
+                    continue
+                if isPhaseDone():
+                    ## NOTE: the last pages may be written right before the phase is done
+                    if os.path.isfile(pagePath):
+                        continue
+                    break
+                await asyncio.wait([resultTask], timeout=cls.POLL_SEC)
+
+        ## NOTE: all pages of a page subset may be written before the job is done
+        result = await resultTask
+        if result["errCode"] != "":
+            ## headers are sent already, the body is cut short (i.e. the client sees an incomplete archive)
+            raise Exception(f"job failed after {nPages} pages, err={result['err']}")
+        U.logD(f"{prefix} streamed {nPages} pages")
+
+    @classmethod
+    async def closing_(
+        cls, body: AsyncIterator[bytes], jobId: str, release: Callable[[], None]
+    ) -> AsyncIterator[bytes]:
+        funcName = cls.closing_.__name__
+        prefix = f"{funcName}[{jobId}]"
+        try:
+            async for chunk in body:
+                if len(chunk) > 0:
+                    yield chunk
+        except Exception as e:
+            U.logPrefixE(prefix, e)
+            raise
+        finally:
+            ## client disconnected or stream ended
+            release()
+
+    @classmethod
+    def release_(cls, flight: Flight, resultTask: asyncio.Future[QueueJobResult], isPersist: bool):
+        """
+        A stream of the flight ends: stop waiting for the job, remove a not persisted output after the last stream
+        """
+        jobId = flight.jobId
+        if not resultTask.done():
+            resultTask.cancel()
+        cls.readers_[jobId] -= 1
+        if cls.readers_[jobId] == 0:
+            del cls.readers_[jobId]
+            if not isPersist:
+                cls.removeOutputOnDone_(jobId, flight.promise)
+
+    @classmethod
+    def removeOutputOnDone_(cls, jobId: str, jobPromise: asyncio.Future[QueueJobResult]):
+        """
+        Remove output of a not persisted job once no stream reads it and the job is done (a worker may still write)
+        """
+
+        def remove(_=None):
+            if cls.readers_.get(jobId, 0) == 0:
+                U.logD(f"removing not persisted output of job[{jobId}]")
+                shutil.rmtree(pdf2imageOutDirOf(jobId), ignore_errors=True)
+
+        if not jobPromise.done():
+            jobPromise.add_done_callback(remove)
+        else:
+            remove()
@@ -1,38 +1,21 @@
-import os
+import queue
+import asyncio
+from http import HTTPStatus
 from typing import Optional
 from fastapi import FastAPI, Body, HTTPException, File, UploadFile, Form, Depends, Request
 from fastapi.exceptions import ResponseValidationError
 from pydantic import BaseModel, Field, validator
-import pdf2image
 
 import util as U
 from util.fastApi import throwHttpPrefix
-from .worker.types import QueueJobResult
+from app import FastApiServer
+from .worker.types import QueueJob, QueueJobResult, QueueJobType
 
 
 class SimpleRes(BaseModel):
     data: str
 
 
-def onJobPdf2image(jobId: str, jobResult: QueueJobResult):
-    funcName = onJobPdf2image.__name__
-    prefix = f"{funcName}[{jobId}]"
-    try:
-        pdfPath = f"./data/regal-17pages.pdf"
-        U.logD(f"{prefix} converting {pdfPath}")
-        pages = pdf2image.convert_from_path(pdfPath, thread_count=4)
-        if pages is not None and len(pages) > 0:
-            basedDir = f"./out/pdf2image/{jobId}"
-            os.makedirs(basedDir)
-            for idx, page in enumerate(pages):
-                page.save(f"{basedDir}/image-{idx:0>2}.png")
-        jobResult["data"] = f"pdf2image finished ({U.epochMs()}), nPages={len(pages)}"
-        U.logD(f"{prefix} finished")
-    except Exception as e:
-        U.logPrefixE(prefix, e)
-        U.throwPrefix(prefix, e)
-
-
 def initEndpoints(app: FastAPI):
     U.logD(f"{initEndpoints.__name__}[{__file__.split('/')[-1]}] loading...")
 
@@ -85,16 +68,30 @@ def initEndpoints(app: FastAPI):
         prefix = funcName
         try:
             jobId = U.uuid()
-            jobResult: QueueJobResult = {
-                "errCode": "",
-                "err": "",
-                "data": "",
-                "workerName": "test",
-                "dequeueElapsedMs": 0,
-                "processElapsedMs": 0,
-                "totalElapsedMs": 0,
+            resultPromise: asyncio.Future[QueueJobResult] = asyncio.Future()
+            job: QueueJob = {
+                "createEpms": U.epochMs(),
+                "id": jobId,
+                "jobType": QueueJobType.PDF2IMAGE,
+                "jobData": {
+                    "tag": QueueJobType.PDF2IMAGE,
+                    "pdfFilePath": f"./data/regal-17pages.pdf",
+                },
+                "promise": resultPromise,
             }
-            onJobPdf2image(jobId, jobResult)
+
+            ## Run the job in a pool thread (inline executor), i.e. it does not block the event loop
+            try:
+                FastApiServer.executors["inline"].submit(job)
+            except queue.Full:
+                raise HTTPException(
+                    status_code=HTTPStatus.SERVICE_UNAVAILABLE, detail=f"Service unavailable (too many jobs)"
+                )
+            FastApiServer.addJobOutputOnDone(job)
+            async with asyncio.timeout(60):
+                jobResult = await resultPromise
+            if jobResult["errCode"] != "":
+                raise Exception(jobResult["err"])
             return jobResult
         except Exception as e:
             throwHttpPrefix(prefix, e)
@@ -0,0 +1,47 @@
+from http import HTTPStatus
+from fastapi import FastAPI, Response
+
+import util as U
+from app import FastApiServer
+from util.fastApi import throwHttpPrefix
+from api.worker import FairExecutor, HedgedExecutor
+
+
+def initEndpoints(app: FastAPI):
+    U.logD(f"{initEndpoints.__name__}[{__file__.split('/')[-1]}] loading...")
+
+    @app.get(
+        "/status", description="Server status, e.g. startup phase timings and measured service times (ms per page)"
+    )
+    async def status(response: Response):
+        funcName = status.__name__
+        prefix = funcName
+        try:
+            ## NOTE: workers failed to start, i.e. the process never serves jobs, health checks must fail
+            if FastApiServer.workersStartError != "":
+                response.status_code = HTTPStatus.SERVICE_UNAVAILABLE
+            return {
+                "data": {
+                    "isWorkersReady": FastApiServer.isWorkersReady,
+                    "workersStartError": FastApiServer.workersStartError,
+                    "startupPhasesMs": FastApiServer.startupPhasesMs,
+                    "serviceTimesMs": FastApiServer.serviceTimes.snapshot(),
+                    "journal": FastApiServer.journal.stats() if FastApiServer.journal is not None else None,
+                    "config": FastApiServer.CONFIG,
+                    "renderBudget": FastApiServer.renderBudget.stats(),
+                    "outputStore": FastApiServer.outputStore.stats(),
+                    "pdfInfos": FastApiServer.pdfInfos.stats(),
+                    "tenants": {
+                        name: executor.stats()
+                        for name, executor in FastApiServer.executors.items()
+                        if isinstance(executor, FairExecutor)
+                    },
+                    "hedging": {
+                        name: executor.stats()
+                        for name, executor in FastApiServer.executors.items()
+                        if isinstance(executor, HedgedExecutor)
+                    },
+                }
+            }
+        except Exception as e:
+            throwHttpPrefix(prefix, e)
@@ -6,6 +6,7 @@ from fastapi import FastAPI, Body, HTTPException, File, UploadFile, Form, Depend
 
 import util as U
 from util.fastApi import throwHttpPrefix
+from app import FastApiServer
 
 
 def initEndpoints(app: FastAPI):
@@ -65,7 +66,7 @@ def initEndpoints(app: FastAPI):
             U.logD(f"{prefix} form={formData}, nFiles={len(files)}")
 
             # Create async tasks for file uploads
-            baseDir = f"./out/uploads/{jobId}"
+            baseDir = FastApiServer.outputStore.dirOf("uploads", jobId)
             os.makedirs(baseDir)
             fileUploadAsyncTasks = [
                 onUploadFile(file, baseDir, f"file-{fileIdx+1:0>2}") for fileIdx, file in enumerate(files)
@@ -73,6 +74,7 @@ def initEndpoints(app: FastAPI):
 
             ## wait for completion of all async tasks
             outFilePaths = await asyncio.gather(*fileUploadAsyncTasks)
+            FastApiServer.outputStore.add("uploads", jobId)
             U.logD(f"{prefix} request completed")
 
             return {
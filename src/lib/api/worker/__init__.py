@@ -1,3 +1,17 @@
 from .types import *
+from .admission import *
+from .singleFlight import *
+from .queueBackend import *
+from .journal import *
+from .renderBudget import *
+from .jobHandlers import *
+from .pdfInfo import *
+from .scheduler import *
+from .pipeTransport import *
 from .mtWorker import *
 from .mpWorker import *
+from .poolServer import *
+from .executor import *
+from .fairQueue import *
+from .hedging import *
+from .outputStore import *
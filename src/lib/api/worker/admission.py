@@ -0,0 +1,95 @@
+import math
+import threading
+from typing import Final, List, Dict, Tuple, TypedDict, Union
+
+import util as U
+from .types import MpQueueJob, QueueJob, QueueJobType
+
+
+def jobPagesOf(job: Union[QueueJob, MpQueueJob]) -> int:
+    """
+    Cost of a job in pages (refer to QueueJob.pages), 1 for jobs without page count (e.g. message)
+    """
+    return job.get("pages", 1)
+
+
+class AdmissionDecision(TypedDict):
+    isAdmitted: bool
+    ## expected ms from now until the job result is ready
+    expectedMs: int
+    ## suggested seconds for the client to retry (0 if admitted)
+    retryAfterSec: int
+
+
+class ServiceTimeEstimator:
+    """
+    Estimate job completion time from measured service times
+
+    NOTE:
+    - Service time of each job type is an EWMA of recent processElapsedMs per page reported by workers
+      (a job without page count is 1 page, refer to jobPagesOf), i.e. a 500-page pdf is not 1 job
+    - Before any job is measured, a default service time of the job type is used
+    - record() is called from worker threads, thus it is protected by a lock
+    """
+
+    EWMA_ALPHA: Final[float] = 0.2
+    ## ms per page
+    DEFAULT_SERVICE_MS: Final[Dict[str, int]] = {
+        QueueJobType.MESSAGE: 3000,
+        QueueJobType.PDF2IMAGE: 400,
+    }
+
+    ## limit the instance variable
+    ## Why? avoid bugs some methods created wrong instance variable
+    __slots__ = ("alpha_", "ewmaMs_", "lock_")
+
+    def __init__(self, alpha: float = EWMA_ALPHA):
+        self.alpha_ = alpha
+        self.ewmaMs_: Dict[str, float] = {}
+        self.lock_ = threading.Lock()
+
+    def record(self, jobType: str, processElapsedMs: int, pages: int = 1):
+        pageMs = processElapsedMs / max(1, pages)
+        with self.lock_:
+            ewmaMs = self.ewmaMs_.get(jobType)
+            self.ewmaMs_[jobType] = pageMs if ewmaMs is None else self.alpha_ * pageMs + (1 - self.alpha_) * ewmaMs
+
+    def serviceMs(self, jobType: str) -> float:
+        ewmaMs = self.ewmaMs_.get(jobType)
+        if ewmaMs is not None:
+            return ewmaMs
+        return self.DEFAULT_SERVICE_MS.get(jobType, 0)
+
+    def snapshot(self) -> Dict[str, int]:
+        return {getattr(k, "value", k): int(v) for k, v in self.ewmaMs_.items()}
+
+    def expectedMs(self, jobType: str, pendingPages: int, activeWorkers: int, jobPages: int = 1) -> float:
+        """
+        Expected ms until a new job completes
+
+        Args:
+            pendingPages: pages of the jobs queued or running ahead of the new job
+            activeWorkers: workers serving the queue in parallel
+            jobPages: pages of the new job
+        """
+        ## Pending pages are served by the workers in parallel, the new job runs after the pages ahead of it
+        pagesAhead = pendingPages // max(1, activeWorkers)
+        return (pagesAhead + jobPages) * self.serviceMs(jobType)
+
+    def admit(
+        self, jobType: str, pendingPages: int, activeWorkers: int, deadlineMs: int, jobPages: int = 1
+    ) -> AdmissionDecision:
+        """
+        Decide if a new job can complete before its deadline
+        """
+        expectedMs = self.expectedMs(jobType, pendingPages, activeWorkers, jobPages)
+        if activeWorkers > 0 and expectedMs <= deadlineMs:
+            return {"isAdmitted": True, "expectedMs": int(expectedMs), "retryAfterSec": 0}
+
+        ## retry after enough jobs ahead have completed
+        retryAfterSec = max(1, math.ceil((expectedMs - deadlineMs) / 1000)) if activeWorkers > 0 else 5
+        U.logW(
+            f"admission rejected job[{jobType}], pages={jobPages}, pendingPages={pendingPages}, workers={activeWorkers}, "
+            f"expectedMs={int(expectedMs)}, deadlineMs={deadlineMs}"
+        )
+        return {"isAdmitted": False, "expectedMs": int(expectedMs), "retryAfterSec": retryAfterSec}
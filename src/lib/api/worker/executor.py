@@ -0,0 +1,182 @@
+import time
+import queue
+import asyncio
+from abc import ABC, abstractmethod
+from typing import Final, Union, List, Dict, Set, Tuple, Optional
+
+import util as U
+from .types import QueueJob, QueueJobResult
+from .admission import ServiceTimeEstimator, jobPagesOf
+from .jobHandlers import runJob, stageReceiverOf
+from .mtWorker import MultiThreadQueueWorker
+from .mpWorker import MultiProcessManager
+from .poolServer import RemoteProcessManager
+
+
+class JobExecutor(ABC):
+    """
+    Interface of an executor (a pool of workers) that runs jobs, refer to jobHandlers.py for the job handlers
+
+    NOTE:
+    - submit() does not wait for the job, the result is set to job["promise"] in the event loop thread
+    - submit() raises queue.Full if the executor cannot take more jobs
+    - All methods must be called in the event loop thread
+    - submit()/load()/stop() are abstract, i.e. an incomplete executor fails on instantiation
+    """
+
+    ## NOTE: empty, thus __slots__ of subclasses take effect
+    __slots__ = ()
+
+    name: str
+
+    @abstractmethod
+    def submit(self, job: QueueJob):
+        pass
+
+    @abstractmethod
+    def load(self) -> Tuple[int, int]:
+        """
+        Returns:
+            (pendingPages, activeWorkers) pendingPages are pages of queued or running jobs (refer to jobPagesOf),
+            used for admission control
+        """
+
+    @abstractmethod
+    async def stop(self, timeoutSec: float = 0):
+        """
+        Stop the workers after their running job, workers still running after timeoutSec are left behind/terminated
+        """
+
+
+class ThreadExecutor(JobExecutor):
+    """
+    Jobs run in MultiThreadQueueWorker threads, the least busy queue is chosen if workers have their own queues
+    """
+
+    ## limit the instance variable
+    ## Why? avoid bugs some methods created wrong instance variable
+    __slots__ = ("name", "workers_")
+
+    def __init__(self, name: str, workers: List[MultiThreadQueueWorker]):
+        self.name = name
+        self.workers_ = workers
+
+    def submit(self, job: QueueJob):
+        ## NOTE: non-block put, i.e. raise queue.Full if queue is already full
+        MultiThreadQueueWorker.leastBusyWorkers(self.workers_).jobQueue().put(job, block=False)
+
+    def load(self) -> Tuple[int, int]:
+        jobQueues = {id(w.jobQueue()): w.jobQueue() for w in self.workers_}
+        pendingPages, activeWorkers = 0, 0
+        for jobQueue in jobQueues.values():
+            queuePendingPages, queueWorkers = MultiThreadQueueWorker.queueLoad(self.workers_, jobQueue)
+            pendingPages += queuePendingPages
+            activeWorkers += queueWorkers
+        return pendingPages, activeWorkers
+
+    async def stop(self, timeoutSec: float = 0):
+        funcName = self.stop.__name__
+        prefix = f"{self.name}.{funcName}"
+        for w in self.workers_:
+            w.stop()
+
+        ## NOTE: join() blocks, thus it runs in pool thread
+        deadlineSec = time.monotonic() + timeoutSec
+        for w in self.workers_:
+            await asyncio.to_thread(w.join, max(0, deadlineSec - time.monotonic()))
+        runningWorkers = [w.name() for w in self.workers_ if w.is_alive()]
+        if len(runningWorkers) > 0:
+            ## NOTE: worker threads are daemon threads, they do not block the process exit
+            U.logW(f"{prefix} workers still running after {timeoutSec}s, workers={runningWorkers}")
+        else:
+            U.logW(f"{prefix} all multi-thread workers stopped")
+
+
+class ProcessExecutor(JobExecutor):
+    """
+    Jobs run in MultiProcessWorker processes, owned by this process (MultiProcessManager) or a shared pool (RemoteProcessManager)
+    """
+
+    ## limit the instance variable
+    ## Why? avoid bugs some methods created wrong instance variable
+    __slots__ = ("name", "mpManager_")
+
+    def __init__(self, name: str, mpManager: Union[MultiProcessManager, RemoteProcessManager]):
+        self.name = name
+        self.mpManager_ = mpManager
+
+    def mpManager(self) -> Union[MultiProcessManager, RemoteProcessManager]:
+        return self.mpManager_
+
+    def submit(self, job: QueueJob):
+        self.mpManager_.enqueue(job)
+
+    def load(self) -> Tuple[int, int]:
+        return self.mpManager_.pendingPageCount(), self.mpManager_.activeWorkerCount()
+
+    async def stop(self, timeoutSec: float = 0):
+        await self.mpManager_.stopAllProcesses(timeoutSec)
+
+
+class InlineExecutor(JobExecutor):
+    """
+    Jobs run in the default pool threads of the event loop (asyncio.to_thread), no dedicated workers nor queue
+
+    NOTE:
+    - at most maxConcurrency jobs run at the same time, submit() raises queue.Full beyond that
+    - if cpus is specified, the pool thread running a job is pinned to cpus (it stays pinned afterwards),
+      thus renders do not run on the cpus reserved for the event loop
+    """
+
+    ## limit the instance variable
+    ## Why? avoid bugs some methods created wrong instance variable
+    __slots__ = ("name", "maxConcurrency_", "serviceTimes_", "tasks_", "pendingPages_", "isStopped_", "cpus_")
+
+    def __init__(
+        self,
+        name: str,
+        maxConcurrency: int,
+        serviceTimes: Optional[ServiceTimeEstimator] = None,
+        cpus: Optional[List[int]] = None,
+    ):
+        self.name = name
+        self.cpus_: List[int] = cpus if cpus is not None else []
+        self.maxConcurrency_ = maxConcurrency
+        self.serviceTimes_ = serviceTimes
+        self.tasks_: Set[asyncio.Task] = set()
+        self.pendingPages_ = 0
+        self.isStopped_ = False
+
+    def submit(self, job: QueueJob):
+        if self.isStopped_:
+            raise Exception(f"{self.name} stopped")
+        if len(self.tasks_) >= self.maxConcurrency_:
+            raise queue.Full()
+        task = asyncio.create_task(self.run_(job))
+        self.tasks_.add(task)
+        self.pendingPages_ += jobPagesOf(job)
+        task.add_done_callback(self.tasks_.discard)
+
+    def load(self) -> Tuple[int, int]:
+        return self.pendingPages_, self.maxConcurrency_
+
+    async def stop(self, timeoutSec: float = 0):
+        self.isStopped_ = True
+        if len(self.tasks_) > 0:
+            await asyncio.wait(list(self.tasks_), timeout=timeoutSec)
+
+    async def run_(self, job: QueueJob):
+        try:
+            result = await asyncio.to_thread(self.runJobPinned_, job)
+        finally:
+            self.pendingPages_ -= jobPagesOf(job)
+        if self.serviceTimes_ is not None and result["errCode"] == "":
+            self.serviceTimes_.record(job["jobType"], result["processElapsedMs"], jobPagesOf(job))
+        if not job["promise"].done():
+            job["promise"].set_result(result)
+
+    def runJobPinned_(self, job: QueueJob) -> QueueJobResult:
+        ## NOTE: runs in a pool thread
+        if len(self.cpus_) > 0 and U.usableCpus() != self.cpus_:
+            U.setCpuAffinity(self.cpus_)
+        return runJob(job, self.name, stageReceiverOf(job), job["promise"].done)
@@ -0,0 +1,283 @@
+import queue
+import asyncio
+from collections import deque
+from typing import Final, List, Dict, Deque, Set, Tuple, Optional, TypedDict
+
+import util as U
+from .types import QueueJob, QueueJobErrCode
+from .admission import jobPagesOf
+from .jobHandlers import newJobResult
+from .scheduler import CostQueue, jobCostOf, newJobQueue, SCHEDULING_AGING_MS
+from .executor import JobExecutor
+
+## Tenant of jobs without tenant (e.g. replayed from the journal)
+DEFAULT_TENANT: Final[str] = "default"
+
+
+class TenantStats(TypedDict):
+    queued: int
+    inFlight: int
+    dispatched: int
+    rejected: int
+    deficit: float
+
+
+class TenantQueueFull(queue.Full):
+    """
+    The tenant has maxQueued jobs waiting already, i.e. the tenant (not the server) is over its quota
+    """
+
+    def __init__(self, tenant: str, queuedPages: int, maxInFlight: int):
+        super().__init__(f"tenant[{tenant}] queue full")
+        self.tenant = tenant
+        ## pages ahead of a new job of the tenant and the workers serving them, refer to ServiceTimeEstimator.expectedMs
+        self.queuedPages = queuedPages
+        self.maxInFlight = maxInFlight
+
+
+class Tenant_:
+    ## limit the instance variable
+    ## Why? avoid bugs some methods created wrong instance variable
+    __slots__ = ("jobs", "deficit", "inFlight", "dispatched", "rejected")
+
+    def __init__(self, jobs: queue.Queue):
+        self.jobs = jobs
+        self.deficit: float = 0
+        self.inFlight = 0
+        self.dispatched = 0
+        self.rejected = 0
+
+
+class FairExecutor(JobExecutor):
+    """
+    Per-tenant fair queuing in front of an executor (a pool), i.e. a tenant's bulk import cannot take all workers
+
+    NOTE:
+    - Each tenant has its own queue (at most maxQueued jobs, submit() raises TenantQueueFull beyond that)
+      ordered by the scheduling policy of the pool (refer to newJobQueue)
+    - Jobs are dispatched to the executor only while it has a free worker, thus the executor holds no backlog
+    - Deficit round robin across tenants with queued jobs: each visit adds quantum to the tenant's deficit,
+      the tenant dispatches jobs while the cost of its next job (refer to jobCostOf) fits in the deficit.
+      Thus tenants get the same share of pages, not of jobs, and a large job is dispatched after enough rounds
+    - A tenant never has more than maxInFlight jobs dispatched, it is skipped (and gains no deficit) meanwhile
+    - A job rejected by the executor (queue.Full) stays at the head of its tenant queue. It is retried on the next
+      job done, or after a backoff (RETRY_MIN_SEC to RETRY_MAX_SEC) if none is in flight, e.g. a shared pool
+      filled by other API processes
+    - All methods must be called in the event loop thread
+    """
+
+    QUANTUM: Final[float] = 4
+    RETRY_MIN_SEC: Final[float] = 0.05
+    RETRY_MAX_SEC: Final[float] = 1
+
+    ## limit the instance variable
+    ## Why? avoid bugs some methods created wrong instance variable
+    __slots__ = (
+        "name",
+        "executor_",
+        "maxInFlight_",
+        "maxQueued_",
+        "quantum_",
+        "scheduling_",
+        "schedulingAgingMs_",
+        "tenants_",
+        "active_",
+        "isQuantumGranted_",
+        "inFlight_",
+        "dispatchedIds_",
+        "retryTimer_",
+        "retrySec_",
+        "isStopped_",
+    )
+
+    def __init__(
+        self,
+        executor: JobExecutor,
+        maxInFlight: int,
+        maxQueued: int,
+        quantum: float = QUANTUM,
+        scheduling: str = "fifo",
+        schedulingAgingMs: int = SCHEDULING_AGING_MS,
+    ):
+        """
+        Args:
+            executor: the pool, the name of this executor is the same (e.g. for the journal)
+            maxInFlight/maxQueued: limits of each tenant
+            quantum: cost added to the deficit of a tenant per round (1: a page at the default dpi)
+            scheduling/schedulingAgingMs: order of the jobs of a tenant, refer to newJobQueue
+        """
+        funcName = f"{FairExecutor.__name__}.ctor"
+        prefix = funcName
+        try:
+            if maxInFlight < 1 or maxQueued < 1 or quantum <= 0:
+                raise Exception(f"invalid maxInFlight={maxInFlight}, maxQueued={maxQueued}, quantum={quantum}")
+            self.name = executor.name
+            self.executor_ = executor
+            self.maxInFlight_ = maxInFlight
+            self.maxQueued_ = maxQueued
+            self.quantum_ = quantum
+            self.scheduling_ = scheduling
+            self.schedulingAgingMs_ = schedulingAgingMs
+            self.tenants_: Dict[str, Tenant_] = {}
+            ## tenants with queued jobs in round robin order, the first one is visited
+            self.active_: Deque[str] = deque()
+            self.isQuantumGranted_ = False
+            self.inFlight_ = 0
+            self.dispatchedIds_: Set[str] = set()
+            self.retryTimer_: Optional[asyncio.TimerHandle] = None
+            self.retrySec_ = self.RETRY_MIN_SEC
+            self.isStopped_ = False
+        except Exception as e:
+            U.throwPrefix(prefix, e)
+
+    def executor(self) -> JobExecutor:
+        return self.executor_
+
+    def submit(self, job: QueueJob):
+        if self.isStopped_:
+            raise Exception(f"{self.name} stopped")
+        tenantName = job.get("tenant", DEFAULT_TENANT)
+        tenant = self.tenants_.get(tenantName)
+        if tenant is None:
+            tenant = Tenant_(newJobQueue(self.scheduling_, self.maxQueued_, self.schedulingAgingMs_))
+            self.tenants_[tenantName] = tenant
+        try:
+            tenant.jobs.put(job, block=False)
+        except queue.Full:
+            tenant.rejected += 1
+            raise TenantQueueFull(tenantName, self.queuedPagesOf_(tenant), self.maxInFlight_)
+        if tenantName not in self.active_:
+            self.active_.append(tenantName)
+        job["promise"].add_done_callback(lambda _: self.onJobDone_(tenantName, job))
+        self.dispatch_()
+
+    def load(self) -> Tuple[int, int]:
+        pendingPages, activeWorkers = self.executor_.load()
+        return pendingPages + sum([self.queuedPagesOf_(t) for t in self.tenants_.values()]), activeWorkers
+
+    async def stop(self, timeoutSec: float = 0):
+        ## NOTE: queued jobs are not dispatched anymore, they are resolved by the caller (drain)
+        self.isStopped_ = True
+        if self.retryTimer_ is not None:
+            self.retryTimer_.cancel()
+            self.retryTimer_ = None
+        await self.executor_.stop(timeoutSec)
+
+    def stats(self) -> Dict[str, TenantStats]:
+        return {
+            tenantName: {
+                "queued": tenant.jobs.qsize(),
+                "inFlight": tenant.inFlight,
+                "dispatched": tenant.dispatched,
+                "rejected": tenant.rejected,
+                "deficit": tenant.deficit,
+            }
+            for tenantName, tenant in self.tenants_.items()
+        }
+
+    @staticmethod
+    def queuedPagesOf_(tenant: Tenant_) -> int:
+        with tenant.jobs.mutex:
+            jobs = tenant.jobs.jobs() if isinstance(tenant.jobs, CostQueue) else tenant.jobs.queue
+            return sum([jobPagesOf(job) for job in jobs])
+
+    @staticmethod
+    def nextJobOf_(tenant: Tenant_) -> Optional[QueueJob]:
+        ## NOTE: the job get() would return, i.e. queue.Queue has no peek
+        with tenant.jobs.mutex:
+            if len(tenant.jobs.queue) == 0:
+                return None
+            return tenant.jobs.queue[0][2] if isinstance(tenant.jobs, CostQueue) else tenant.jobs.queue[0]
+
+    def dispatch_(self):
+        """
+        Dispatch jobs of the active tenants by deficit round robin while the executor has free workers
+        """
+        funcName = self.dispatch_.__name__
+        prefix = f"{self.name}.{funcName}"
+        if self.isStopped_:
+            return
+        ## one job per worker, at least 1 thus jobs are dispatched while workers are (re)starting
+        maxInFlight = max(1, self.executor_.load()[1])
+        skippedTenants = 0
+        while len(self.active_) > 0 and self.inFlight_ < maxInFlight and skippedTenants < len(self.active_):
+            tenantName = self.active_[0]
+            tenant = self.tenants_[tenantName]
+            job = self.nextJobOf_(tenant)
+
+            ## no more queued jobs, the tenant leaves the round (its deficit is not kept)
+            if job is None:
+                tenant.deficit = 0
+                self.active_.popleft()
+                self.isQuantumGranted_ = False
+                if tenant.inFlight == 0:
+                    del self.tenants_[tenantName]
+                continue
+
+            ## a job done while it is queued (e.g. aborted on shutdown) is dropped
+            if job["promise"].done():
+                tenant.jobs.get_nowait()
+                continue
+
+            if tenant.inFlight < self.maxInFlight_:
+                if not self.isQuantumGranted_:
+                    tenant.deficit += self.quantum_
+                    self.isQuantumGranted_ = True
+                cost = jobCostOf(job)
+                if cost <= tenant.deficit:
+                    try:
+                        self.executor_.submit(job)
+                    except queue.Full:
+                        ## NOTE: the job stays at the head of its tenant queue (it is removed once submitted)
+                        self.retryLater_()
+                        break
+                    except Exception as e:
+                        tenant.jobs.get_nowait()
+                        U.logPrefixE(prefix, e)
+                        result = newJobResult(self.name)
+                        result["errCode"] = QueueJobErrCode.ERR
+                        result["err"] = f"{e}"
+                        job["promise"].set_result(result)
+                        continue
+                    tenant.jobs.get_nowait()
+                    self.retrySec_ = self.RETRY_MIN_SEC
+                    tenant.deficit -= cost
+                    tenant.inFlight += 1
+                    tenant.dispatched += 1
+                    self.inFlight_ += 1
+                    self.dispatchedIds_.add(job["id"])
+                    skippedTenants = 0
+                    continue
+
+            ## next tenant, the tenant keeps its deficit for the next round
+            ## NOTE: a tenant at maxInFlight gains no deficit, i.e. no burst once its jobs are done
+            skippedTenants = skippedTenants + 1 if tenant.inFlight >= self.maxInFlight_ else 0
+            self.active_.rotate(-1)
+            self.isQuantumGranted_ = False
+
+    def retryLater_(self):
+        """
+        Retry the dispatch after a backoff if no job is in flight, i.e. no job done would retry it
+        """
+        if self.inFlight_ > 0 or self.retryTimer_ is not None:
+            return
+
+        def retry():
+            self.retryTimer_ = None
+            self.dispatch_()
+
+        self.retryTimer_ = asyncio.get_running_loop().call_later(self.retrySec_, retry)
+        self.retrySec_ = min(self.RETRY_MAX_SEC, self.retrySec_ * 2)
+
+    def onJobDone_(self, tenantName: str, job: QueueJob):
+        if job["id"] not in self.dispatchedIds_:
+            ## done while queued, it is dropped on dispatch
+            return
+        self.dispatchedIds_.discard(job["id"])
+        tenant = self.tenants_[tenantName]
+        tenant.inFlight -= 1
+        self.inFlight_ -= 1
+        if tenant.inFlight == 0 and tenant.jobs.qsize() == 0 and tenantName not in self.active_:
+            ## idle tenant, e.g. a client seen once
+            del self.tenants_[tenantName]
+        self.dispatch_()
@@ -0,0 +1,231 @@
+import random
+import asyncio
+from collections import deque
+from typing import Final, List, Dict, Deque, Tuple, Optional, TypedDict
+
+import util as U
+from .types import QueueJob, QueueJobResult, QueueJobType
+from .admission import jobPagesOf
+from .executor import JobExecutor
+
+## Job types that can be hedged, i.e. the result is the whole output of the job
+## NOTE: a pdf2image job writes its pages to the output dir of its id, a duplicate cannot take its place
+HEDGEABLE_JOB_TYPES: Final[Tuple[str, ...]] = (QueueJobType.MESSAGE.value,)
+
+
+class HedgingStats(TypedDict):
+    jobs: int
+    hedged: int
+    ## hedged jobs won by the duplicate / by the primary execution
+    hedgeWins: int
+    primaryWins: int
+    ## hedges not sent, no idle worker or no budget left
+    busySkipped: int
+    budgetSkipped: int
+    ## current hedge delay of each job type
+    thresholdMs: Dict[str, int]
+
+
+def hedgeJobOf(job: QueueJob, promise: asyncio.Future[QueueJobResult]) -> QueueJob:
+    """
+    Duplicate of a job for hedging, i.e. another execution of the same job
+
+    NOTE: randomNo of a message job simulates the luck of an execution (e.g. a slow host), a duplicate draws its own
+    """
+    jobData = dict(job["jobData"])
+    if jobData["tag"] == QueueJobType.MESSAGE:
+        jobData["randomNo"] = random.randint(1, 10)
+    hedgeJob: QueueJob = {
+        "createEpms": U.epochMs(),
+        "id": f"{job['id']}-hedge",
+        "jobType": job["jobType"],
+        "jobData": jobData,
+        "promise": promise,
+    }
+    if "pages" in job:
+        hedgeJob["pages"] = job["pages"]
+    return hedgeJob
+
+
+class HedgedExecutor(JobExecutor):
+    """
+    Hedged execution in front of an executor (a pool), i.e. a job slower than most jobs is run twice, the first
+    result wins
+
+    NOTE:
+    - Jobs of HEDGEABLE_JOB_TYPES only, other jobs are submitted as they are
+    - The job is submitted as a primary execution (same id, its own promise). If it has no result after the
+      hedge delay (percentile of recent elapsed ms of its job type, at least minDelayMs), a duplicate is submitted
+      if the executor has an idle worker (refer to JobExecutor.load) and the budget allows
+    - Budget: each job adds budgetPercent/100 of a hedge, up to BUDGET_BURST hedges, a hedge takes 1.
+      Thus hedges are at most budgetPercent of the jobs, i.e. a slow pool is not loaded twice
+    - The first success resolves the job promise, the other execution is cancelled (its promise), i.e. a queued
+      one is skipped by the worker, a running one aborts at its next budget check (refer to checkJobBudget and
+      checkBatchJobBudget for a job of a batch) and its result is dropped
+    - An error (e.g. timeout of the primary over its budget) is dropped while the other execution is running,
+      the job fails only if all its executions fail (with the last error)
+    - The executor needs at least 2 workers, i.e. a duplicate never finds an idle worker otherwise
+      (refer to FastApiServer.withHedging)
+    - Elapsed ms of the winning executions are the samples of the percentile
+    - All methods must be called in the event loop thread
+    """
+
+    BUDGET_BURST: Final[float] = 5
+    ## samples of elapsed ms per job type, hedging starts after MIN_SAMPLES
+    MAX_SAMPLES: Final[int] = 200
+    MIN_SAMPLES: Final[int] = 20
+
+    ## limit the instance variable
+    ## Why? avoid bugs some methods created wrong instance variable
+    __slots__ = (
+        "name",
+        "executor_",
+        "percentile_",
+        "minDelayMs_",
+        "budgetRatio_",
+        "budget_",
+        "samplesMs_",
+        "stats_",
+        "isStopped_",
+    )
+
+    def __init__(self, executor: JobExecutor, percentile: int, minDelayMs: int, budgetPercent: int):
+        """
+        Args:
+            executor: the pool, the name of this executor is the same (e.g. for the journal)
+            percentile: hedge delay is this percentile of recent elapsed ms of the job type, e.g. 95
+            minDelayMs: min hedge delay
+            budgetPercent: max hedges in percent of the jobs
+        """
+        funcName = f"{HedgedExecutor.__name__}.ctor"
+        prefix = funcName
+        try:
+            if not (0 < percentile < 100) or minDelayMs < 0 or budgetPercent <= 0:
+                raise Exception(
+                    f"invalid percentile={percentile}, minDelayMs={minDelayMs}, budgetPercent={budgetPercent}"
+                )
+            self.name = executor.name
+            self.executor_ = executor
+            self.percentile_ = percentile
+            self.minDelayMs_ = minDelayMs
+            self.budgetRatio_ = budgetPercent / 100
+            self.budget_: float = 0
+            self.samplesMs_: Dict[str, Deque[int]] = {}
+            self.stats_: HedgingStats = {
+                "jobs": 0,
+                "hedged": 0,
+                "hedgeWins": 0,
+                "primaryWins": 0,
+                "busySkipped": 0,
+                "budgetSkipped": 0,
+                "thresholdMs": {},
+            }
+            self.isStopped_ = False
+        except Exception as e:
+            U.throwPrefix(prefix, e)
+
+    def executor(self) -> JobExecutor:
+        return self.executor_
+
+    def submit(self, job: QueueJob):
+        if self.isStopped_:
+            raise Exception(f"{self.name} stopped")
+        jobType = getattr(job["jobType"], "value", job["jobType"])
+        if jobType not in HEDGEABLE_JOB_TYPES:
+            self.executor_.submit(job)
+            return
+
+        ## primary execution, raises queue.Full as the executor does
+        loop = asyncio.get_running_loop()
+        primary: QueueJob = {**job, "promise": loop.create_future()}
+        self.executor_.submit(primary)
+        self.stats_["jobs"] += 1
+        self.budget_ = min(self.BUDGET_BURST, self.budget_ + self.budgetRatio_)
+
+        executions: List[QueueJob] = [primary]
+        delayMs = self.thresholdMsOf(jobType)
+        timer = loop.call_later(delayMs / 1000, self.hedge_, job, executions) if delayMs is not None else None
+        primary["promise"].add_done_callback(lambda _: self.onExecutionDone_(job, executions, primary, timer))
+
+        ## job promise done by others (e.g. timeout of the request, drain), executions are not needed anymore
+        def onJobDone(_):
+            if timer is not None:
+                timer.cancel()
+            for execution in executions:
+                execution["promise"].cancel()
+
+        job["promise"].add_done_callback(onJobDone)
+
+    def load(self) -> Tuple[int, int]:
+        return self.executor_.load()
+
+    async def stop(self, timeoutSec: float = 0):
+        self.isStopped_ = True
+        await self.executor_.stop(timeoutSec)
+
+    def stats(self) -> HedgingStats:
+        return {**self.stats_, "thresholdMs": {t: self.thresholdMsOf(t) or 0 for t in self.samplesMs_}}
+
+    def thresholdMsOf(self, jobType: str) -> Optional[int]:
+        """
+        Hedge delay of a job type, None if not enough samples yet
+        """
+        samplesMs = self.samplesMs_.get(jobType)
+        if samplesMs is None or len(samplesMs) < self.MIN_SAMPLES:
+            return None
+        sortedMs = sorted(samplesMs)
+        percentileMs = sortedMs[min(len(sortedMs) - 1, len(sortedMs) * self.percentile_ // 100)]
+        return max(self.minDelayMs_, percentileMs)
+
+    def hedge_(self, job: QueueJob, executions: List[QueueJob]):
+        funcName = self.hedge_.__name__
+        prefix = f"{self.name}.{funcName}[{job['id']}]"
+        if self.isStopped_ or job["promise"].done():
+            return
+
+        ## an idle worker, i.e. the duplicate does not wait behind other jobs nor delay them
+        pendingPages, activeWorkers = self.executor_.load()
+        if pendingPages + jobPagesOf(job) > activeWorkers:
+            self.stats_["busySkipped"] += 1
+            return
+        if self.budget_ < 1:
+            self.stats_["budgetSkipped"] += 1
+            return
+
+        hedgeJob = hedgeJobOf(job, asyncio.get_running_loop().create_future())
+        try:
+            self.executor_.submit(hedgeJob)
+        except Exception as e:
+            ## NOTE: not fatal, the primary goes on
+            U.logPrefixE(prefix, e)
+            return
+        self.budget_ -= 1
+        self.stats_["hedged"] += 1
+        executions.append(hedgeJob)
+        hedgeJob["promise"].add_done_callback(lambda _: self.onExecutionDone_(job, executions, hedgeJob, None))
+        U.logD(f"{prefix} hedged, elapsedMs={U.epochMs() - job['createEpms']}")
+
+    def onExecutionDone_(
+        self, job: QueueJob, executions: List[QueueJob], execution: QueueJob, timer: Optional[asyncio.TimerHandle]
+    ):
+        if execution["promise"].cancelled() or job["promise"].done():
+            return
+        result: QueueJobResult = execution["promise"].result()
+        ## NOTE: an error does not win while the other execution may still succeed
+        if result["errCode"] != "" and any([not other["promise"].done() for other in executions]):
+            return
+        if timer is not None:
+            timer.cancel()
+        job["promise"].set_result(result)
+
+        ## the loser is cancelled
+        if len(executions) > 1 and result["errCode"] == "":
+            self.stats_["hedgeWins" if execution is not executions[0] else "primaryWins"] += 1
+        for other in executions:
+            if other is not execution:
+                other["promise"].cancel()
+
+        if result["errCode"] == "":
+            jobType = getattr(job["jobType"], "value", job["jobType"])
+            samplesMs = self.samplesMs_.setdefault(jobType, deque(maxlen=self.MAX_SAMPLES))
+            samplesMs.append(U.epochMs() - execution["createEpms"])
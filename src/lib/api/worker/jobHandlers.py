@@ -0,0 +1,690 @@
+import os
+import time
+import itertools
+import threading
+import concurrent.futures
+from typing import Final, Union, Callable, Iterator, List, Dict, Any, Optional, Tuple
+
+import util as U
+from .types import (
+    MpQueueJob,
+    QueueJob,
+    QueueJobMessage,
+    QueueJobPdf2Image,
+    QueueJobResult,
+    QueueJobType,
+    QueueJobErrCode,
+)
+from .renderBudget import RenderBudget
+
+## A job handler processes jobData and fills in jobResult["data"], it raises on error
+## NOTE: handlers must be module level functions, thus they are available in worker processes
+JobHandler = Callable[[QueueJobResult, str, Dict[str, Any]], None]
+
+## A batch job handler processes (jobResult, jobId, jobData) of several jobs of its job type at once, e.g. tiny jobs
+## NOTE: it fills in jobResult["data"] of each job, it raises if the whole batch fails.  It may finish a job early
+## (e.g. on its own budget, refer to checkBatchJobBudget) by finishBatchJobs()
+BatchJobHandler = Callable[[List[Tuple[QueueJobResult, str, Dict[str, Any]]]], None]
+
+## Output of pdf2image jobs, i.e. {PDF2IMAGE_OUT_DIR}/{jobId}/image-NN.png
+PDF2IMAGE_OUT_DIR: Final[str] = "./out/pdf2image"
+
+## Render options of pdf2image jobs (refer to QueueJobPdf2Image)
+## NOTE: default dpi is the one of pdf2image
+PDF2IMAGE_DEFAULT_DPI: Final[int] = 200
+PDF2IMAGE_MIN_DPI: Final[int] = 18
+PDF2IMAGE_MAX_DPI: Final[int] = 600
+PDF2IMAGE_MIN_SIZE: Final[int] = 16
+PDF2IMAGE_MAX_SIZE: Final[int] = 8192
+PDF2IMAGE_STAGE_PREVIEW: Final[str] = "preview"
+
+## Pages of a renderer subprocess (pdftoppm) per chunk, the first chunks are smaller thus the first pages appear early
+## NOTE: each renderer parses the pdf again, i.e. a renderer per page would pay it for every page
+PDF2IMAGE_MAX_PAGES_PER_RENDERER: Final[int] = 16
+
+## Step of the simulated task of a message job, i.e. the budget of the job is checked every step
+MESSAGE_STEP_SEC: Final[float] = 0.1
+
+## Receiver of stage results and execution budget of the job running in this thread, refer to runJob(),
+## emitJobStage() and checkJobBudget()
+## NOTE: thread local, thus it works the same for thread, inline and process workers
+runningJob_ = threading.local()
+
+## job type -> execution budget in ms (0 or missing: no budget), refer to setJobBudgets()
+## NOTE: set before worker processes are started, thus forked processes have it too
+jobBudgetsMs_: Dict[str, int] = {}
+
+## job type -> handler
+## NOTE: keyed by str, QueueJobType is a str enum, i.e. job type decoded from json (MpQueueJob) is found too
+jobHandlers_: Dict[str, JobHandler] = {}
+
+## job type -> batch handler, refer to runJobBatch()
+batchJobHandlers_: Dict[str, BatchJobHandler] = {}
+
+## Budget of renderer subprocesses of this process (and processes sharing it)
+## NOTE: None means each render uses RenderBudget.DEFAULT_THREADS_PER_JOB without limit
+renderBudget_: Optional[RenderBudget] = None
+
+
+def registerJobHandler(jobType: str, handler: JobHandler):
+    jobHandlers_[jobType] = handler
+
+
+def registerBatchJobHandler(jobType: str, handler: BatchJobHandler):
+    batchJobHandlers_[jobType] = handler
+
+
+def hasBatchJobHandler(jobType: str) -> bool:
+    return jobType in batchJobHandlers_
+
+
+def setJobBudgets(budgetsMs: Dict[str, int]):
+    """
+    Execution budgets of job types, e.g. {"pdf2image": 60000}, a job running longer is aborted (refer to checkJobBudget)
+    """
+    global jobBudgetsMs_
+    jobBudgetsMs_ = {jobType: budgetMs for jobType, budgetMs in budgetsMs.items() if budgetMs > 0}
+
+
+def jobBudgets() -> Dict[str, int]:
+    return dict(jobBudgetsMs_)
+
+
+def jobBudgetMsOf(jobType: str) -> int:
+    """
+    Execution budget of a job type in ms, 0 if none
+    """
+    return jobBudgetsMs_.get(getattr(jobType, "value", jobType), 0)
+
+
+def setRenderBudget(budget: Optional[RenderBudget]):
+    global renderBudget_
+    renderBudget_ = budget
+
+
+def jobHandler(jobType: str):
+    """
+    Decorator to register a job handler of a job type
+    """
+
+    def decorator(handler: JobHandler) -> JobHandler:
+        registerJobHandler(jobType, handler)
+        return handler
+
+    return decorator
+
+
+def batchJobHandler(jobType: str):
+    """
+    Decorator to register a batch job handler of a job type
+    """
+
+    def decorator(handler: BatchJobHandler) -> BatchJobHandler:
+        registerBatchJobHandler(jobType, handler)
+        return handler
+
+    return decorator
+
+
+def newJobResult(workerName: str) -> QueueJobResult:
+    return {
+        "errCode": "",
+        "err": "",
+        "data": "",
+        "workerName": workerName,
+        "dequeueElapsedMs": 0,
+        "processElapsedMs": 0,
+        "totalElapsedMs": 0,
+    }
+
+
+def runJob(
+    job: Union[QueueJob, MpQueueJob],
+    workerName: str,
+    onStage: Optional[Callable[[QueueJobResult], None]] = None,
+    isAborted: Optional[Callable[[], bool]] = None,
+) -> QueueJobResult:
+    """
+    Run a job by the handler of its job type, it is shared by all executors (thread/process/inline)
+
+    Args:
+        onStage: receives stage results emitted by the handler (called in the worker thread), refer to emitJobStage()
+        isAborted: True if nobody waits for the result anymore (e.g. the promise is done), refer to checkJobBudget()
+
+    Returns:
+        result with timings, errCode/err are filled in if the job fails (it does not raise)
+        errCode is TIMEOUT if the job exceeds the budget of its job type (refer to setJobBudgets) or is aborted
+    """
+    funcName = runJob.__name__
+    prefix = f"{workerName}.{funcName}[{job['id']}]"
+    result = newJobResult(workerName)
+    try:
+        ## calculate elapsed time for job dequeue
+        onDequeueEpms = U.epochMs()
+        result["dequeueElapsedMs"] = onDequeueEpms - job["createEpms"]
+
+        jobType = job["jobType"]
+        handler = jobHandlers_.get(jobType)
+        if handler is None or job["jobData"]["tag"] != jobType:
+            raise Exception(f"invalid jobType={jobType}")
+
+        ## Process CPU intensive task
+        onProcessEpms = U.epochMs()
+        runningJob_.onStage = onStage
+        runningJob_.createEpms = job["createEpms"]
+        runningJob_.processEpms = onProcessEpms
+        budgetMs = jobBudgetMsOf(jobType)
+        runningJob_.budgetMs = budgetMs
+        runningJob_.deadlineEpms = onProcessEpms + budgetMs if budgetMs > 0 else 0
+        runningJob_.isAborted = isAborted
+        try:
+            ## NOTE: a job aborted while queued is not started
+            checkJobBudget()
+            handler(result, job["id"], job["jobData"])
+        finally:
+            runningJob_.onStage = None
+            runningJob_.deadlineEpms = 0
+            runningJob_.isAborted = None
+        onResultEpms = U.epochMs()
+
+        ## fill in the result
+        result["processElapsedMs"] = onResultEpms - onProcessEpms
+        result["totalElapsedMs"] = onResultEpms - job["createEpms"]
+
+    ## In case of exception, fill in err/errcode to the result
+    except Exception as e:
+        U.logPrefixE(prefix, e)
+        if isinstance(e, U.SWErr) and e.errCode() == U.SWErrCode.E_Timeout:
+            nowEpms = U.epochMs()
+            result["errCode"] = QueueJobErrCode.TIMEOUT
+            result["err"] = U.trimErrPrefix(str(e))
+            result["processElapsedMs"] = nowEpms - onProcessEpms
+            result["totalElapsedMs"] = nowEpms - job["createEpms"]
+        else:
+            result["errCode"] = QueueJobErrCode.ERR
+            result["err"] = "error processing job request"
+    return result
+
+
+class BatchJob_:
+    """
+    Execution budget and state of a job of the running batch, refer to runJobBatch()
+    """
+
+    ## limit the instance variable
+    ## Why? avoid bugs some methods created wrong instance variable
+    __slots__ = ("index", "job", "budgetMs", "deadlineEpms", "isAborted", "isDone")
+
+    def __init__(
+        self,
+        index: int,
+        job: Union[QueueJob, MpQueueJob],
+        budgetMs: int,
+        deadlineEpms: int,
+        isAborted: Optional[Callable[[], bool]],
+    ):
+        self.index = index
+        self.job = job
+        self.budgetMs = budgetMs
+        self.deadlineEpms = deadlineEpms
+        self.isAborted = isAborted
+        self.isDone = False
+
+
+def runJobBatch(
+    jobs: List[Union[QueueJob, MpQueueJob]],
+    workerName: str,
+    onResult: Optional[Callable[[List[Tuple[int, QueueJobResult]]], None]] = None,
+    isAborted: Optional[Callable[[Union[QueueJob, MpQueueJob]], bool]] = None,
+) -> List[QueueJobResult]:
+    """
+    Run jobs of one job type by its batch handler (refer to batchJobHandler), i.e. one call for all jobs
+
+    Args:
+        onResult: receives [(index of the job, result)] of the jobs finished together before the end of the batch
+            (refer to finishBatchJobs), e.g. their promises are resolved right away.  Results of the other jobs
+            are returned only
+        isAborted: True if nobody waits for the result of the job anymore (e.g. its promise is done),
+            refer to checkBatchJobBudget()
+
+    NOTE:
+    - Each job has the execution budget of its job type from the start of the batch (refer to setJobBudgets)
+    - processElapsedMs of a job not finished by finishBatchJobs() is the elapsed time of the whole batch
+    - Stage results are not supported, i.e. emitJobStage() is a no-op in a batch handler
+
+    Returns:
+        results in the order of jobs, errCode/err of the jobs not finished yet are filled in if the batch fails
+        (it does not raise)
+    """
+    funcName = runJobBatch.__name__
+    prefix = f"{workerName}.{funcName}[{len(jobs)}]"
+    results = [newJobResult(workerName) for _ in jobs]
+    batchJobs: Dict[int, BatchJob_] = {}
+    try:
+        onDequeueEpms = U.epochMs()
+        for job, result in zip(jobs, results):
+            result["dequeueElapsedMs"] = onDequeueEpms - job["createEpms"]
+
+        jobType = jobs[0]["jobType"]
+        handler = batchJobHandlers_.get(jobType)
+        if handler is None or any([job["jobType"] != jobType or job["jobData"]["tag"] != jobType for job in jobs]):
+            raise Exception(f"invalid jobType={jobType}")
+
+        onProcessEpms = U.epochMs()
+        budgetMs = jobBudgetMsOf(jobType)
+        for index, (job, result) in enumerate(zip(jobs, results)):
+            ## NOTE: keyed by the result object, it is what a batch handler has of each job
+            batchJobs[id(result)] = BatchJob_(
+                index,
+                job,
+                budgetMs,
+                onProcessEpms + budgetMs if budgetMs > 0 else 0,
+                (lambda job=job: isAborted(job)) if isAborted is not None else None,
+            )
+        runningJob_.batchJobs = batchJobs
+        runningJob_.onBatchResult = onResult
+        runningJob_.processEpms = onProcessEpms
+        try:
+            handler([(result, job["id"], job["jobData"]) for job, result in zip(jobs, results)])
+        finally:
+            runningJob_.batchJobs = None
+            runningJob_.onBatchResult = None
+        onResultEpms = U.epochMs()
+
+        for job, result in zip(jobs, results):
+            if batchJobs[id(result)].isDone:
+                continue
+            result["processElapsedMs"] = onResultEpms - onProcessEpms
+            result["totalElapsedMs"] = onResultEpms - job["createEpms"]
+
+    except Exception as e:
+        U.logPrefixE(prefix, e)
+        for result in results:
+            batchJob = batchJobs.get(id(result))
+            if batchJob is not None and batchJob.isDone:
+                continue
+            result["errCode"] = QueueJobErrCode.ERR
+            result["err"] = "error processing job request"
+    return results
+
+
+def batchJobOf_(jobResult: QueueJobResult) -> Optional[BatchJob_]:
+    batchJobs = getattr(runningJob_, "batchJobs", None)
+    return batchJobs.get(id(jobResult)) if batchJobs is not None else None
+
+
+def checkBatchJobBudget(jobResult: QueueJobResult):
+    """
+    Abort a job of the running batch (raise SWErr E_Timeout) if it exceeds its execution budget or nobody waits for
+    its result, the batch handler fails the job alone by finishBatchJobs([(jobResult, err)])
+
+    NOTE: same as checkJobBudget() for a job of a batch
+    """
+    batchJob = batchJobOf_(jobResult)
+    if batchJob is None:
+        return
+    if batchJob.deadlineEpms > 0 and U.epochMs() > batchJob.deadlineEpms:
+        raise U.SWErr(U.SWErrCode.E_Timeout, f"job exceeded its budget of {batchJob.budgetMs}ms")
+    if batchJob.isAborted is not None and batchJob.isAborted():
+        raise U.SWErr(U.SWErrCode.E_Timeout, "job aborted, nobody waits for its result")
+
+
+def finishBatchJobs(jobResults: List[Tuple[QueueJobResult, Optional[Exception]]]):
+    """
+    Finish jobs of the running batch before the end of the batch, their results are sent right away and together,
+    i.e. one wake up of the event loop for the jobs finished at once (refer to runJobBatch)
+
+    Args:
+        jobResults: (jobResult, err) of each job, err: the job failed, e.g. raised by checkBatchJobBudget(),
+            the other jobs of the batch go on
+
+    NOTE: it must be called by a batch job handler, i.e. in the thread running the batch
+    """
+    funcName = finishBatchJobs.__name__
+    nowEpms = U.epochMs()
+    finished: List[Tuple[int, QueueJobResult]] = []
+    for jobResult, err in jobResults:
+        batchJob = batchJobOf_(jobResult)
+        if batchJob is None or batchJob.isDone:
+            continue
+        batchJob.isDone = True
+        jobResult["processElapsedMs"] = nowEpms - runningJob_.processEpms
+        jobResult["totalElapsedMs"] = nowEpms - batchJob.job["createEpms"]
+        if err is not None:
+            U.logW(f"{jobResult['workerName']}.{funcName}[{batchJob.job['id']}] err={err}")
+            if isinstance(err, U.SWErr) and err.errCode() == U.SWErrCode.E_Timeout:
+                jobResult["errCode"] = QueueJobErrCode.TIMEOUT
+                jobResult["err"] = U.trimErrPrefix(str(err))
+            else:
+                jobResult["errCode"] = QueueJobErrCode.ERR
+                jobResult["err"] = "error processing job request"
+        finished.append((batchJob.index, jobResult))
+    onBatchResult = getattr(runningJob_, "onBatchResult", None)
+    if onBatchResult is not None and len(finished) > 0:
+        onBatchResult(finished)
+
+
+def stageReceiverOf(job: QueueJob) -> Optional[Callable[[QueueJobResult], None]]:
+    """
+    onStage of a job for runJob() in a worker thread, job["onStage"] is called in the event loop thread of the job promise
+    """
+    if "onStage" not in job:
+        return None
+    onStage = job["onStage"]
+    loop = job["promise"].get_loop()
+    return lambda stageResult: loop.call_soon_threadsafe(onStage, stageResult)
+
+
+def checkJobBudget():
+    """
+    Abort the running job (raise SWErr E_Timeout) if it exceeds its execution budget or nobody waits for its result
+
+    NOTE: it must be called by a job handler at its stage boundaries (e.g. between chunks of pages), i.e. cooperative
+    """
+    deadlineEpms = getattr(runningJob_, "deadlineEpms", 0)
+    if deadlineEpms > 0 and U.epochMs() > deadlineEpms:
+        raise U.SWErr(U.SWErrCode.E_Timeout, f"job exceeded its budget of {runningJob_.budgetMs}ms")
+    isAborted = getattr(runningJob_, "isAborted", None)
+    if isAborted is not None and isAborted():
+        raise U.SWErr(U.SWErrCode.E_Timeout, "job aborted, nobody waits for its result")
+
+
+def jobBudgetSecLeft() -> Optional[float]:
+    """
+    Seconds left of the execution budget of the running job, None if no budget, e.g. timeout of a renderer subprocess
+    """
+    deadlineEpms = getattr(runningJob_, "deadlineEpms", 0)
+    if deadlineEpms == 0:
+        return None
+    return max(0.001, (deadlineEpms - U.epochMs()) / 1000)
+
+
+def emitJobStage(jobResult: QueueJobResult, stage: str):
+    """
+    Send a copy of jobResult as the result of a stage, the job goes on (no-op if the submitter does not take stages)
+
+    NOTE: it must be called by a job handler, i.e. in the thread running the job
+    """
+    onStage = getattr(runningJob_, "onStage", None)
+    if onStage is None:
+        return
+    nowEpms = U.epochMs()
+    stageResult: QueueJobResult = {
+        **jobResult,
+        "processElapsedMs": nowEpms - runningJob_.processEpms,
+        "totalElapsedMs": nowEpms - runningJob_.createEpms,
+        "stage": stage,
+    }
+    onStage(stageResult)
+
+
+@jobHandler(QueueJobType.MESSAGE)
+def onJobMessage(jobResult: QueueJobResult, jobId: str, jobData: QueueJobMessage):
+    """
+    Simulate CPU task that may run 3 to 10 secs
+    If randomNo >=8, it runs for longer 10 secs
+
+    NOTE: the task is simulated in steps of MESSAGE_STEP_SEC, the budget is checked between steps (refer to checkJobBudget)
+    """
+    funcName = onJobMessage.__name__
+    prefix = funcName
+    try:
+        taskSec = 3
+        if jobData["randomNo"] >= 8:
+            U.logW(f"{prefix} simulating a CPU intensive task that runs for an unexpected long time! (10secs)")
+            taskSec = 10
+        endSec = time.monotonic() + taskSec
+        while time.monotonic() < endSec:
+            time.sleep(min(MESSAGE_STEP_SEC, endSec - time.monotonic()))
+            checkJobBudget()
+        jobResult["data"] = f"message job finished ({U.epochMs()})"
+    except Exception as e:
+        U.throwPrefix(prefix, e)
+
+
+@batchJobHandler(QueueJobType.MESSAGE)
+def onJobMessages(batch: List[Tuple[QueueJobResult, str, QueueJobMessage]]):
+    """
+    Message jobs of a batch simulated together (refer to onJobMessage), i.e. a step of MESSAGE_STEP_SEC advances
+    the tasks of all jobs of the batch
+
+    NOTE: a job is finished (its result is sent) as soon as its own task ends, e.g. a 3 secs job does not wait for
+    a 10 secs job of the batch.  The budget of each job is checked every step, a job over budget fails alone
+    """
+    funcName = onJobMessages.__name__
+    prefix = funcName
+    try:
+        startSec = time.monotonic()
+        runningJobs = [
+            (jobResult, startSec + (10 if jobData["randomNo"] >= 8 else 3)) for jobResult, _, jobData in batch
+        ]
+        longJobs = len([jobData for _, _, jobData in batch if jobData["randomNo"] >= 8])
+        if longJobs > 0:
+            U.logW(f"{prefix} simulating {longJobs} CPU intensive tasks that run for an unexpected long time! (10secs)")
+        while len(runningJobs) > 0:
+            nextEndSec = min([endSec for _, endSec in runningJobs])
+            time.sleep(max(0, min(MESSAGE_STEP_SEC, nextEndSec - time.monotonic())))
+            nowSec = time.monotonic()
+            stillRunningJobs = []
+            ## jobs finished by this step are sent together
+            finishedJobs: List[Tuple[QueueJobResult, Optional[Exception]]] = []
+            for jobResult, endSec in runningJobs:
+                try:
+                    checkBatchJobBudget(jobResult)
+                except Exception as e:
+                    finishedJobs.append((jobResult, e))
+                    continue
+                if nowSec < endSec:
+                    stillRunningJobs.append((jobResult, endSec))
+                    continue
+                jobResult["data"] = f"message job finished ({U.epochMs()})"
+                finishedJobs.append((jobResult, None))
+            finishBatchJobs(finishedJobs)
+            runningJobs = stillRunningJobs
+    except Exception as e:
+        U.throwPrefix(prefix, e)
+
+
+def pdf2imageOutDirOf(jobId: str) -> str:
+    return f"{PDF2IMAGE_OUT_DIR}/{jobId}"
+
+
+def pdf2imagePageNameOf(pageIdx: int) -> str:
+    return f"image-{pageIdx:0>2}.png"
+
+
+def pdf2imagePreviewNameOf(pageIdx: int) -> str:
+    return f"preview-{pageIdx:0>2}.png"
+
+
+def parsePageRanges(spec: str) -> List[Tuple[int, int]]:
+    """
+    Parse pages of a pdf2image job, e.g. "1-3,5" -> [(1, 3), (5, 5)], "" -> [] (all pages)
+
+    Returns:
+        sorted and merged ranges of page numbers (starts from 1), raises if the spec is invalid
+    """
+    ranges: List[Tuple[int, int]] = []
+    for part in spec.replace(" ", "").split(","):
+        if part == "":
+            continue
+        first, last = part.split("-", 1) if "-" in part else (part, part)
+        first, last = int(first), int(last)
+        if first < 1 or last < first:
+            raise ValueError(f"invalid page range={part}")
+        ranges.append((first, last))
+    merged: List[Tuple[int, int]] = []
+    for first, last in sorted(ranges):
+        if len(merged) > 0 and first <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], last))
+        else:
+            merged.append((first, last))
+    return merged
+
+
+def pdf2imagePageIdxsOf(jobData: QueueJobPdf2Image) -> Iterator[int]:
+    """
+    Page indexes (starts from 0) a pdf2image job renders in page order
+
+    NOTE: the page count is not known here, i.e. it is endless for all pages, stop at the page count
+    """
+    ranges = parsePageRanges(jobData.get("pages", ""))
+    if len(ranges) == 0:
+        return itertools.count()
+    return itertools.chain.from_iterable(range(first - 1, last) for first, last in ranges)
+
+
+def pdf2imagePreviewIdxsOf(jobData: QueueJobPdf2Image) -> Iterator[int]:
+    """
+    Page indexes of the preview of a progressive pdf2image job, i.e. the first previewPages of pdf2imagePageIdxsOf()
+    """
+    if "previewDpi" not in jobData:
+        return iter([])
+    pageIdxs = pdf2imagePageIdxsOf(jobData)
+    if "previewPages" in jobData:
+        return itertools.islice(pageIdxs, jobData["previewPages"])
+    return pageIdxs
+
+
+def renderChunk_(
+    executor: concurrent.futures.ThreadPoolExecutor,
+    pdfPath: str,
+    firstPage: int,
+    lastPage: int,
+    threadCount: int,
+    renderOpts: Dict[str, Any],
+) -> List[Any]:
+    """
+    Render pages firstPage..lastPage (1-based) of a pdf by threadCount renderer subprocesses (pdftoppm), each renders
+    a contiguous sub-range of the pages
+
+    NOTE:
+    - Each sub-range is rendered by its own pdf2image call in a thread of the executor (of the job), thus each renderer
+      has the budget left as its timeout and is killed by pdf2image once it expires, i.e. the whole chunk is killed,
+      not only one renderer (pdf2image waits for its renderers one after another, a timeout kills one and leaves
+      the others running)
+    - It returns after all renderers exited, i.e. the threads of the chunk are given back to the render budget
+      only when no renderer of the chunk is running
+    """
+    import pdf2image
+    from pdf2image.exceptions import PDFPopplerTimeoutError
+
+    timeoutSec = jobBudgetSecLeft()
+    renderRange = lambda pageRange: pdf2image.convert_from_path(
+        pdfPath, first_page=pageRange[0], last_page=pageRange[1], thread_count=1, timeout=timeoutSec, **renderOpts
+    )
+    ## contiguous sub-ranges of (almost) the same no. of pages, e.g. 10 pages by 4 renderers: 3, 3, 2, 2
+    nPages = lastPage - firstPage + 1
+    nRenderers = max(1, min(threadCount, nPages))
+    pageRanges: List[Tuple[int, int]] = []
+    rangeFirst = firstPage
+    for i in range(nRenderers):
+        rangePages = nPages // nRenderers + (1 if i < nPages % nRenderers else 0)
+        pageRanges.append((rangeFirst, rangeFirst + rangePages - 1))
+        rangeFirst += rangePages
+    try:
+        if len(pageRanges) == 1:
+            return renderRange(pageRanges[0])
+        futures = [executor.submit(renderRange, pageRange) for pageRange in pageRanges]
+        ## NOTE: wait for all renderers, result() raises the error of a failed sub-range
+        concurrent.futures.wait(futures)
+        return [image for future in futures for image in future.result()]
+    except PDFPopplerTimeoutError:
+        raise U.SWErr(U.SWErrCode.E_Timeout, f"renderer killed, job exceeded its budget of {runningJob_.budgetMs}ms")
+
+
+def renderPages_(
+    pdfPath: str, pageIdxs: List[int], outDir: str, nameOf: Callable[[int], str], renderOpts: Dict[str, Any]
+):
+    """
+    Render pages of a pdf to {outDir}/{nameOf(pageIdx)}
+
+    NOTE:
+    - Pages are rendered in chunks (runs of consecutive pages split over the renderer threads, refer to renderChunk_).
+      Pages per renderer double each chunk up to PDF2IMAGE_MAX_PAGES_PER_RENDERER, i.e. the first pages appear
+      early and a large pdf is not parsed again for every page
+    - A page file appears atomically (renamed from a temp file), i.e. readers never see a partial page
+    - The budget of the job is checked before each chunk, renderers running past the budget are killed
+    """
+    renderBudget = renderBudget_
+    maxThreads = renderBudget.threadsPerJob if renderBudget is not None else RenderBudget.DEFAULT_THREADS_PER_JOB
+    pagesPerRenderer = 1
+    chunkStart = 0
+    ## NOTE: one executor (renderer threads) per job, not per chunk
+    with concurrent.futures.ThreadPoolExecutor(max_workers=maxThreads) as executor:
+        while chunkStart < len(pageIdxs):
+            checkJobBudget()
+            ## thread_count is no. of pdftoppm subprocesses, granted by the render budget according to the load
+            threadCount = renderBudget.acquire() if renderBudget is not None else maxThreads
+            try:
+                chunkEnd = chunkStart + 1
+                while (
+                    chunkEnd < len(pageIdxs)
+                    and chunkEnd - chunkStart < threadCount * pagesPerRenderer
+                    and pageIdxs[chunkEnd] == pageIdxs[chunkEnd - 1] + 1
+                ):
+                    chunkEnd += 1
+                pages = renderChunk_(
+                    executor, pdfPath, pageIdxs[chunkStart] + 1, pageIdxs[chunkEnd - 1] + 1, threadCount, renderOpts
+                )
+            finally:
+                if renderBudget is not None:
+                    renderBudget.release(threadCount)
+
+            for pageIdx, page in zip(pageIdxs[chunkStart:chunkEnd], pages):
+                pagePath = f"{outDir}/{nameOf(pageIdx)}"
+                page.save(f"{pagePath}.tmp", format="PNG")
+                os.replace(f"{pagePath}.tmp", pagePath)
+            chunkStart = chunkEnd
+            pagesPerRenderer = min(PDF2IMAGE_MAX_PAGES_PER_RENDERER, pagesPerRenderer * 2)
+
+
+@jobHandler(QueueJobType.PDF2IMAGE)
+def onJobPdf2image(jobResult: QueueJobResult, jobId: str, jobData: QueueJobPdf2Image):
+    """
+    Convert pdf to images, i.e. ./out/pdf2image/{jobId}/image-{page}.png
+
+    NOTE:
+    - Only the pages of jobData["pages"] are rendered, a page file is named by its page in the pdf
+    - dpi, size (thumbnail) and grayscale are passed to the renderer (pdftoppm), i.e. a preview costs a fraction of a full render
+    - Progressive (previewDpi): pages are rendered at previewDpi to preview-{page}.png first, the stage "preview"
+      is emitted, then pages are rendered at full quality
+    - Pages appear while the job is running (refer to renderPages_ and api/pageStream.py)
+    """
+    funcName = onJobPdf2image.__name__
+    prefix = f"{funcName}[{jobId}]"
+    try:
+        ## NOTE: pdf2image is imported on first use, i.e. not on server startup
+        import pdf2image
+
+        pdfPath = jobData["pdfFilePath"]
+        ## NOTE: page count probed on submit (refer to PdfInfoCache), probed here only if unknown (e.g. /pdf2image)
+        if "pdfPages" in jobData:
+            nPages = jobData["pdfPages"]
+        else:
+            nPages = int(pdf2image.pdfinfo_from_path(pdfPath, timeout=jobBudgetSecLeft())["Pages"])
+        pageIdxs = list(itertools.takewhile(lambda pageIdx: pageIdx < nPages, pdf2imagePageIdxsOf(jobData)))
+        basedDir = pdf2imageOutDirOf(jobId)
+        os.makedirs(basedDir)
+
+        renderOpts = {
+            "dpi": jobData.get("dpi", PDF2IMAGE_DEFAULT_DPI),
+            "size": jobData.get("size"),
+            "grayscale": jobData.get("grayscale", False),
+        }
+        if "previewDpi" in jobData:
+            previewIdxs = list(itertools.takewhile(lambda pageIdx: pageIdx < nPages, pdf2imagePreviewIdxsOf(jobData)))
+            ## NOTE: the preview is sized by previewDpi only, size applies to the full quality pages
+            previewOpts = {**renderOpts, "dpi": jobData["previewDpi"], "size": None}
+            renderPages_(pdfPath, previewIdxs, basedDir, pdf2imagePreviewNameOf, previewOpts)
+            jobResult["data"] = (
+                f"job[{jobData['tag']}] preview ({U.epochMs()}), nPages={nPages}, previewPages={len(previewIdxs)}"
+            )
+            emitJobStage(jobResult, PDF2IMAGE_STAGE_PREVIEW)
+
+        renderPages_(pdfPath, pageIdxs, basedDir, pdf2imagePageNameOf, renderOpts)
+        jobResult["data"] = (
+            f"job[{jobData['tag']}] finished ({U.epochMs()}), nPages={nPages}, renderedPages={len(pageIdxs)}"
+        )
+    except Exception as e:
+        U.throwPrefix(prefix, e)
@@ -0,0 +1,195 @@
+import os
+import json
+import sqlite3
+import threading
+import asyncio
+from typing import Final, List, Dict, Any, Optional, Tuple, TypedDict
+
+import util as U
+from .types import QueueJob, QueueJobResult, QueueJobErrCode
+
+
+class JournalEntry(TypedDict):
+    id: str
+    createEpms: int
+    jobType: str
+    jobData: Dict[str, Any]
+    ## executor name, refer to FastApiServer.executors
+    executor: str
+    ## SingleFlight key and client idempotency key, so that a retry after restart joins the replayed job
+    flightKey: str
+    idempotencyKey: str
+
+
+class JournalStats(TypedDict):
+    pendingRecords: int
+    committedBatches: int
+    committedRecords: int
+    maxBatchSize: int
+
+
+class JobJournal:
+    """
+    Write-ahead journal of accepted jobs, jobs accepted but not completed are replayed on startup
+
+    NOTE:
+    - Journal is a SQLite db in WAL mode, a row is inserted when a job is accepted and deleted when it completes
+    - Group commit: accepted()/completed() only append to an in-memory batch (no disk I/O on the request path),
+      a writer thread commits the batch in one transaction every FLUSH_INTERVAL_MS or when FLUSH_MAX_BATCH is reached
+    - A job accepted within the last flush interval before a crash may be lost, i.e. durability is delayed by
+      at most FLUSH_INTERVAL_MS
+    - Replay is at-least-once, i.e. a job that completed right before a crash may run again
+    """
+
+    FLUSH_INTERVAL_MS: Final[int] = 5
+    FLUSH_MAX_BATCH: Final[int] = 256
+
+    ## limit the instance variable
+    ## Why? avoid bugs some methods created wrong instance variable
+    __slots__ = (
+        "dbPath_",
+        "conn_",
+        "batch_",
+        "batchCond_",
+        "writerThread_",
+        "isRequestedToStop_",
+        "stats_",
+    )
+
+    def __init__(self, dbPath: str):
+        funcName = f"{JobJournal.__name__}.ctor"
+        prefix = funcName
+        try:
+            self.dbPath_ = dbPath
+            dbDir = os.path.dirname(dbPath)
+            if dbDir != "":
+                os.makedirs(dbDir, exist_ok=True)
+
+            ## NOTE: connection is used by the writer thread, and by the caller before the writer starts (pendingJobs)
+            self.conn_ = sqlite3.connect(dbPath, timeout=10, isolation_level=None, check_same_thread=False)
+            self.conn_.execute("PRAGMA journal_mode=WAL")
+            ## each commit is a batch, thus fsync of every commit is affordable
+            self.conn_.execute("PRAGMA synchronous=FULL")
+            self.conn_.execute(
+                "CREATE TABLE IF NOT EXISTS jobJournal (jobId TEXT PRIMARY KEY, acceptedEpms INTEGER, entry TEXT NOT NULL)"
+            )
+
+            ## ("accept", JournalEntry) or ("complete", jobId) in arrival order
+            self.batch_: List[Tuple[str, Any]] = []
+            self.batchCond_ = threading.Condition()
+            self.isRequestedToStop_ = False
+            self.stats_: JournalStats = {
+                "pendingRecords": 0,
+                "committedBatches": 0,
+                "committedRecords": 0,
+                "maxBatchSize": 0,
+            }
+            self.writerThread_ = threading.Thread(target=self.writerThreadWorker_, daemon=True)
+            self.writerThread_.start()
+        except Exception as e:
+            U.throwPrefix(prefix, e)
+
+    def pendingJobs(self) -> List[JournalEntry]:
+        """
+        Jobs accepted but not completed (e.g. before the last shutdown or crash), in accepted order
+        """
+        funcName = self.pendingJobs.__name__
+        prefix = funcName
+        try:
+            with self.batchCond_:
+                rows = self.conn_.execute("SELECT entry FROM jobJournal ORDER BY rowid").fetchall()
+            return [json.loads(row[0]) for row in rows]
+        except Exception as e:
+            U.throwPrefix(prefix, e)
+
+    def accepted(self, job: QueueJob, executor: str, flightKey: str = "", idempotencyKey: str = ""):
+        """
+        Journal an accepted job, it is marked completed automatically when its promise is done
+        """
+        entry: JournalEntry = {
+            "id": job["id"],
+            "createEpms": job["createEpms"],
+            "jobType": getattr(job["jobType"], "value", job["jobType"]),
+            "jobData": dict(job["jobData"]),
+            "executor": executor,
+            "flightKey": flightKey,
+            "idempotencyKey": idempotencyKey,
+        }
+        self.append_(("accept", entry))
+        job["promise"].add_done_callback(lambda promise: self.onJobDone_(job["id"], promise))
+
+    def completed(self, jobId: str):
+        self.append_(("complete", jobId))
+
+    def stats(self) -> JournalStats:
+        with self.batchCond_:
+            self.stats_["pendingRecords"] = len(self.batch_)
+            return dict(self.stats_)
+
+    def close(self):
+        """
+        Commit the pending batch and stop the writer thread
+        """
+        with self.batchCond_:
+            self.isRequestedToStop_ = True
+            self.batchCond_.notify()
+        self.writerThread_.join()
+
+    def onJobDone_(self, jobId: str, promise: asyncio.Future[QueueJobResult]):
+        ## Job aborted by shutdown is kept, i.e. replayed on restart
+        if not promise.cancelled() and promise.result()["errCode"] == QueueJobErrCode.SHUTDOWN:
+            return
+        ## NOTE: canceled means all clients gave up waiting, the job is not replayed either
+        self.completed(jobId)
+
+    def append_(self, record: Tuple[str, Any]):
+        with self.batchCond_:
+            self.batch_.append(record)
+            ## wake up the writer on the first record (starts the flush interval) and on a full batch
+            if len(self.batch_) == 1 or len(self.batch_) >= self.FLUSH_MAX_BATCH:
+                self.batchCond_.notify()
+
+    def writerThreadWorker_(self):
+        funcName = self.writerThreadWorker_.__name__
+        prefix = f"journal[{self.dbPath_}][{funcName}]"
+        U.logD(f"{prefix} running...")
+        while True:
+            try:
+                with self.batchCond_:
+                    ## idle until the first record, then wait a flush interval to group more records into the batch
+                    while len(self.batch_) == 0 and not self.isRequestedToStop_:
+                        self.batchCond_.wait()
+                    if len(self.batch_) < self.FLUSH_MAX_BATCH and not self.isRequestedToStop_:
+                        self.batchCond_.wait(self.FLUSH_INTERVAL_MS / 1000)
+                    batch = self.batch_
+                    self.batch_ = []
+                    isRequestedToStop = self.isRequestedToStop_
+
+                if len(batch) > 0:
+                    self.commit_(batch)
+                if isRequestedToStop:
+                    U.logW(f"{prefix} stopped")
+                    break
+            except Exception as e:
+                U.logPrefixE(prefix, e)
+
+    def commit_(self, batch: List[Tuple[str, Any]]):
+        conn = self.conn_
+        conn.execute("BEGIN")
+        try:
+            for action, data in batch:
+                if action == "accept":
+                    conn.execute(
+                        "INSERT OR REPLACE INTO jobJournal (jobId, acceptedEpms, entry) VALUES (?, ?, ?)",
+                        (data["id"], U.epochMs(), json.dumps(data)),
+                    )
+                else:
+                    conn.execute("DELETE FROM jobJournal WHERE jobId=?", (data,))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        with self.batchCond_:
+            self.stats_["committedBatches"] += 1
+            self.stats_["committedRecords"] += len(batch)
+            self.stats_["maxBatchSize"] = max(self.stats_["maxBatchSize"], len(batch))
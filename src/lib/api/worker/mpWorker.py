@@ -2,14 +2,34 @@ import time
 import os
 import asyncio
 import queue
+import signal
 import threading
 import multiprocessing
 from multiprocessing import Process, Manager
-from typing import Final, Union, Callable, TypeVar, List, TypedDict, Dict, Any, Optional, Literal, NotRequired, Tuple
-import pdf2image
+from typing import (
+    Final,
+    Union,
+    Callable,
+    TypeVar,
+    List,
+    TypedDict,
+    Dict,
+    Set,
+    Any,
+    Optional,
+    Literal,
+    NotRequired,
+    Tuple,
+)
 
 import util as U
-from .types import MpQueueJob, QueueJob, QueueEventType, QueueJobPdf2Image, QueueJobResult, QueueJobType, QueueJobEvent
+from .types import MpQueueJob, QueueJob, QueueEventType, QueueJobResult, QueueJobType, QueueJobEvent, QueueJobErrCode
+from .renderBudget import RenderBudget
+from .jobHandlers import runJob, newJobResult, setRenderBudget, setJobBudgets, jobBudgets, jobBudgetMsOf
+from .admission import ServiceTimeEstimator, jobPagesOf
+from .queueBackend import QueueBackend, InMemoryQueueBackend
+from .scheduler import CostQueue, newJobQueue, SCHEDULING_AGING_MS
+from .pipeTransport import PipeHub
 
 
 class MPQueueJobResult(TypedDict):
@@ -22,6 +42,56 @@ class MPQueueJobResult(TypedDict):
     totalElapsedMs: int
 
 
+## Max bytes of a job id in shared memory (uuid: 36)
+JOB_ID_BYTES: Final[int] = 64
+
+
+class AbortedJobIds:
+    """
+    Ids of the recent jobs nobody waits for anymore (e.g. the request timed out), shared by a manager and its
+    worker processes, i.e. a worker process aborts such a job (refer to checkJobBudget) or skips it if not started
+
+    NOTE: a ring of MAX_IDS ids in shared memory, an id is forgotten after MAX_IDS newer ones
+    """
+
+    MAX_IDS: Final[int] = 64
+
+    ## limit the instance variable
+    ## Why? avoid bugs some methods created wrong instance variable
+    __slots__ = ("lock_", "ids_", "next_")
+
+    def __init__(self):
+        self.lock_ = multiprocessing.Lock()
+        self.ids_ = multiprocessing.RawArray("c", self.MAX_IDS * JOB_ID_BYTES)
+        self.next_ = multiprocessing.RawValue("i", 0)
+
+    def add(self, jobId: str):
+        with self.lock_:
+            offset = self.next_.value * JOB_ID_BYTES
+            self.ids_[offset : offset + JOB_ID_BYTES] = jobId.encode()[:JOB_ID_BYTES].ljust(JOB_ID_BYTES, b"\0")
+            self.next_.value = (self.next_.value + 1) % self.MAX_IDS
+
+    def contains(self, jobId: str) -> bool:
+        key = jobId.encode()[:JOB_ID_BYTES].ljust(JOB_ID_BYTES, b"\0")
+        with self.lock_:
+            ids = self.ids_.raw
+        return any([ids[i : i + JOB_ID_BYTES] == key for i in range(0, len(ids), JOB_ID_BYTES)])
+
+
+def killRendererGroup(pid: int):
+    """
+    Kill the process group led by a worker process, i.e. the worker and its renderer subprocesses (pdftoppm)
+
+    NOTE: a worker process leads its own process group (refer to MultiProcessWorker.mpWorker), no-op if none
+    """
+    if not hasattr(os, "killpg"):
+        return
+    try:
+        os.killpg(pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
 class MultiProcessManager:
     JOB_QUEUE_MAX_SIZE = 10
     RESULT_QUEUE_MAX_SIZE = 10
@@ -36,23 +106,126 @@ class MultiProcessManager:
         "processes_",
         "resultPromises_",
         "resultPromisesLock_",
+        "serviceTimes_",
+        "resultJobTypes_",
+        "resultJobPages_",
+        "stageReceivers_",
+        "replyTo_",
+        "stopEvent_",
+        "renderBudget_",
+        "workerCpus_",
+        "workerPinning_",
+        "processesLock_",
+        "scheduleQueue_",
+        "dispatchCond_",
+        "dispatchedIds_",
+        "dispatchThread_",
+        "processCpus_",
+        "monitorThread_",
+        "abortedJobIds_",
+        "runningJobIds_",
     )
 
-    def __init__(self, name: str, jobQueueMaxSize=JOB_QUEUE_MAX_SIZE, resultQueueMaxsize=RESULT_QUEUE_MAX_SIZE):
+    ## interval of checking worker processes, a process exited while the pool is running is respawned
+    MONITOR_INTERVAL_SEC: Final[float] = 1
+
+    @classmethod
+    def workerCpusOf(cls, workerCpus: List[int], workerPinning: str, workerIdx: int) -> List[int]:
+        """
+        CPU affinity of the workerIdx-th worker of a pool
+
+        Args:
+            workerPinning: "core" (one cpu per worker, round robin) or "set" (all of workerCpus)
+
+        Returns:
+            cpus, empty means not pinned
+        """
+        if len(workerCpus) == 0 or workerPinning == "set":
+            return list(workerCpus)
+        return [workerCpus[workerIdx % len(workerCpus)]]
+
+    def __init__(
+        self,
+        name: str,
+        jobQueueMaxSize=JOB_QUEUE_MAX_SIZE,
+        resultQueueMaxsize=RESULT_QUEUE_MAX_SIZE,
+        serviceTimes: Optional[ServiceTimeEstimator] = None,
+        jobQueue: Optional[QueueBackend] = None,
+        resultQueue: Optional[QueueBackend] = None,
+        renderBudget: Optional[RenderBudget] = None,
+        workerCpus: Optional[List[int]] = None,
+        workerPinning: str = "core",
+        scheduling: str = "fifo",
+        schedulingAgingMs: int = SCHEDULING_AGING_MS,
+        transport: str = "queue",
+    ):
+        """
+        Args:
+            jobQueue/resultQueue: queue backend (default: in-memory multiprocessing.Queue)
+                If the backend is shared (e.g. SqliteQueueBackend), jobs may be processed by workers of other nodes,
+                and results are sent back to resultQueue of this manager
+            renderBudget: budget of renderer subprocesses shared by all worker processes (and this process)
+            workerCpus/workerPinning: CPU affinity of the worker processes (renderer subprocesses inherit it),
+                refer to workerCpusOf(). Not pinned if empty
+            scheduling: "fifo" or "sjf" (shortest expected job first, refer to CostQueue)
+                With "sjf", jobs wait in a CostQueue of this manager and are dispatched to the job queue
+                only when a worker is free, i.e. the job queue holds no backlog to be served in FIFO order
+                NOTE: with a shared backend, jobs of this node are ordered, the shared queue stays FIFO
+            transport: IPC of the in-memory backend (jobQueue/resultQueue not specified)
+                - "queue": multiprocessing.Queue shared by all workers
+                - "pipe": one duplex pipe per worker multiplexed by a selector, compact encoding (refer to PipeHub)
+        """
         funcName = f"{MultiProcessManager.__name__}.ctor"
         prefix = funcName
         try:
             self.name = name
 
             ## NOTE: All processes shared the single job queue and result queue
-            self.jobQueue_: multiprocessing.Queue[MpQueueJob] = multiprocessing.Queue(maxsize=jobQueueMaxSize)
-            self.resultQueue_: multiprocessing.Queue[Tuple[str, QueueJobResult]] = multiprocessing.Queue(
-                maxsize=resultQueueMaxsize
-            )
+            ## (pipe transport: the hub is both, each process has its own pipe, refer to PipeHub)
+            if transport == "pipe":
+                if jobQueue is not None or resultQueue is not None:
+                    raise Exception(f"transport={transport} is for the in-memory backend only")
+                ## NOTE: the hub sends a job only to a free worker, thus it orders its own queue (no dispatch thread)
+                self.jobQueue_: QueueBackend = PipeHub(newJobQueue(scheduling, jobQueueMaxSize, schedulingAgingMs))
+                self.resultQueue_: QueueBackend = self.jobQueue_
+                scheduling = "fifo"
+            elif transport == "queue":
+                self.jobQueue_ = jobQueue if jobQueue is not None else InMemoryQueueBackend(jobQueueMaxSize)
+                self.resultQueue_ = resultQueue if resultQueue is not None else InMemoryQueueBackend(resultQueueMaxsize)
+            else:
+                raise Exception(f"invalid transport={transport}")
+
+            ## Workers of a shared backend reply to the result queue of this manager
+            self.replyTo_ = getattr(self.resultQueue_, "queueName_", "") if self.resultQueue_.isShared() else ""
 
             ## Single thread worker to process result from all processes
             self.resultPromises_: Dict[str, asyncio.Future["QueueJobResult"]] = {}
             self.resultPromisesLock_ = threading.Lock()
+            self.serviceTimes_ = serviceTimes
+            self.resultJobTypes_: Dict[str, QueueJobType] = {}
+            self.resultJobPages_: Dict[str, int] = {}
+            ## jobId -> onStage of jobs taking stage results
+            self.stageReceivers_: Dict[str, Callable[[QueueJobResult], None]] = {}
+
+            ## Set to request all processes to stop after their running job (graceful stop)
+            self.stopEvent_ = multiprocessing.Event()
+            self.renderBudget_ = renderBudget
+            self.workerCpus_: List[int] = workerCpus if workerCpus is not None else []
+            self.workerPinning_ = workerPinning
+            self.processesLock_ = threading.Lock()
+
+            ## Jobs waiting for a free worker ("sjf" only), ids of the jobs dispatched to the job queue and not yet done
+            self.scheduleQueue_: Optional[CostQueue] = None
+            self.dispatchCond_ = threading.Condition()
+            self.dispatchedIds_: Set[str] = set()
+            self.dispatchThread_: Optional[threading.Thread] = None
+            if scheduling == "sjf":
+                self.scheduleQueue_ = CostQueue(jobQueueMaxSize, schedulingAgingMs)
+                self.dispatchThread_ = threading.Thread(target=self.dispatchThreadWorker_, daemon=True)
+                self.dispatchThread_.start()
+            elif scheduling != "fifo":
+                raise Exception(f"invalid scheduling={scheduling}")
+
             self.resultThread_: threading.Thread = threading.Thread(target=self.resultQueueThreadWorker_)
 
             ## Important note:
@@ -66,6 +239,16 @@ class MultiProcessManager:
                 process: Process
 
             self.processes_: Dict[str, Process] = {}
+            self.processCpus_: Dict[str, List[int]] = {}
+
+            ## Jobs aborted by this process (promise done before the result), and the job running in each worker
+            ## (shared memory, refer to MultiProcessWorker)
+            self.abortedJobIds_ = AbortedJobIds()
+            self.runningJobIds_: Dict[str, Any] = {}
+
+            ## Respawn worker processes that exit (e.g. killed by their watchdog, refer to MultiProcessWorker)
+            self.monitorThread_ = threading.Thread(target=self.monitorThreadWorker_, daemon=True)
+            self.monitorThread_.start()
 
         except Exception as e:
             U.throwPrefix(prefix, e)
@@ -76,6 +259,33 @@ class MultiProcessManager:
     def resultQueue(self):
         return self.resultQueue_
 
+    def pendingJobCount(self) -> int:
+        """
+        No. of jobs queued or running (i.e. result not yet received)
+        NOTE: For shared backend, jobs queued by other nodes are counted too
+        """
+        with self.resultPromisesLock_:
+            localPendingJobs = sum([1 if not p.done() else 0 for p in self.resultPromises_.values()])
+        return max(localPendingJobs, self.jobQueue_.qsize())
+
+    def pendingPageCount(self) -> int:
+        """
+        Pages of the jobs queued or running (refer to jobPagesOf)
+        NOTE: For shared backend, jobs queued by other nodes are counted as 1 page each
+        """
+        with self.resultPromisesLock_:
+            localPendingPages = sum(
+                [self.resultJobPages_.get(k, 1) for k, p in self.resultPromises_.items() if not p.done()]
+            )
+        return max(localPendingPages, self.jobQueue_.qsize())
+
+    def activeWorkerCount(self) -> int:
+        ## For shared backend, workers may run in other processes/nodes (reported by heartbeat)
+        sharedWorkerCount = self.jobQueue_.activeWorkerCount()
+        if sharedWorkerCount is not None:
+            return sharedWorkerCount
+        return sum([1 if p.is_alive() else 0 for p in self.processes_.values()])
+
     def enqueue(self, job: QueueJob):
         funcName = self.enqueue.__name__
         prefix = f"{funcName}[{job['id']}]"
@@ -95,10 +305,25 @@ class MultiProcessManager:
                     "jobType": job["jobType"],
                     "promise": job["id"],
                 }
-                self.jobQueue_.put(mpJob, block=False)
+                if self.replyTo_ != "":
+                    mpJob["replyTo"] = self.replyTo_
+                if "onStage" in job:
+                    mpJob["isStaged"] = True
+                if "pages" in job:
+                    mpJob["pages"] = job["pages"]
+                if self.scheduleQueue_ is not None:
+                    self.scheduleQueue_.put(mpJob, block=False)
+                else:
+                    self.jobQueue_.put(mpJob, block=False)
 
                 ## Keep the result promise
                 self.resultPromises_[jobId] = job["promise"]
+                self.resultJobTypes_[jobId] = job["jobType"]
+                self.resultJobPages_[jobId] = jobPagesOf(job)
+                if "onStage" in job:
+                    self.stageReceivers_[jobId] = job["onStage"]
+                ## NOTE: the job is aborted if its promise is done by others (e.g. request timeout, hedge loser)
+                job["promise"].add_done_callback(lambda _, jobId=jobId: self.onJobDone_(jobId))
 
                 ## housekeeping: All done promises should be clear
                 promiseIdsToBeRemoved: List[str] = []
@@ -108,8 +333,14 @@ class MultiProcessManager:
                 if len(promiseIdsToBeRemoved) > 0:
                     for promiseId in promiseIdsToBeRemoved:
                         del self.resultPromises_[promiseId]
+                        self.resultJobTypes_.pop(promiseId, None)
+                        self.resultJobPages_.pop(promiseId, None)
+                        self.stageReceivers_.pop(promiseId, None)
                         U.logD(f"resultPromises[{promiseId}] removed")
 
+        except queue.Full:
+            ## NOTE: re-raise as it is, caller responds 503 for full queue
+            raise
         except Exception as e:
             U.throwPrefix(prefix, e)
 
@@ -122,65 +353,220 @@ class MultiProcessManager:
                 promiseId, result = self.resultQueue_.get()
                 U.logD(f"{prefix} promiseId={promiseId}, result={result}")
 
+                ## result of a stage, the job goes on
+                if result.get("stage", "") != "":
+                    with self.resultPromisesLock_:
+                        promise = self.resultPromises_.get(promiseId)
+                        onStage = self.stageReceivers_.get(promiseId)
+                    if promise is not None and onStage is not None and not promise.done():
+                        promise.get_loop().call_soon_threadsafe(onStage, result)
+                    continue
+
+                ## the worker is free, whether or not somebody waits for the result
+                if self.scheduleQueue_ is not None:
+                    with self.dispatchCond_:
+                        self.dispatchedIds_.discard(promiseId)
+                        self.dispatchCond_.notify()
+
                 with self.resultPromisesLock_:
                     if not (promiseId in self.resultPromises_):
-                        raise Exception(f"promiseId not found in resultPromises")
+                        ## NOTE: e.g. the promise is done and removed already (request timed out, aborted job)
+                        U.logD(f"{prefix} promiseId={promiseId} not found in resultPromises, result dropped")
+                        continue
                     promise = self.resultPromises_[promiseId]
-                    if not promise.done():
-                        self.resultPromises_[promiseId].set_result(result)
-                    else:
-                        U.logD(f"{prefix} job already done, promiseId={promiseId}")
+                    jobType = self.resultJobTypes_.pop(promiseId, None)
+                    jobPages = self.resultJobPages_.pop(promiseId, 1)
+                    self.stageReceivers_.pop(promiseId, None)
                     del self.resultPromises_[promiseId]
 
+                ## record service time for admission control
+                if self.serviceTimes_ is not None and jobType is not None and result["errCode"] == "":
+                    self.serviceTimes_.record(jobType, result["processElapsedMs"], jobPages)
+
+                ## NOTE: asyncio.Future is NOT thread safe, the result must be set in the event loop thread
+                promise.get_loop().call_soon_threadsafe(self.setPromiseResult_, prefix, promiseId, promise, result)
+
             except KeyboardInterrupt as e:
                 U.logW(f"{prefix} KeyboardInterrupt")
                 break
             except Exception as e:
                 U.logPrefixE(prefix, e)
 
-    def startProcess(self, workerName: str):
+    def dispatchThreadWorker_(self):
+        """
+        Move the next job of the schedule queue (lowest cost first) to the job queue whenever a worker is free
+        """
+        funcName = self.dispatchThreadWorker_.__name__
+        prefix = f"MpMgr[{self.name}][{funcName}]"
+        U.logD(f"{prefix} running...")
+        while not self.stopEvent_.is_set():
+            try:
+                ## NOTE: short timeout, thus workers started later and stop request are noticed
+                with self.dispatchCond_:
+                    if len(self.dispatchedIds_) >= max(1, self.activeWorkerCount()):
+                        self.dispatchCond_.wait(timeout=1)
+                        continue
+                try:
+                    mpJob = self.scheduleQueue_.get(timeout=1)
+                except queue.Empty:
+                    continue
+                with self.dispatchCond_:
+                    self.dispatchedIds_.add(mpJob["promise"])
+                self.jobQueue_.put(mpJob)
+            except Exception as e:
+                U.logPrefixE(prefix, e)
+
+    def monitorThreadWorker_(self):
+        """
+        Respawn worker processes that failed (killed, crashed) while the pool is running, i.e. capacity is kept
+        """
+        funcName = self.monitorThreadWorker_.__name__
+        prefix = f"MpMgr[{self.name}][{funcName}]"
+        while not self.stopEvent_.wait(self.MONITOR_INTERVAL_SEC):
+            try:
+                with self.processesLock_:
+                    ## NOTE: exitcode 0 is a stop on request (e.g. STOP event), it is not respawned
+                    exitedProcesses = [(n, p) for n, p in self.processes_.items() if p.exitcode not in (None, 0)]
+                for workerName, workerProcess in exitedProcesses:
+                    if self.stopEvent_.is_set():
+                        break
+                    U.logW(f"{prefix} process[{workerName}] exited, exitcode={workerProcess.exitcode}, respawning...")
+                    self.reclaimProcess_(workerName, workerProcess)
+                    with self.processesLock_:
+                        del self.processes_[workerName]
+                    self.startProcess(workerName, self.processCpus_.get(workerName))
+            except Exception as e:
+                U.logPrefixE(prefix, e)
+
+    def reclaimProcess_(self, workerName: str, workerProcess: Process):
+        """
+        Reclaim what a worker process held when it exited (e.g. killed, crashed)
+        - its renderer subprocesses (its process group) are killed, its render budget threads are given back
+        - its running job resolves with an error (no result is sent by a crashed worker)
+        - jobs dispatched and done meanwhile no longer count as dispatched ("sjf")
+        """
+        funcName = self.reclaimProcess_.__name__
+        prefix = f"MpMgr[{self.name}][{funcName}][{workerName}]"
+        killRendererGroup(workerProcess.pid)
+        if self.renderBudget_ is not None:
+            threads = self.renderBudget_.reclaim(workerProcess.pid)
+            if threads > 0:
+                U.logW(f"{prefix} {threads} render threads reclaimed")
+
+        runningJobId = self.runningJobIds_.get(workerName)
+        promiseId = runningJobId.value.decode() if runningJobId is not None else ""
+        ## NOTE: PipeHub fails the running job of an exited worker itself (refer to PipeHub.removeConn_),
+        ## it reads runningJobId when the pipe is closed, i.e. it is not cleared here
+        if promiseId != "" and not isinstance(self.resultQueue_, PipeHub):
+            runningJobId.value = b""
+            U.logW(f"{prefix} job[{promiseId}] was running, it fails")
+            result = newJobResult(workerName)
+            result["errCode"] = QueueJobErrCode.ERR
+            result["err"] = "worker exited while running the job"
+            ## NOTE: resolved by the result thread like any result, i.e. the same bookkeeping
+            ## a job of another node is not ours to fail
+            with self.resultPromisesLock_:
+                isOwnJob = promiseId in self.resultPromises_
+            if isOwnJob:
+                self.resultQueue_.put((promiseId, result))
+
+        if self.scheduleQueue_ is not None:
+            with self.resultPromisesLock_:
+                pendingIds = set([k for k, p in self.resultPromises_.items() if not p.done()])
+            with self.dispatchCond_:
+                self.dispatchedIds_ = set([i for i in self.dispatchedIds_ if i in pendingIds and i != promiseId])
+                self.dispatchCond_.notify()
+
+    def onJobDone_(self, jobId: str):
+        ## NOTE: a result removes the promise first, i.e. a promise still kept is done by others (cancelled)
+        with self.resultPromisesLock_:
+            isAborted = jobId in self.resultPromises_
+        if isAborted:
+            self.abortJob(jobId)
+
+    def abortJob(self, jobId: str):
+        """
+        Nobody waits for the result of the job anymore, the worker process aborts it at its next budget check
+        (refer to checkJobBudget) or skips it if not yet started
+        """
+        self.abortedJobIds_.add(jobId)
+
+    def setPromiseResult_(
+        self, prefix: str, promiseId: str, promise: asyncio.Future[QueueJobResult], result: QueueJobResult
+    ):
+        if not promise.done():
+            promise.set_result(result)
+        else:
+            U.logD(f"{prefix} job already done, promiseId={promiseId}")
+
+    def startProcess(self, workerName: str, cpus: Optional[List[int]] = None):
+        """
+        Args:
+            cpus: CPU affinity of the worker, default: refer to workerCpusOf(), i.e. by the order of started workers
+        """
         funcName = self.startProcess.__name__
         prefix = f"{funcName}[{workerName}]"
         try:
-            if workerName in self.processes_:
-                raise Exception(f"processes[{workerName}] already exist")
-
-            ## Important note: refer to class note
-            worker = MultiProcessWorker(self.name, workerName, self.jobQueue_, self.resultQueue_)
-            workerProcess = Process(target=worker.mpWorker, daemon=True)
-            self.processes_[workerName] = workerProcess
+            ## NOTE: processes may be started concurrently (pool threads)
+            with self.processesLock_:
+                if workerName in self.processes_:
+                    raise Exception(f"processes[{workerName}] already exist")
+                if cpus is None:
+                    cpus = MultiProcessManager.workerCpusOf(self.workerCpus_, self.workerPinning_, len(self.processes_))
+                self.processCpus_[workerName] = cpus
+
+                ## Important note: refer to class note
+                runningJobId = multiprocessing.RawArray("c", JOB_ID_BYTES)
+                self.runningJobIds_[workerName] = runningJobId
+                workerQueue = self.jobQueue_.workerEnd(workerName, runningJobId)
+                workerResultQueue = workerQueue if workerQueue is not self.jobQueue_ else self.resultQueue_
+                worker = MultiProcessWorker(
+                    self.name,
+                    workerName,
+                    workerQueue,
+                    workerResultQueue,
+                    self.stopEvent_,
+                    self.renderBudget_,
+                    cpus,
+                    self.abortedJobIds_,
+                    runningJobId,
+                )
+                workerProcess = Process(target=worker.mpWorker, daemon=True)
+                self.processes_[workerName] = workerProcess
             workerProcess.start()
+
+            ## the end of a worker's own pipe belongs to the worker process, i.e. EOF is seen once the worker exits
+            if workerQueue is not self.jobQueue_:
+                workerQueue.close()
         except Exception as e:
             U.throwPrefix(prefix, e)
 
-    async def stopAllProcesses(self):
+    async def stopAllProcesses(self, timeoutSec: float = 0):
+        """
+        Stop all processes gracefully, i.e. each process exits after its running job
+
+        Args:
+            timeoutSec: processes still running after timeoutSec are terminated (0: terminate immediately)
+        """
         funcName = self.stopAllProcesses.__name__
         prefix = funcName
         try:
-            # for idx in range(len(self.processes_)):
-            #     resultPromise: asyncio.Future[QueueJobResult] = asyncio.Future()
-            #     jobId = U.uuid()
-            #     job: QueueJob = {
-            #         "createEpms": U.epochMs(),
-            #         "id": jobId,
-            #         "jobType": QueueJobType.EVENT,
-            #         "jobData": {"tag": QueueJobType.EVENT, "action": QueueEventType.STOP},
-            #         "promise": resultPromise,
-            #     }
-
-            #     U.logW(f"{prefix} jwjwjw before enqueue, jobId={jobId}")
-            #     self.enqueue(job)
-
-            #     U.logW(f"{prefix} waiting worker to respond to stop request...")
-            #     await resultPromise
-            #     U.logW(f"{prefix} waiting worker done!")
+            U.logW(f"{prefix} stopping multi-process Workers, timeoutSec={timeoutSec}...")
+            self.stopEvent_.set()
+
+            ## NOTE: join() blocks, thus it runs in pool thread
+            deadlineSec = time.monotonic() + timeoutSec
+            for pName, p in self.processes_.items():
+                await asyncio.to_thread(p.join, max(0, deadlineSec - time.monotonic()))
 
             for pName, p in self.processes_.items():
                 if p.is_alive():
-                    U.logW(f"{prefix} stopping multi-process Worker[{pName}]...")
+                    U.logW(f"{prefix} multi-process Worker[{pName}] still running after {timeoutSec}s, terminating...")
                     p.terminate()
-            for _, p in self.processes_.items():
-                p.join()
+                    p.join()
+
+            ## jobs left in the queue are not processed (they are resolved by the caller, e.g. drain)
+            self.jobQueue_.close()
             U.logW(f"{prefix} all multi-process Workers stopped")
         except Exception as e:
             U.throwPrefix(prefix, e)
@@ -212,25 +598,69 @@ class MultiProcessWorker:
         "prefix_",
         "isRunningJob_",
         "isRequestToStop_",
+        "replyQueues_",
+        "stopEvent_",
+        "renderBudget_",
+        "cpus_",
+        "jobBudgetsMs_",
+        "watchdogLock_",
+        "runningPromiseId_",
+        "runningResultQueue_",
+        "runningKillEpms_",
+        "abortedJobIds_",
+        "runningJobId_",
     )
 
+    ## the watchdog kills the process when a job runs this long past its budget (cooperative abort failed)
+    JOB_KILL_GRACE_MS: Final[int] = 2000
+    WATCHDOG_INTERVAL_SEC: Final[float] = 0.5
+
     def __init__(
         self,
         mpMgrName: str,
         workerName: str,
-        jobQueue: multiprocessing.Queue,
-        resultQueue: multiprocessing.Queue,
+        jobQueue: QueueBackend,
+        resultQueue: QueueBackend,
+        stopEvent: Optional[Any] = None,
+        renderBudget: Optional[RenderBudget] = None,
+        cpus: Optional[List[int]] = None,
+        abortedJobIds: Optional[AbortedJobIds] = None,
+        runningJobId: Optional[Any] = None,
     ):
+        """
+        Args:
+            stopEvent: multiprocessing.Event, the worker exits after its running job once it is set
+            renderBudget: budget of renderer subprocesses, shared with other processes started with the same budget
+            cpus: CPU affinity of the worker process (renderer subprocesses inherit it), not pinned if empty
+            abortedJobIds: jobs aborted by the manager, a job is aborted at its next budget check (refer to checkJobBudget)
+            runningJobId: multiprocessing.RawArray("c") the id of the running job is kept in, e.g. the manager fails
+                the job if the worker crashes
+
+        NOTE: execution budgets of job types (refer to setJobBudgets) are taken from this process, i.e. the worker
+        process has them even if it is spawned
+        """
         funcName = f"{MultiProcessWorker.__name__}.ctor"
         prefix = funcName
         try:
             self.mpMgrName = mpMgrName
             self.workerName = workerName
             self.pid = os.getpid()
-            self.jobQueue_: multiprocessing.Queue[MpQueueJob] = jobQueue
-            self.resultQueue_: multiprocessing.Queue[Tuple[str, QueueJobResult]] = resultQueue
+            self.jobQueue_ = jobQueue
+            self.resultQueue_ = resultQueue
+            self.isRunningJob_ = False
             self.prefix_ = f"mp[{self.mpMgrName}][{workerName}]"
             self.isRequestToStop_ = False
+            self.replyQueues_: Dict[str, QueueBackend] = {}
+            self.stopEvent_ = stopEvent
+            self.renderBudget_ = renderBudget
+            self.cpus_: List[int] = cpus if cpus is not None else []
+            self.jobBudgetsMs_ = jobBudgets()
+            self.watchdogLock_ = threading.Lock()
+            self.runningPromiseId_ = ""
+            self.runningResultQueue_: Optional[QueueBackend] = None
+            self.runningKillEpms_ = 0
+            self.abortedJobIds_ = abortedJobIds
+            self.runningJobId_ = runningJobId
         except Exception as e:
             U.throwPrefix(prefix, e)
 
@@ -239,10 +669,23 @@ class MultiProcessWorker:
         prefix = f"{self.prefix_}[{os.getpid()}]"
         U.logD(f"{prefix} running...")
         lastAliveEpms = U.epochMs()
+        if self.renderBudget_ is not None:
+            setRenderBudget(self.renderBudget_)
+        setJobBudgets(self.jobBudgetsMs_)
+        ## own process group, renderer subprocesses are in it, i.e. they are killed with the worker (refer to killRendererGroup)
+        if hasattr(os, "setpgrp"):
+            os.setpgrp()
+        threading.Thread(target=self.watchdogThreadWorker_, daemon=True).start()
+        try:
+            if U.setCpuAffinity(self.cpus_):
+                U.logI(f"{prefix} pinned to cpus={self.cpus_}")
+        except Exception as e:
+            ## NOTE: not fatal, the worker runs unpinned
+            U.logPrefixE(prefix, e)
         while True:
             try:
                 ## requested to stop?
-                if self.isRequestToStop_:
+                if self.isRequestToStop_ or (self.stopEvent_ is not None and self.stopEvent_.is_set()):
                     U.logW(f"{prefix} requested to stop...")
                     break
 
@@ -253,9 +696,13 @@ class MultiProcessWorker:
                     U.logD(f"{prefix} alive...")
                     lastAliveEpms = nowEpms
 
+                ## report alive to shared queue backend (no-op for in-memory queue)
+                self.jobQueue_.heartbeat(self.workerName, False)
+
                 try:
                     ## Get the job item from the queue
-                    job = self.jobQueue_.get(timeout=5)
+                    ## NOTE: short timeout, thus stop request is noticed soon when the queue is empty
+                    job = self.jobQueue_.get(timeout=1)
                 except queue.Empty:
                     # U.logD(f"queue is empty")
 
@@ -268,88 +715,96 @@ class MultiProcessWorker:
             except KeyboardInterrupt as e:
                 U.logW(f"{prefix} KeyboardInterrupt")
                 break
+            except EOFError:
+                ## own pipe of the worker (refer to PipeHub) is closed, i.e. the manager is gone
+                U.logW(f"{prefix} job pipe closed")
+                break
             except Exception as e:
                 U.logPrefixE(prefix, e)
 
     def onQueueJob_(self, job: MpQueueJob):
         funcName = self.onQueueJob_.__name__
         prefix = f"{self.prefix_}.{funcName}.job[{job['id']}]"
-        result: QueueJobResult = {
-            "errCode": "",
-            "err": "",
-            "data": "",
-            "workerName": self.workerName,
-            "dequeueElapsedMs": 0,
-            "processElapsedMs": 0,
-            "totalElapsedMs": 0,
-        }
-        resultPromiseId = ""
         try:
             self.isRunningJob_ = True
             U.logW(f"{prefix} {job}")
 
             resultPromiseId = job["promise"]
+            if resultPromiseId == "":
+                raise Exception(f"resultPromiseId is empty")
 
-            ## calculate elapsed time for job dequeue
-            onDequeueEpms = U.epochMs()
-            result["dequeueElapsedMs"] = onDequeueEpms - job["createEpms"]
-
-            ## Process CPU intensive task
-            onProcessEpms = U.epochMs()
-            jobType = job["jobType"]
+            ## Result (and stage results) are put to the result queue (the thread worker)
+            ## NOTE: for shared backend, result is sent to the result queue of the node that submits the job
+            resultQueue = self.resultQueue_
+            if "replyTo" in job:
+                if job["replyTo"] not in self.replyQueues_:
+                    self.replyQueues_[job["replyTo"]] = self.resultQueue_.named(job["replyTo"])
+                resultQueue = self.replyQueues_[job["replyTo"]]
 
             ## queue event
-            if jobType == QueueJobType.EVENT and job["jobData"]["tag"] == QueueJobType.EVENT:
-                eventAction = job["jobData"]["action"]
-                if eventAction == QueueEventType.STOP:
+            if job["jobType"] == QueueJobType.EVENT and job["jobData"]["tag"] == QueueJobType.EVENT:
+                result = newJobResult(self.workerName)
+                if job["jobData"]["action"] == QueueEventType.STOP:
                     self.isRequestToStop_ = True
 
-            ## Convert pdf to image
-            elif jobType == QueueJobType.PDF2IMAGE and job["jobData"]["tag"] == QueueJobType.PDF2IMAGE:
-                self.onJobPdf2image(result, job, job["jobData"])
-
+            ## Process the job by the handler of its job type
             else:
-                raise Exception(f"invalid jobType")
-            onResultEpms = U.epochMs()
-
-            ## fill in the result
-            result["processElapsedMs"] = onResultEpms - onProcessEpms
-            result["totalElapsedMs"] = onResultEpms - job["createEpms"]
-
-        ## In case of exception, fill in err/errcode to the result
-        except Exception as e:
-            ## jwjwjw
-            U.logPrefixE(prefix, e)
-            if resultPromiseId is not None:
-                result["errCode"] = "err"
-                result["err"] = "error processing job request"
-
-        ## Regardless of exception, it needs to set_result() to notify the original job dispatcher
+                onStage = None
+                if job.get("isStaged", False):
+                    onStage = lambda stageResult: resultQueue.put((resultPromiseId, stageResult))
+                budgetMs = jobBudgetMsOf(job["jobType"])
+                with self.watchdogLock_:
+                    self.runningPromiseId_ = resultPromiseId
+                    self.runningResultQueue_ = resultQueue
+                    self.runningKillEpms_ = U.epochMs() + budgetMs + self.JOB_KILL_GRACE_MS if budgetMs > 0 else 0
+                if self.runningJobId_ is not None:
+                    self.runningJobId_.value = resultPromiseId.encode()[:JOB_ID_BYTES]
+                ## NOTE: a job aborted by the manager (nobody waits for it) aborts at its next budget check,
+                ## or right away if it is not yet started
+                isAborted = None
+                if self.abortedJobIds_ is not None:
+                    isAborted = lambda: self.abortedJobIds_.contains(resultPromiseId)
+                result = runJob(job, self.workerName, onStage, isAborted)
         finally:
-            try:
-                if resultPromiseId != "":
-                    ## Put the resultPromiseId and the result to result queue (the thread worker)
-                    self.resultQueue_.put((resultPromiseId, result))
-                else:
-                    raise Exception(f"resultPromiseId is empty")
-            except Exception as e2:
-                U.throwPrefix(prefix, f"failed setting result, err={e2}")
+            self.isRunningJob_ = False
+            ## NOTE: the watchdog holds the lock until the process exits, i.e. the result of a killed job is not sent twice
+            with self.watchdogLock_:
+                self.runningKillEpms_ = 0
+            if self.runningJobId_ is not None:
+                self.runningJobId_.value = b""
 
-            if result["errCode"] != "":
-                U.throwPrefix(prefix, result["err"])
-
-    def onJobPdf2image(self, jobResult: QueueJobResult, job: MpQueueJob, jobData: QueueJobPdf2Image):
-        funcName = self.onJobPdf2image.__name__
-        prefix = funcName
         try:
-            pdfPath = jobData["pdfFilePath"]
-            pages = pdf2image.convert_from_path(pdfPath, thread_count=4)
-            if pages is not None and len(pages) > 0:
-                basedDir = f"./out/pdf2image/{job['id']}"
-                os.makedirs(basedDir)
-                for idx, page in enumerate(pages):
-                    page.save(f"{basedDir}/image-{idx:0>2}.png")
-            jobResult["data"] = f"job[{jobData['tag']}] finished ({U.epochMs()}), nPages={len(pages)}"
+            ## Put the resultPromiseId and the result to result queue
+            resultQueue.put((resultPromiseId, result))
         except Exception as e:
-            U.logPrefixE(prefix, e)
-            U.throwPrefix(prefix, e)
+            U.throwPrefix(prefix, f"failed setting result, err={e}")
+
+    def watchdogThreadWorker_(self):
+        """
+        Kill this process if its job runs past its budget + JOB_KILL_GRACE_MS, i.e. the job did not abort itself
+        (refer to checkJobBudget), e.g. stuck in a call. The job resolves with a timeout error, the process is killed
+        with its renderer subprocesses, the manager respawns it (refer to MultiProcessManager.monitorThreadWorker_)
+        """
+        funcName = self.watchdogThreadWorker_.__name__
+        prefix = f"{self.prefix_}[{os.getpid()}].{funcName}"
+        while True:
+            time.sleep(self.WATCHDOG_INTERVAL_SEC)
+            with self.watchdogLock_:
+                if self.runningKillEpms_ == 0 or U.epochMs() < self.runningKillEpms_:
+                    continue
+                U.logW(f"{prefix} job[{self.runningPromiseId_}] exceeded its budget, killing the process...")
+                try:
+                    result = newJobResult(self.workerName)
+                    result["errCode"] = QueueJobErrCode.TIMEOUT
+                    result["err"] = "worker killed, job exceeded its budget"
+                    self.runningResultQueue_.put((self.runningPromiseId_, result))
+                    self.runningResultQueue_.flush()
+                    if self.runningJobId_ is not None:
+                        self.runningJobId_.value = b""
+                except Exception as e:
+                    U.logPrefixE(prefix, e)
+                ## NOTE: renderer subprocesses are killed with the process, render budget threads it holds are
+                ## reclaimed by the manager on respawn (refer to MultiProcessManager.reclaimProcess_)
+                if hasattr(os, "getpgrp") and os.getpgrp() == os.getpid():
+                    killRendererGroup(os.getpid())
+                os._exit(1)
@@ -3,18 +3,50 @@ import threading
 import time
 import queue
 import os
+import math
 from queue import Queue
 from enum import Enum
-from typing import Final, Union, Callable, TypeVar, List, TypedDict, Dict, Any, Optional, Literal, NotRequired, Tuple
-import pdf2image
+from typing import (
+    Final,
+    Union,
+    Callable,
+    TypeVar,
+    List,
+    TypedDict,
+    Dict,
+    Set,
+    Any,
+    Optional,
+    Literal,
+    NotRequired,
+    Tuple,
+)
 
 import util as U
-from .types import QueueJob, QueueJobMessage, QueueJobPdf2Image, QueueJobResult, QueueJobType
+from .types import QueueJob, QueueJobResult, QueueJobType
+from .jobHandlers import runJob, runJobBatch, hasBatchJobHandler, stageReceiverOf
+from .admission import ServiceTimeEstimator, jobPagesOf
+from .scheduler import CostQueue
+
+## (promise, result) of a job, it is set in the event loop thread of the promise
+PromiseResult = Tuple[asyncio.Future[QueueJobResult], QueueJobResult]
 
 
 class QueueWorkerOpts(TypedDict):
     queueMaxSize: NotRequired[int]
     queue: NotRequired[Optional[queue.Queue]]
+    ## if specified, processElapsedMs of each job is recorded for admission control
+    serviceTimes: NotRequired[Optional[ServiceTimeEstimator]]
+    ## CPU affinity of the worker thread (renderer subprocesses inherit it), not pinned if empty
+    cpus: NotRequired[List[int]]
+    ## Batch mode (off if batchMaxJobs <= 1): jobs of a job type with a batch handler (refer to batchJobHandler)
+    ## are dequeued up to batchMaxJobs or batchWaitMs after the first one, run by one handler call and
+    ## their promises are resolved by one event loop callback
+    batchMaxJobs: NotRequired[int]
+    batchWaitMs: NotRequired[float]
+    ## no. of workers sharing the queue (default 1), a batch takes at most its share of the queued jobs,
+    ## i.e. it does not starve the other workers
+    queueWorkers: NotRequired[int]
 
 
 class MultiThreadQueueWorker(threading.Thread):
@@ -41,9 +73,9 @@ class MultiThreadQueueWorker(threading.Thread):
                     f"{prefix} unique queues={len(queues)}, workers={[ [ w.name() for w in queues[q]]  for q in queues  ]}"
                 )
 
-            ## Get size of unique queues
-            ## NOTE: If there is running task in the worker, add 1 to the size since it is still running
-            queueSizes = [q.qsize() + sum([1 if w.isRunningJob() else 0 for w in queues[q]]) for q in queues]
+            ## Get pages of unique queues, i.e. a 500-page job is not the same as a 1-page job
+            ## NOTE: If there is running task in the worker, add its pages since it is still running
+            queueSizes = [cls.queuedPagesOf(q) + sum([w.runningJobPages() for w in queues[q]]) for q in queues]
 
             ## Find out the work who has the smallest queue size
             queueIdxMinSize = queueSizes.index(min(queueSizes))
@@ -54,6 +86,53 @@ class MultiThreadQueueWorker(threading.Thread):
         except Exception as e:
             U.throwPrefix(prefix, e)
 
+    @classmethod
+    def queuedPagesOf(cls, jobQueue: queue.Queue) -> int:
+        """
+        Pages of the jobs in a job queue (refer to jobPagesOf)
+        """
+        ## NOTE: queue.Queue keeps its items in .queue guarded by .mutex
+        with jobQueue.mutex:
+            jobs = jobQueue.jobs() if isinstance(jobQueue, CostQueue) else jobQueue.queue
+            return sum([jobPagesOf(job) for job in jobs])
+
+    @classmethod
+    def queueLoad(cls, workers: List["MultiThreadQueueWorker"], jobQueue: queue.Queue) -> Tuple[int, int]:
+        """
+        Get the load of a job queue
+
+        Returns:
+            (pendingPages, activeWorkers) pendingPages are pages of queued or running jobs of the workers sharing the queue
+        """
+        queueWorkers = [w for w in workers if w.jobQueue() is jobQueue and w.is_alive()]
+        pendingPages = cls.queuedPagesOf(jobQueue) + sum([w.runningJobPages() for w in queueWorkers])
+        return pendingPages, len(queueWorkers)
+
+    @classmethod
+    def setPromiseResult_(cls, prefix: str, resultPromise: asyncio.Future[QueueJobResult], result: QueueJobResult):
+        ## NOTE: it must run in the event loop thread of the promise
+        if not resultPromise.done():
+            resultPromise.set_result(result)
+        else:
+            U.logD(f"{prefix} promise already done, state={resultPromise._state}")
+
+    @classmethod
+    def setPromiseResults_(cls, prefix: str, promiseResults: List[PromiseResult]):
+        ## NOTE: it must run in the event loop thread of the promises
+        for resultPromise, result in promiseResults:
+            cls.setPromiseResult_(prefix, resultPromise, result)
+
+    @classmethod
+    def setBatchResults_(cls, prefix: str, jobResults: List[Tuple[QueueJob, QueueJobResult]]):
+        """
+        Resolve promises of jobs of a batch by one call_soon_threadsafe per event loop (i.e. one wake up), not per job
+        """
+        promiseResults: Dict[asyncio.AbstractEventLoop, List[PromiseResult]] = {}
+        for job, result in jobResults:
+            promiseResults.setdefault(job["promise"].get_loop(), []).append((job["promise"], result))
+        for loop, loopPromiseResults in promiseResults.items():
+            loop.call_soon_threadsafe(cls.setPromiseResults_, prefix, loopPromiseResults)
+
     ## limit the instance variable
     ## Why? avoid bugs some methods created wrong instance variable
     __slots__ = (
@@ -63,7 +142,13 @@ class MultiThreadQueueWorker(threading.Thread):
         "startedPromise_",
         "isWorkerStarted_",
         "isRunningJob_",
+        "runningJobPages_",
         "isRequestedToStop_",
+        "serviceTimes_",
+        "cpus_",
+        "batchMaxJobs_",
+        "batchWaitMs_",
+        "queueWorkers_",
     )
 
     def __init__(self, workerName: str, startedPromise: asyncio.Future[bool], optsIn: Optional[QueueWorkerOpts]):
@@ -105,6 +190,13 @@ class MultiThreadQueueWorker(threading.Thread):
             ## - By default, it is False.  When main thread exits, running threads will prevent the program from exiting.
             self.setDaemon(True)
             self.isRequestedToStop_ = False
+            self.isRunningJob_ = False
+            self.runningJobPages_ = 0
+            self.serviceTimes_ = optsIn.get("serviceTimes") if optsIn is not None else None
+            self.cpus_: List[int] = optsIn.get("cpus", []) if optsIn is not None else []
+            self.batchMaxJobs_: int = optsIn.get("batchMaxJobs", 1) if optsIn is not None else 1
+            self.batchWaitMs_: float = optsIn.get("batchWaitMs", 0) if optsIn is not None else 0
+            self.queueWorkers_: int = max(1, optsIn.get("queueWorkers", 1)) if optsIn is not None else 1
 
         except Exception as e:
             U.throwPrefix(prefix, e)
@@ -130,6 +222,9 @@ class MultiThreadQueueWorker(threading.Thread):
     def isRunningJob(self):
         return self.isRunningJob_
 
+    def runningJobPages(self) -> int:
+        return self.runningJobPages_ if self.isRunningJob_ else 0
+
     def jobQueueMaxSize(self):
         return self.jobQueue_.maxsize
 
@@ -141,9 +236,19 @@ class MultiThreadQueueWorker(threading.Thread):
 
         ## notify worker is started
         if not self.isWorkerStarted_:
-            self.startedPromise_.set_result(True)
+            ## NOTE: asyncio.Future is NOT thread safe, the result must be set in the event loop thread
+            self.startedPromise_.get_loop().call_soon_threadsafe(self.startedPromise_.set_result, True)
             self.isWorkerStarted_ = True
-            U.logI(f"{prefix} running... maxQueueSize={self.jobQueue_.maxsize}")
+            U.logI(
+                f"{prefix} running... maxQueueSize={self.jobQueue_.maxsize},"
+                f" batchMaxJobs={self.batchMaxJobs_}, batchWaitMs={self.batchWaitMs_}"
+            )
+            try:
+                if U.setCpuAffinity(self.cpus_):
+                    U.logI(f"{prefix} pinned to cpus={self.cpus_}")
+            except Exception as e:
+                ## NOTE: not fatal, the worker runs unpinned
+                U.logPrefixE(prefix, e)
 
         lastAliveEpms = U.epochMs()
         while True:
@@ -170,8 +275,11 @@ class MultiThreadQueueWorker(threading.Thread):
                     ## continue the while loop if job queue is empty
                     continue
 
-                ## process the queue job
-                self.onQueueJob_(job)
+                ## process the queue job, or a batch of jobs starting with it
+                if self.batchMaxJobs_ > 1 and hasBatchJobHandler(job["jobType"]):
+                    self.onQueueJobs_(self.nextJobs_(job))
+                else:
+                    self.onQueueJob_(job)
 
             except KeyboardInterrupt as e:
                 U.logW(f"{prefix} KeyboardInterrupt")
@@ -182,99 +290,98 @@ class MultiThreadQueueWorker(threading.Thread):
     def onQueueJob_(self, job: QueueJob):
         funcName = self.onQueueJob_.__name__
         prefix = f"{self.workerName_}.{funcName}[{job['id']}]"
-        result: QueueJobResult = {
-            "errCode": "",
-            "err": "",
-            "data": "",
-            "workerName": self.workerName_,
-            "dequeueElapsedMs": 0,
-            "processElapsedMs": 0,
-            "totalElapsedMs": 0,
-        }
         resultPromise: Optional[asyncio.Future["QueueJobResult"]] = None
         try:
-            self.isRunningJob_ = True
             U.logW(f"{prefix} {job}")
 
             ## result promise needs to obtain earlier.
-            ## In case of exception, it will be used to return errcode/err
             resultPromise = job["promise"]
             if resultPromise.done():
                 U.logD(f"{prefix} no need to process job (already canceled)")
                 return
 
-            ## calculate elapsed time for job dequeue
-            onDequeueEpms = U.epochMs()
-            result["dequeueElapsedMs"] = onDequeueEpms - job["createEpms"]
+            ## Process the job by the handler of its job type
+            self.runningJobPages_ = jobPagesOf(job)
+            self.isRunningJob_ = True
+            ## NOTE: the job aborts at its next stage boundary once its promise is done (e.g. request timed out)
+            result = runJob(job, self.workerName_, stageReceiverOf(job), resultPromise.done)
+            if self.serviceTimes_ is not None and result["errCode"] == "":
+                self.serviceTimes_.record(job["jobType"], result["processElapsedMs"], jobPagesOf(job))
 
-            ## Process CPU intensive task
-            onProcessEpms = U.epochMs()
-            jobType = job["jobType"]
+            ## Important note:
+            ## - asyncio.Future is NOT thread safe, set_result() from worker thread does not wake up the event loop
+            ## - Thus, the result must be set in the event loop thread by call_soon_threadsafe()
+            resultPromise.get_loop().call_soon_threadsafe(
+                MultiThreadQueueWorker.setPromiseResult_, prefix, resultPromise, result
+            )
+        except Exception as e:
+            U.throwPrefix(prefix, f"failed setting result, err={e}")
+
+    def nextJobs_(self, job: QueueJob) -> List[QueueJob]:
+        """
+        A batch starting with job, i.e. jobs in the queue up to batchMaxJobs, waits up to batchWaitMs for more
+
+        NOTE: with queueWorkers > 1, at most ceil(queued jobs / queueWorkers), e.g. 1 job if the queue is empty
+        """
+        jobs = [job]
+        maxJobs = self.batchMaxJobs_
+        if self.queueWorkers_ > 1:
+            ## its share of the queued jobs, the other workers sharing the queue take the rest
+            maxJobs = min(maxJobs, math.ceil((1 + self.jobQueue_.qsize()) / self.queueWorkers_))
+        deadlineSec = time.monotonic() + self.batchWaitMs_ / 1000
+        while len(jobs) < maxJobs:
+            try:
+                waitSec = deadlineSec - time.monotonic()
+                jobs.append(self.jobQueue_.get(timeout=waitSec) if waitSec > 0 else self.jobQueue_.get_nowait())
+            except queue.Empty:
+                break
+        return jobs
 
-            ## Simulate CPU task that may run 3 to 10 secs
-            ## If randomNo >=8, it runs for longer 10 secs
-            if jobType == QueueJobType.MESSAGE and job["jobData"]["tag"] == QueueJobType.MESSAGE:
-                self.onJobMessage(result, job, job["jobData"])
+    def onQueueJobs_(self, jobs: List[QueueJob]):
+        """
+        Process a batch of jobs, jobs of a job type with a batch handler are run by one call (refer to runJobBatch)
 
-            ## Convert pdf to image
-            elif jobType == QueueJobType.PDF2IMAGE and job["jobData"]["tag"] == QueueJobType.PDF2IMAGE:
-                self.onJobPdf2image(result, job, job["jobData"])
-            else:
-                raise Exception(f"invalid jobType")
-            onResultEpms = U.epochMs()
+        NOTE: jobs without a batch handler (e.g. a pdf2image job dequeued by the batch) are processed one by one
+        """
+        funcName = self.onQueueJobs_.__name__
+        prefix = f"{self.workerName_}.{funcName}[{len(jobs)}]"
+        try:
+            ## NOTE: one log per batch, i.e. not per job
+            U.logD(f"{prefix} jobs={[job['id'] for job in jobs]}")
 
-            ## fill in the result
-            result["processElapsedMs"] = onResultEpms - onProcessEpms
-            result["totalElapsedMs"] = onResultEpms - job["createEpms"]
+            batches: Dict[str, List[QueueJob]] = {}
+            singleJobs: List[QueueJob] = []
+            for job in jobs:
+                if job["promise"].done():
+                    continue
+                if hasBatchJobHandler(job["jobType"]):
+                    batches.setdefault(job["jobType"], []).append(job)
+                else:
+                    singleJobs.append(job)
 
-        ## In case of exception, fill in err/errcode to the result
-        except Exception as e:
-            if resultPromise is not None:
-                result["errCode"] = "err"
-                result["err"] = "error processing job request"
+            for jobType, batch in batches.items():
+                pages = sum([jobPagesOf(job) for job in batch])
+                self.runningJobPages_ = pages
+                self.isRunningJob_ = True
 
-        ## Regardless of exception, it needs to set_result() to notify the original job dispatcher
-        finally:
-            try:
-                if resultPromise is not None:
-                    if not resultPromise.done():
-                        resultPromise.set_result(result)
-                    else:
-                        U.logD(f"{prefix} promise already done, state={resultPromise._state}")
-                else:
-                    raise Exception(f"resultPromise is null")
-            except Exception as e2:
-                U.throwPrefix(prefix, f"failed setting result, err={e2}")
+                ## jobs finished before the end of the batch are resolved right away (refer to finishBatchJobs)
+                sentJobIdxs: Set[int] = set()
 
-            if result["errCode"] != "":
-                U.throwPrefix(prefix, result["err"])
+                def onResult(jobIdxResults: List[Tuple[int, QueueJobResult]], batch: List[QueueJob] = batch):
+                    for jobIdx, _ in jobIdxResults:
+                        sentJobIdxs.add(jobIdx)
+                    self.setBatchResults_(prefix, [(batch[jobIdx], result) for jobIdx, result in jobIdxResults])
 
-    def onJobMessage(self, jobResult: QueueJobResult, job: QueueJob, jobData: QueueJobMessage):
-        funcName = self.onJobMessage.__name__
-        prefix = funcName
-        try:
-            if jobData["randomNo"] >= 8:
-                U.logW(f"{prefix} simulating a CPU intensive task that runs for an unexpected long time! (10secs)")
-                time.sleep(10)
-            else:
-                time.sleep(3)
-            jobResult["data"] = f"message job finished ({U.epochMs()})"
-        except Exception as e:
-            U.logPrefixE(prefix, e)
-            U.throwPrefix(prefix, e)
+                ## NOTE: a job aborts at its next budget check once its promise is done (e.g. request timed out)
+                results = runJobBatch(batch, self.workerName_, onResult, lambda job: job["promise"].done())
+                if self.serviceTimes_ is not None and all([result["errCode"] == "" for result in results]):
+                    self.serviceTimes_.record(jobType, max([result["processElapsedMs"] for result in results]), pages)
 
-    def onJobPdf2image(self, jobResult: QueueJobResult, job: QueueJob, jobData: QueueJobPdf2Image):
-        funcName = self.onJobPdf2image.__name__
-        prefix = funcName
-        try:
-            pdfPath = jobData["pdfFilePath"]
-            pages = pdf2image.convert_from_path(pdfPath, thread_count=4)
-            if pages is not None and len(pages) > 0:
-                basedDir = f"./out/pdf2image/{job['id']}"
-                os.makedirs(basedDir)
-                for idx, page in enumerate(pages):
-                    page.save(f"{basedDir}/image-{idx:0>2}.png")
-            jobResult["data"] = f"job[{jobData['tag']}] finished ({U.epochMs()}), nPages={len(pages)}"
+                ## the others
+                jobResults = [(job, result) for job, result in zip(batch, results)]
+                self.setBatchResults_(prefix, [jobResults[i] for i in range(len(batch)) if i not in sentJobIdxs])
+
+            for job in singleJobs:
+                self.onQueueJob_(job)
         except Exception as e:
-            U.logPrefixE(prefix, e)
-            U.throwPrefix(prefix, e)
+            U.throwPrefix(prefix, f"failed setting results, err={e}")
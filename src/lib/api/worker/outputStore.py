@@ -0,0 +1,274 @@
+import os
+import time
+import shutil
+import asyncio
+from collections import OrderedDict
+from typing import Final, List, Dict, Tuple, Optional, TypedDict
+
+import util as U
+
+
+class OutputEntry(TypedDict):
+    kind: str
+    id: str
+    dir: str
+    bytes: int
+    files: int
+    createSec: float
+    lastAccessSec: float
+
+
+class OutputStoreStats(TypedDict):
+    entries: int
+    bytes: int
+    files: int
+    maxBytes: int
+    maxFiles: int
+    evictedEntries: int
+    evictedBytes: int
+
+
+class OutputStore:
+    """
+    Quota-managed store of job outputs, i.e. {rootDir of kind}/{id}/ (e.g. ./out/pdf2image/{jobId})
+
+    NOTE:
+    - In-memory index of all outputs (size, files, last access) in LRU order, built by one scan on startup,
+      thus lookups and quota checks never scan the filesystem
+    - An output is added when it is complete (add), and touched when it is read (touch)
+    - Eviction runs in background (never on the request path): outputs older than ttlSec are removed,
+      then least recently used outputs until the store is within maxBytes/maxFiles
+    - Directories are removed in pool thread
+    - All methods must be called in the event loop thread, thus no lock is needed
+    - The index is per process, with API_WORKER_COUNT > 1 each API process enforces the quota on outputs it knows
+    """
+
+    EVICT_INTERVAL_SEC: Final[float] = 60
+
+    ## limit the instance variable
+    ## Why? avoid bugs some methods created wrong instance variable
+    __slots__ = (
+        "rootDirs_",
+        "maxBytes_",
+        "maxFiles_",
+        "ttlSec_",
+        "index_",
+        "bytes_",
+        "files_",
+        "evictedEntries_",
+        "evictedBytes_",
+        "evictEvent_",
+        "task_",
+    )
+
+    def __init__(self, rootDirs: Dict[str, str], maxBytes: int, maxFiles: int, ttlSec: float = 0):
+        """
+        Args:
+            rootDirs: kind -> root dir, e.g. {"pdf2image": "./out/pdf2image"}
+            maxBytes/maxFiles: quota of all outputs (0: unlimited)
+            ttlSec: outputs not accessed for ttlSec are removed (0: no ttl)
+        """
+        self.rootDirs_ = rootDirs
+        self.maxBytes_ = maxBytes
+        self.maxFiles_ = maxFiles
+        self.ttlSec_ = ttlSec
+        ## (kind, id) -> entry, least recently used first
+        self.index_: OrderedDict[Tuple[str, str], OutputEntry] = OrderedDict()
+        self.bytes_ = 0
+        self.files_ = 0
+        self.evictedEntries_ = 0
+        self.evictedBytes_ = 0
+        self.evictEvent_: Optional[asyncio.Event] = None
+        self.task_: Optional[asyncio.Task] = None
+
+    def start(self):
+        """
+        Scan existing outputs and start the eviction task (in background)
+        """
+        self.evictEvent_ = asyncio.Event()
+        self.task_ = asyncio.create_task(self.evictionWorker_())
+
+    async def stop(self):
+        if self.task_ is not None:
+            self.task_.cancel()
+            await asyncio.gather(self.task_, return_exceptions=True)
+
+    def dirOf(self, kind: str, id: str) -> str:
+        return f"{self.rootDirs_[kind]}/{id}"
+
+    def find(self, kind: str, id: str) -> Optional[OutputEntry]:
+        return self.index_.get((kind, id))
+
+    def touch(self, kind: str, id: str):
+        entry = self.index_.get((kind, id))
+        if entry is not None:
+            entry["lastAccessSec"] = time.time()
+            self.index_.move_to_end((kind, id))
+
+    def add(self, kind: str, id: str):
+        """
+        Add a complete output, its size is measured in pool thread
+        """
+        asyncio.get_running_loop().create_task(self.add_(kind, id))
+
+    def stats(self) -> OutputStoreStats:
+        return {
+            "entries": len(self.index_),
+            "bytes": self.bytes_,
+            "files": self.files_,
+            "maxBytes": self.maxBytes_,
+            "maxFiles": self.maxFiles_,
+            "evictedEntries": self.evictedEntries_,
+            "evictedBytes": self.evictedBytes_,
+        }
+
+    async def add_(self, kind: str, id: str):
+        funcName = self.add_.__name__
+        prefix = f"{funcName}[{kind}][{id}]"
+        try:
+            outDir = self.dirOf(kind, id)
+            sizeBytes, files = await asyncio.to_thread(self.dirUsage_, outDir)
+            nowSec = time.time()
+            self.put_(
+                {
+                    "kind": kind,
+                    "id": id,
+                    "dir": outDir,
+                    "bytes": sizeBytes,
+                    "files": files,
+                    "createSec": nowSec,
+                    "lastAccessSec": nowSec,
+                }
+            )
+            if self.isOverQuota_() and self.evictEvent_ is not None:
+                self.evictEvent_.set()
+        except FileNotFoundError:
+            ## e.g. a job failed before writing its output
+            pass
+        except Exception as e:
+            U.logPrefixE(prefix, e)
+
+    def put_(self, entry: OutputEntry):
+        key = (entry["kind"], entry["id"])
+        self.remove_(key)
+        self.index_[key] = entry
+        self.bytes_ += entry["bytes"]
+        self.files_ += entry["files"]
+
+    def remove_(self, key: Tuple[str, str]) -> Optional[OutputEntry]:
+        entry = self.index_.pop(key, None)
+        if entry is not None:
+            self.bytes_ -= entry["bytes"]
+            self.files_ -= entry["files"]
+        return entry
+
+    def isOverQuota_(self) -> bool:
+        return (self.maxBytes_ > 0 and self.bytes_ > self.maxBytes_) or (
+            self.maxFiles_ > 0 and self.files_ > self.maxFiles_
+        )
+
+    @staticmethod
+    def dirUsage_(outDir: str) -> Tuple[int, int]:
+        """
+        Returns:
+            (bytes, files) of a dir, raises FileNotFoundError if the dir does not exist
+        """
+        sizeBytes, files = 0, 0
+        with os.scandir(outDir) as it:
+            for dirEntry in it:
+                if dirEntry.is_file(follow_symlinks=False):
+                    sizeBytes += dirEntry.stat(follow_symlinks=False).st_size
+                    files += 1
+        return sizeBytes, files
+
+    def scan_(self) -> List[OutputEntry]:
+        """
+        Scan all outputs of all root dirs (startup only), oldest first
+        """
+        entries: List[OutputEntry] = []
+        for kind, rootDir in self.rootDirs_.items():
+            if not os.path.isdir(rootDir):
+                continue
+            with os.scandir(rootDir) as it:
+                for dirEntry in it:
+                    if not dirEntry.is_dir(follow_symlinks=False):
+                        continue
+                    try:
+                        sizeBytes, files = self.dirUsage_(dirEntry.path)
+                        mtimeSec = dirEntry.stat(follow_symlinks=False).st_mtime
+                    except FileNotFoundError:
+                        continue
+                    entries.append(
+                        {
+                            "kind": kind,
+                            "id": dirEntry.name,
+                            "dir": dirEntry.path,
+                            "bytes": sizeBytes,
+                            "files": files,
+                            "createSec": mtimeSec,
+                            "lastAccessSec": mtimeSec,
+                        }
+                    )
+        entries.sort(key=lambda entry: entry["lastAccessSec"])
+        return entries
+
+    def evictionCandidates_(self) -> List[OutputEntry]:
+        """
+        Remove expired and least recently used entries from the index until it is within the quota
+        """
+        evicted: List[OutputEntry] = []
+        if self.ttlSec_ > 0:
+            expirySec = time.time() - self.ttlSec_
+            ## NOTE: index is in LRU order, thus expired entries are at the front
+            while len(self.index_) > 0:
+                key, entry = next(iter(self.index_.items()))
+                if entry["lastAccessSec"] > expirySec:
+                    break
+                evicted.append(self.remove_(key))
+        while self.isOverQuota_() and len(self.index_) > 0:
+            evicted.append(self.remove_(next(iter(self.index_))))
+        return evicted
+
+    async def evictionWorker_(self):
+        funcName = self.evictionWorker_.__name__
+        prefix = funcName
+        try:
+            phaseStartSec = time.perf_counter()
+            for entry in await asyncio.to_thread(self.scan_):
+                ## NOTE: outputs added while scanning are more recent, keep them
+                if (entry["kind"], entry["id"]) not in self.index_:
+                    self.put_(entry)
+                    self.index_.move_to_end((entry["kind"], entry["id"]), last=False)
+            U.logI(
+                f"{prefix} indexed {len(self.index_)} outputs, bytes={self.bytes_}, files={self.files_} in {int((time.perf_counter() - phaseStartSec) * 1000)}ms"
+            )
+        except Exception as e:
+            U.logPrefixE(prefix, e)
+
+        while True:
+            try:
+                evicted = self.evictionCandidates_()
+                if len(evicted) > 0:
+                    ## NOTE: entries are out of the index already, i.e. lookups miss them while they are removed
+                    await asyncio.to_thread(self.removeDirs_, evicted)
+                    self.evictedEntries_ += len(evicted)
+                    self.evictedBytes_ += sum(entry["bytes"] for entry in evicted)
+                    U.logI(f"{prefix} evicted {len(evicted)} outputs, bytes={self.bytes_}, files={self.files_}")
+
+                ## wait for the next round, or an output that exceeds the quota
+                try:
+                    async with asyncio.timeout(self.EVICT_INTERVAL_SEC):
+                        await self.evictEvent_.wait()
+                except TimeoutError:
+                    pass
+                self.evictEvent_.clear()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                U.logPrefixE(prefix, e)
+                await asyncio.sleep(self.EVICT_INTERVAL_SEC)
+
+    @staticmethod
+    def removeDirs_(entries: List[OutputEntry]):
+        for entry in entries:
+            shutil.rmtree(entry["dir"], ignore_errors=True)
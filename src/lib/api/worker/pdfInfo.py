@@ -0,0 +1,149 @@
+import re
+import math
+import asyncio
+import itertools
+from collections import OrderedDict
+from typing import Final, List, Dict, Tuple, Optional, TypedDict
+
+import util as U
+from .types import PdfInfo, QueueJobPdf2Image
+from .jobHandlers import PDF2IMAGE_DEFAULT_DPI, pdf2imagePageIdxsOf, pdf2imagePreviewIdxsOf
+
+
+class PdfInfoStats(TypedDict):
+    entries: int
+    hits: int
+    probes: int
+    failures: int
+
+
+def probePdfInfo(filePath: str) -> PdfInfo:
+    """
+    Page count, page sizes and encryption of a pdf by pdfinfo (poppler), it blocks
+
+    NOTE: page sizes are of all pages, i.e. pdfinfo -f 1 -l {pages}
+    """
+    funcName = probePdfInfo.__name__
+    prefix = f"{funcName}[{filePath}]"
+    try:
+        ## NOTE: pdf2image is imported on first use, i.e. not on server startup
+        import pdf2image
+
+        info = pdf2image.pdfinfo_from_path(filePath)
+        nPages = int(info["Pages"])
+        pageSizes: List[Tuple[float, float]] = []
+        if nPages > 0:
+            ## e.g. "Page    1 size": "612 x 792 pts (letter)"
+            pageInfo = pdf2image.pdfinfo_from_path(filePath, first_page=1, last_page=nPages)
+            for key, value in pageInfo.items():
+                if re.fullmatch(r"Page\s+\d+ size", key):
+                    match = re.match(r"([\d.]+) x ([\d.]+) pts", value)
+                    if match is not None:
+                        pageSizes.append((float(match.group(1)), float(match.group(2))))
+        return {
+            "pages": nPages,
+            "pageSizes": pageSizes,
+            "isEncrypted": str(info.get("Encrypted", "no")).startswith("yes"),
+        }
+    except Exception as e:
+        U.throwPrefix(prefix, e)
+
+
+def pdf2imagePagesOf(jobData: QueueJobPdf2Image, pdfInfo: PdfInfo) -> int:
+    """
+    Cost of a pdf2image job in pages rendered at jobData dpi, i.e. selected pages + the preview scaled by (previewDpi / dpi)^2
+    """
+    nPages = pdfInfo["pages"]
+    pages = sum(1 for _ in itertools.takewhile(lambda pageIdx: pageIdx < nPages, pdf2imagePageIdxsOf(jobData)))
+    if "previewDpi" in jobData:
+        previewPages = sum(
+            1 for _ in itertools.takewhile(lambda pageIdx: pageIdx < nPages, pdf2imagePreviewIdxsOf(jobData))
+        )
+        dpiRatio = jobData["previewDpi"] / jobData.get("dpi", PDF2IMAGE_DEFAULT_DPI)
+        pages += math.ceil(previewPages * dpiRatio * dpiRatio)
+    return max(1, pages)
+
+
+class PdfInfoCache:
+    """
+    Metadata of pdfs (refer to probePdfInfo) cached by content hash, i.e. a document is probed once
+
+    NOTE:
+    - Probe runs in pool thread, concurrent probes of the same document share one probe
+    - A failed probe (e.g. not a pdf, pdfinfo timeout under load) is cached for FAILURE_TTL_MS only (None),
+      i.e. a transient failure does not stick to the document, the job fails by itself in the worker
+    - All methods must be called in the event loop thread, thus no lock is needed
+    """
+
+    MAX_SIZE: Final[int] = 1024
+    FAILURE_TTL_MS: Final[int] = 10000
+
+    ## limit the instance variable
+    ## Why? avoid bugs some methods created wrong instance variable
+    __slots__ = ("maxSize_", "infos_", "failedEpms_", "probes_", "hits_", "probeCount_", "failures_")
+
+    def __init__(self, maxSize: int = MAX_SIZE):
+        self.maxSize_ = maxSize
+        ## contentHash -> info, least recently used first
+        self.infos_: OrderedDict[str, PdfInfo] = OrderedDict()
+        ## contentHash -> epms of the failed probe, oldest first
+        self.failedEpms_: OrderedDict[str, int] = OrderedDict()
+        ## contentHash -> running probe
+        self.probes_: Dict[str, asyncio.Future[Optional[PdfInfo]]] = {}
+        self.hits_ = 0
+        self.probeCount_ = 0
+        self.failures_ = 0
+
+    async def infoOf(self, filePath: str, contentHash: str) -> Optional[PdfInfo]:
+        """
+        Returns:
+            metadata of the pdf, None if it cannot be probed
+        """
+        if contentHash in self.infos_:
+            self.hits_ += 1
+            self.infos_.move_to_end(contentHash)
+            return self.infos_[contentHash]
+        if contentHash in self.failedEpms_:
+            if U.epochMs() - self.failedEpms_[contentHash] < self.FAILURE_TTL_MS:
+                self.hits_ += 1
+                return None
+            del self.failedEpms_[contentHash]
+
+        probe = self.probes_.get(contentHash)
+        if probe is None:
+            probe = asyncio.ensure_future(self.probe_(filePath, contentHash))
+            self.probes_[contentHash] = probe
+        else:
+            self.hits_ += 1
+        ## NOTE: shielded, thus a canceled request does not cancel the probe shared with others
+        return await asyncio.shield(probe)
+
+    def stats(self) -> PdfInfoStats:
+        return {
+            "entries": len(self.infos_) + len(self.failedEpms_),
+            "hits": self.hits_,
+            "probes": self.probeCount_,
+            "failures": self.failures_,
+        }
+
+    async def probe_(self, filePath: str, contentHash: str) -> Optional[PdfInfo]:
+        funcName = self.probe_.__name__
+        prefix = f"{funcName}[{filePath}]"
+        pdfInfo: Optional[PdfInfo] = None
+        try:
+            self.probeCount_ += 1
+            pdfInfo = await asyncio.to_thread(probePdfInfo, filePath)
+        except Exception as e:
+            self.failures_ += 1
+            U.logPrefixE(prefix, e)
+        finally:
+            del self.probes_[contentHash]
+        if pdfInfo is None:
+            self.failedEpms_[contentHash] = U.epochMs()
+            if len(self.failedEpms_) > self.maxSize_:
+                self.failedEpms_.popitem(last=False)
+            return None
+        self.infos_[contentHash] = pdfInfo
+        if len(self.infos_) > self.maxSize_:
+            self.infos_.popitem(last=False)
+        return pdfInfo
@@ -0,0 +1,312 @@
+import os
+import time
+import queue
+import marshal
+import selectors
+import threading
+import multiprocessing
+from enum import Enum
+from collections import deque
+from multiprocessing.connection import Connection
+from typing import Final, List, Dict, Deque, Tuple, Any, Optional
+
+import util as U
+from .types import MpQueueJob, QueueJobResult, QueueJobErrCode
+from .queueBackend import QueueBackend
+from .jobHandlers import newJobResult
+from .scheduler import jobCostOf
+
+## Fields of the compact encoding, in order (refer to encodeMpJob/encodeMpResult)
+MP_JOB_FIELDS: Final[Tuple[str, ...]] = ("createEpms", "id", "jobType", "jobData", "promise", "isStaged", "pages")
+MP_RESULT_FIELDS: Final[Tuple[str, ...]] = (
+    "errCode",
+    "err",
+    "workerName",
+    "data",
+    "dequeueElapsedMs",
+    "processElapsedMs",
+    "totalElapsedMs",
+    "stage",
+)
+
+
+def plainOf(value: Any) -> Any:
+    ## NOTE: marshal takes builtin types only, str enums (e.g. QueueJobType) are sent as their value
+    return value.value if isinstance(value, Enum) else value
+
+
+def encodeMpJob(job: MpQueueJob) -> bytes:
+    """
+    Compact encoding of a job, i.e. a marshal tuple of MP_JOB_FIELDS (no keys, no pickle)
+
+    NOTE: jobData is a flat dict of builtin types (refer to QueueJobPdf2Image), but its tag (QueueJobType)
+    """
+    return marshal.dumps(
+        (
+            job["createEpms"],
+            job["id"],
+            plainOf(job["jobType"]),
+            {**job["jobData"], "tag": plainOf(job["jobData"]["tag"])},
+            job["promise"],
+            job.get("isStaged", False),
+            job.get("pages", 1),
+        )
+    )
+
+
+def decodeMpJob(payload: bytes) -> MpQueueJob:
+    job: MpQueueJob = dict(zip(MP_JOB_FIELDS, marshal.loads(payload)))
+    if not job["isStaged"]:
+        del job["isStaged"]
+    return job
+
+
+def encodeMpResult(item: Tuple[str, QueueJobResult]) -> bytes:
+    promiseId, result = item
+    return marshal.dumps(
+        (
+            promiseId,
+            plainOf(result["errCode"]),
+            result["err"],
+            result["workerName"],
+            result["data"],
+            result["dequeueElapsedMs"],
+            result["processElapsedMs"],
+            result["totalElapsedMs"],
+            result.get("stage", ""),
+        )
+    )
+
+
+def decodeMpResult(payload: bytes) -> Tuple[str, QueueJobResult]:
+    promiseId, *values = marshal.loads(payload)
+    result: QueueJobResult = dict(zip(MP_RESULT_FIELDS, values))
+    if result["stage"] == "":
+        del result["stage"]
+    return promiseId, result
+
+
+class WorkerPipe(QueueBackend):
+    """
+    Worker end of a duplex pipe of PipeHub, i.e. both the job queue and the result queue of one worker process
+
+    NOTE: get() receives the jobs sent to this worker only, put() sends a result (promiseId, QueueJobResult)
+    """
+
+    ## limit the instance variable
+    ## Why? avoid bugs some methods created wrong instance variable
+    __slots__ = ("conn_",)
+
+    def __init__(self, conn: Connection):
+        self.conn_ = conn
+
+    def put(self, item: Any, block: bool = True, timeout: Optional[float] = None):
+        self.conn_.send_bytes(encodeMpResult(item))
+
+    def get(self, block: bool = True, timeout: Optional[float] = None) -> Any:
+        if not self.conn_.poll(timeout if block else 0):
+            raise queue.Empty()
+        return decodeMpJob(self.conn_.recv_bytes())
+
+    def qsize(self) -> int:
+        return 0
+
+    def named(self, queueName: str) -> QueueBackend:
+        ## NOTE: not shared, i.e. no job has replyTo
+        raise Exception(f"{type(self).__name__} is not shared, no named queue[{queueName}]")
+
+    def close(self):
+        self.conn_.close()
+
+
+class PipeHub(QueueBackend):
+    """
+    Job queue and result queue of MultiProcessManager over one duplex pipe per worker (MP_TRANSPORT=pipe),
+    instead of a multiprocessing.Queue shared by all workers
+
+    NOTE:
+    - Jobs wait in a local queue of this process (refer to newJobQueue, i.e. fifo or sjf), and are sent to a worker
+      whose jobs sent and not yet done cost less than PIPELINE_COST (refer to jobCostOf), an idle worker gets
+      a job of any cost. Thus cheap jobs are pipelined deeply (no round trip per job), and a large job does not
+      hold cheap jobs behind it in the pipe of one worker while the other workers are idle.
+      Workers never compete for a shared pipe and its lock
+    - get() (the result thread of the manager) runs the selector: it dispatches jobs, and receives results
+      of all workers. put() wakes it up by a self-pipe
+    - Jobs and results are sent by the compact encoding (refer to encodeMpJob), no feeder thread nor pickle
+    - workerEnd() creates the pipe of a worker, the worker uses the returned WorkerPipe
+    - A worker that exits is removed (EOF).  Its running job (refer to runningJobId of workerEnd, it may have crashed
+      the worker) resolves with an error, the other jobs sent to it were not started and are queued again.
+      NOTE: a job killed by the watchdog has its result already, i.e. the oldest job sent is not always the running one
+    """
+
+    ## cost of the jobs sent to a worker and not yet done (1: a message job or a page at the default dpi),
+    ## i.e. the next jobs are in the pipe when the worker finishes its job
+    PIPELINE_COST: Final[float] = 8
+
+    ## limit the instance variable
+    ## Why? avoid bugs some methods created wrong instance variable
+    __slots__ = (
+        "jobs_",
+        "selector_",
+        "conns_",
+        "runningJobIds_",
+        "outstanding_",
+        "newConns_",
+        "lock_",
+        "results_",
+        "wakeReadFd_",
+        "wakeWriteFd_",
+    )
+
+    def __init__(self, jobs: queue.Queue):
+        """
+        Args:
+            jobs: local queue of jobs waiting for a worker, its maxsize is the queue size (refer to newJobQueue)
+        """
+        self.jobs_ = jobs
+        self.selector_ = selectors.DefaultSelector()
+        ## workerName -> manager end of the pipe, (cost, job) of the jobs sent and not yet done (in order)
+        self.conns_: Dict[str, Connection] = {}
+        ## manager end of the pipe -> runningJobId of its worker (refer to workerEnd)
+        self.runningJobIds_: Dict[Connection, Any] = {}
+        self.outstanding_: Dict[str, Deque[Tuple[float, MpQueueJob]]] = {}
+        ## pipes created by workerEnd(), registered to the selector by get()
+        self.newConns_: List[Tuple[str, Connection, Optional[Any]]] = []
+        self.lock_ = threading.Lock()
+        self.results_: Deque[Tuple[str, QueueJobResult]] = deque()
+        self.wakeReadFd_, self.wakeWriteFd_ = os.pipe()
+        os.set_blocking(self.wakeWriteFd_, False)
+        self.selector_.register(self.wakeReadFd_, selectors.EVENT_READ, None)
+
+    def workerEnd(self, workerName: str, runningJobId: Optional[Any] = None) -> QueueBackend:
+        conn, workerConn = multiprocessing.Pipe(duplex=True)
+        with self.lock_:
+            self.newConns_.append((workerName, conn, runningJobId))
+        self.wake_()
+        return WorkerPipe(workerConn)
+
+    def put(self, item: Any, block: bool = True, timeout: Optional[float] = None):
+        self.jobs_.put(item, block=block, timeout=timeout)
+        self.wake_()
+
+    def get(self, block: bool = True, timeout: Optional[float] = None) -> Any:
+        """
+        Next result (promiseId, QueueJobResult) of any worker, jobs are dispatched meanwhile
+
+        NOTE: it must be called by one thread only (the result thread)
+        """
+        deadlineSec = None if timeout is None else time.monotonic() + timeout
+        while len(self.results_) == 0:
+            self.registerNewConns_()
+            self.dispatch_()
+            waitSec = None if deadlineSec is None else max(0, deadlineSec - time.monotonic())
+            for key, _ in self.selector_.select(waitSec if block else 0):
+                if key.data is None:
+                    os.read(self.wakeReadFd_, 4096)
+                else:
+                    self.receive_(key.data, key.fileobj)
+            if len(self.results_) == 0 and (not block or (deadlineSec is not None and time.monotonic() >= deadlineSec)):
+                raise queue.Empty()
+        return self.results_.popleft()
+
+    def qsize(self) -> int:
+        return self.jobs_.qsize()
+
+    def named(self, queueName: str) -> QueueBackend:
+        ## NOTE: not shared, i.e. no job has replyTo
+        raise Exception(f"{type(self).__name__} is not shared, no named queue[{queueName}]")
+
+    def close(self):
+        ## NOTE: pipes of stopped workers are closed by get() on EOF, thus only the jobs not yet sent are discarded
+        while True:
+            try:
+                self.jobs_.get_nowait()
+            except queue.Empty:
+                break
+
+    def wake_(self):
+        try:
+            os.write(self.wakeWriteFd_, b"\0")
+        except BlockingIOError:
+            ## the self-pipe is full, i.e. the selector is woken up anyway
+            pass
+
+    def registerNewConns_(self):
+        with self.lock_:
+            newConns, self.newConns_ = self.newConns_, []
+        for workerName, conn, runningJobId in newConns:
+            self.conns_[workerName] = conn
+            if runningJobId is not None:
+                self.runningJobIds_[conn] = runningJobId
+            self.outstanding_[workerName] = deque()
+            self.selector_.register(conn, selectors.EVENT_READ, workerName)
+
+    def dispatch_(self):
+        ## least outstanding cost first, i.e. jobs are spread over idle workers before any is pipelined
+        while self.jobs_.qsize() > 0:
+            workerName = min(self.outstanding_, key=lambda w: self.outstandingCostOf_(w), default=None)
+            if workerName is None:
+                return
+            outstanding = self.outstanding_[workerName]
+            if len(outstanding) > 0 and self.outstandingCostOf_(workerName) >= self.PIPELINE_COST:
+                return
+            try:
+                job = self.jobs_.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                self.conns_[workerName].send_bytes(encodeMpJob(job))
+                outstanding.append((jobCostOf(job), job))
+            except OSError as e:
+                U.logW(f"PipeHub worker[{workerName}] gone, err={e}, job[{job['id']}] is queued again")
+                self.requeue_(job)
+                self.removeConn_(workerName, self.conns_[workerName])
+
+    def receive_(self, workerName: str, conn: Connection):
+        try:
+            ## NOTE: read all results in the pipe, the selector reports the pipe once per select()
+            while conn.poll():
+                promiseId, result = decodeMpResult(conn.recv_bytes())
+                ## NOTE: a worker runs its jobs in order, thus a final result is of its oldest outstanding job
+                if "stage" not in result:
+                    self.outstanding_[workerName].popleft()
+                self.results_.append((promiseId, result))
+        except (EOFError, OSError) as e:
+            nOutstanding = len(self.outstanding_.get(workerName, []))
+            U.logW(f"PipeHub worker[{workerName}] exited, outstanding jobs={nOutstanding}")
+            self.removeConn_(workerName, conn)
+
+    def outstandingCostOf_(self, workerName: str) -> float:
+        return sum([cost for cost, _ in self.outstanding_[workerName]])
+
+    def removeConn_(self, workerName: str, conn: Connection):
+        ## NOTE: a respawned worker of the same name may have registered its new pipe already
+        runningJobId = self.runningJobIds_.pop(conn, None)
+        if self.conns_.get(workerName) is conn:
+            del self.conns_[workerName]
+            outstanding = self.outstanding_.pop(workerName, deque())
+            ## the running job (if any) is not resent, e.g. it may crash the next worker too
+            ## NOTE: a job killed by the watchdog is not running anymore (its result is received), the next job
+            ## in the pipe was not started
+            runningId = runningJobId.value if runningJobId is not None else b""
+            for _, job in outstanding:
+                if runningId != b"" and runningId == job["promise"].encode()[: len(runningJobId.raw)]:
+                    self.failJob_(job, "worker exited while running the job")
+                else:
+                    self.requeue_(job)
+        self.selector_.unregister(conn)
+        conn.close()
+
+    def requeue_(self, job: MpQueueJob):
+        ## NOTE: the job was not started, it is dispatched to another worker (at the end of a fifo queue)
+        try:
+            self.jobs_.put(job, block=False)
+        except queue.Full:
+            self.failJob_(job, "worker exited, job queue full")
+
+    def failJob_(self, job: MpQueueJob, err: str):
+        U.logW(f"PipeHub job[{job['id']}] failed, err={err}")
+        result = newJobResult("PipeHub")
+        result["errCode"] = QueueJobErrCode.ERR
+        result["err"] = err
+        self.results_.append((job["promise"], result))
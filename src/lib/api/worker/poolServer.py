@@ -0,0 +1,455 @@
+import os
+import json
+import time
+import queue
+import struct
+import asyncio
+import threading
+from typing import Final, Callable, List, Dict, Any, Optional, Set
+
+import util as U
+from .types import MpQueueJob, QueueJob, QueueJobResult, QueueJobType, QueueJobErrCode
+from .admission import ServiceTimeEstimator, jobPagesOf
+from .mpWorker import MultiProcessManager
+from .renderBudget import RenderBudget
+from .scheduler import SCHEDULING_AGING_MS
+
+## Frame: 4 bytes big-endian length + json
+FRAME_HEADER = struct.Struct(">I")
+
+
+async def readFrame(reader: asyncio.StreamReader) -> Dict[str, Any]:
+    header = await reader.readexactly(FRAME_HEADER.size)
+    (size,) = FRAME_HEADER.unpack(header)
+    return json.loads(await reader.readexactly(size))
+
+
+def writeFrame(writer: asyncio.StreamWriter, msg: Dict[str, Any]):
+    ## NOTE: write() does not block, data is buffered and sent by the event loop
+    payload = json.dumps(msg).encode("utf-8")
+    writer.write(FRAME_HEADER.pack(len(payload)) + payload)
+
+
+def errorResult(errCode: str, err: str) -> QueueJobResult:
+    return {
+        "errCode": errCode,
+        "err": err,
+        "workerName": "",
+        "data": "",
+        "dequeueElapsedMs": 0,
+        "processElapsedMs": 0,
+        "totalElapsedMs": 0,
+    }
+
+
+class ProcessPoolServer:
+    """
+    A pool of multi-process workers shared by several API processes (e.g. uvicorn workers) over a unix socket
+
+    NOTE:
+    - It runs its own event loop in a thread of the process that owns the pool (e.g. uvicorn supervisor, refer to main.py)
+    - Messages (refer to RemoteProcessManager):
+      - client -> server: {"op": "enqueue", "job": MpQueueJob}
+      - client -> server: {"op": "abort", "promiseId": str} nobody waits for the result anymore (e.g. request timeout),
+        the job is skipped if queued or aborted by the worker (refer to MultiProcessManager.abortJob)
+      - server -> client: {"op": "result", "promiseId": str, "result": QueueJobResult}
+      - server -> client: {"op": "stage", "promiseId": str, "result": QueueJobResult} for jobs with isStaged
+      - server -> all clients: {"op": "load", "pendingJobs": int, "pendingPages": int, "activeWorkers": int}
+        whenever the load changes
+    - A job rejected by the full queue is responded with errCode=QueueJobErrCode.QUEUE_FULL
+    - A job that cannot be enqueued (e.g. a bad job) is responded with errCode=QueueJobErrCode.ERR, the other jobs
+      of the client go on
+    - Jobs of a client that disconnects are aborted
+    """
+
+    ## limit the instance variable
+    ## Why? avoid bugs some methods created wrong instance variable
+    __slots__ = (
+        "socketPath_",
+        "workerCount_",
+        "renderBudget_",
+        "workerCpus_",
+        "workerPinning_",
+        "scheduling_",
+        "schedulingAgingMs_",
+        "transport_",
+        "mpManager_",
+        "loop_",
+        "thread_",
+        "server_",
+        "clients_",
+        "clientJobs_",
+        "startedEvent_",
+    )
+
+    def __init__(
+        self,
+        socketPath: str,
+        workerCount: int,
+        renderBudget: Optional[RenderBudget] = None,
+        workerCpus: Optional[List[int]] = None,
+        workerPinning: str = "core",
+        scheduling: str = "fifo",
+        schedulingAgingMs: int = SCHEDULING_AGING_MS,
+        transport: str = "queue",
+    ):
+        """
+        Args:
+            renderBudget/workerCpus/workerPinning/scheduling/schedulingAgingMs/transport: refer to MultiProcessManager
+        """
+        self.socketPath_ = socketPath
+        self.workerCount_ = workerCount
+        self.renderBudget_ = renderBudget
+        self.workerCpus_ = workerCpus
+        self.workerPinning_ = workerPinning
+        self.scheduling_ = scheduling
+        self.schedulingAgingMs_ = schedulingAgingMs
+        self.transport_ = transport
+        self.mpManager_: Optional[MultiProcessManager] = None
+        self.loop_: Optional[asyncio.AbstractEventLoop] = None
+        self.server_: Optional[asyncio.AbstractServer] = None
+        self.clients_: Set[asyncio.StreamWriter] = set()
+        ## client -> promiseId -> promise of its jobs not yet done
+        self.clientJobs_: Dict[asyncio.StreamWriter, Dict[str, asyncio.Future[QueueJobResult]]] = {}
+        self.startedEvent_ = threading.Event()
+        self.thread_ = threading.Thread(target=self.threadWorker_, daemon=True)
+
+    def start(self, timeoutSec: float = 30):
+        """
+        Start the pool and listen on the socket, it returns when the pool is ready
+        """
+        funcName = self.start.__name__
+        prefix = f"pool[{self.socketPath_}].{funcName}"
+        try:
+            socketDir = os.path.dirname(self.socketPath_)
+            if socketDir != "":
+                os.makedirs(socketDir, exist_ok=True)
+            self.thread_.start()
+            if not self.startedEvent_.wait(timeoutSec):
+                raise Exception(f"pool not ready in {timeoutSec}s")
+        except Exception as e:
+            U.throwPrefix(prefix, e)
+
+    def stop(self, timeoutSec: float = 0):
+        """
+        Stop listening and stop the worker processes after their running job
+        """
+        funcName = self.stop.__name__
+        prefix = f"pool[{self.socketPath_}].{funcName}"
+        try:
+            if self.loop_ is None:
+                return
+            future = asyncio.run_coroutine_threadsafe(self.stop_(timeoutSec), self.loop_)
+            future.result()
+        except Exception as e:
+            U.logPrefixE(prefix, e)
+
+    def threadWorker_(self):
+        funcName = self.threadWorker_.__name__
+        prefix = f"pool[{self.socketPath_}].{funcName}"
+        try:
+            self.loop_ = asyncio.new_event_loop()
+            self.loop_.run_until_complete(self.serve_())
+            self.loop_.run_forever()
+        except Exception as e:
+            U.logPrefixE(prefix, e)
+
+    async def serve_(self):
+        self.mpManager_ = MultiProcessManager(
+            "mpPool",
+            renderBudget=self.renderBudget_,
+            workerCpus=self.workerCpus_,
+            workerPinning=self.workerPinning_,
+            scheduling=self.scheduling_,
+            schedulingAgingMs=self.schedulingAgingMs_,
+            transport=self.transport_,
+        )
+        for i in range(self.workerCount_):
+            self.mpManager_.startProcess(f"pdfWorker{i+1}")
+
+        if os.path.exists(self.socketPath_):
+            os.remove(self.socketPath_)
+        self.server_ = await asyncio.start_unix_server(self.onClient_, path=self.socketPath_)
+        U.logI(f"pool[{self.socketPath_}] {self.workerCount_} workers ready")
+        self.startedEvent_.set()
+
+    async def stop_(self, timeoutSec: float):
+        if self.server_ is not None:
+            self.server_.close()
+        for writer in list(self.clients_):
+            writer.close()
+        if self.mpManager_ is not None:
+            await self.mpManager_.stopAllProcesses(timeoutSec)
+        if os.path.exists(self.socketPath_):
+            os.remove(self.socketPath_)
+        asyncio.get_running_loop().call_soon(asyncio.get_running_loop().stop)
+
+    def broadcastLoad_(self):
+        msg = {
+            "op": "load",
+            "pendingJobs": self.mpManager_.pendingJobCount(),
+            "pendingPages": self.mpManager_.pendingPageCount(),
+            "activeWorkers": self.mpManager_.activeWorkerCount(),
+        }
+        for writer in self.clients_:
+            if not writer.is_closing():
+                writeFrame(writer, msg)
+
+    async def onClient_(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        funcName = self.onClient_.__name__
+        prefix = f"pool[{self.socketPath_}].{funcName}"
+        self.clients_.add(writer)
+        self.clientJobs_[writer] = {}
+        self.broadcastLoad_()
+        try:
+            while True:
+                msg = await readFrame(reader)
+                if msg["op"] == "enqueue":
+                    self.onEnqueue_(writer, msg["job"])
+                elif msg["op"] == "abort":
+                    self.onAbort_(writer, msg["promiseId"])
+                else:
+                    U.logW(f"{prefix} unknown op={msg['op']}")
+        except asyncio.IncompleteReadError:
+            ## client disconnected
+            pass
+        except Exception as e:
+            U.logPrefixE(prefix, e)
+        finally:
+            self.clients_.discard(writer)
+            ## nobody waits for the results of the client anymore
+            for resultPromise in self.clientJobs_.pop(writer, {}).values():
+                resultPromise.cancel()
+            writer.close()
+
+    def onEnqueue_(self, writer: asyncio.StreamWriter, mpJob: MpQueueJob):
+        funcName = self.onEnqueue_.__name__
+        prefix = f"pool[{self.socketPath_}].{funcName}"
+        promiseId = mpJob.get("promise", "") if isinstance(mpJob, dict) else ""
+        resultPromise: asyncio.Future[QueueJobResult] = asyncio.get_running_loop().create_future()
+        clientJobs = self.clientJobs_.get(writer, {})
+
+        def onResult(promise: asyncio.Future[QueueJobResult]):
+            clientJobs.pop(promiseId, None)
+            ## NOTE: an aborted job (cancelled) has no result to send, the client does not wait for it
+            if not promise.cancelled() and not writer.is_closing():
+                writeFrame(writer, {"op": "result", "promiseId": promiseId, "result": promise.result()})
+            self.broadcastLoad_()
+
+        try:
+            job: QueueJob = {
+                "createEpms": mpJob["createEpms"],
+                "id": mpJob["id"],
+                "jobType": QueueJobType(mpJob["jobType"]),
+                "jobData": mpJob["jobData"],
+                "promise": resultPromise,
+            }
+            if "pages" in mpJob:
+                job["pages"] = mpJob["pages"]
+            if mpJob.get("isStaged", False):
+
+                def onStage(stageResult: QueueJobResult):
+                    if not writer.is_closing():
+                        writeFrame(writer, {"op": "stage", "promiseId": promiseId, "result": stageResult})
+
+                job["onStage"] = onStage
+            self.mpManager_.enqueue(job)
+            clientJobs[promiseId] = resultPromise
+        except queue.Full:
+            resultPromise.set_result(errorResult(QueueJobErrCode.QUEUE_FULL, "job queue full"))
+        except Exception as e:
+            ## NOTE: the job fails alone, i.e. the connection and the other jobs of the client go on
+            U.logPrefixE(f"{prefix}[{promiseId}]", e)
+            resultPromise.set_result(errorResult(QueueJobErrCode.ERR, "error processing job request (invalid job)"))
+
+        resultPromise.add_done_callback(onResult)
+        self.broadcastLoad_()
+
+    def onAbort_(self, writer: asyncio.StreamWriter, promiseId: str):
+        ## NOTE: the manager aborts the job once its promise is done (refer to MultiProcessManager.onJobDone_)
+        resultPromise = self.clientJobs_.get(writer, {}).get(promiseId)
+        if resultPromise is not None:
+            resultPromise.cancel()
+
+
+class RemoteProcessManager:
+    """
+    Client of ProcessPoolServer, it has the same interface as MultiProcessManager used by the endpoints
+
+    NOTE:
+    - It must be used in the event loop thread that calls connect()
+    - Load (pending jobs, workers) is pushed by the pool, i.e. it is the load of the whole pool (all API processes)
+    - If the connection is lost, waiting jobs are resolved with error and the pool reports no worker (admission rejects)
+    - A job whose promise is done by others (e.g. request timeout) is aborted in the pool, i.e. it does not hold
+      a worker of the pool
+    """
+
+    CONNECT_TIMEOUT_SEC: Final[float] = 30
+    CONNECT_RETRY_SEC: Final[float] = 0.2
+
+    ## limit the instance variable
+    ## Why? avoid bugs some methods created wrong instance variable
+    __slots__ = (
+        "name",
+        "socketPath_",
+        "serviceTimes_",
+        "reader_",
+        "writer_",
+        "readerTask_",
+        "resultPromises_",
+        "resultJobTypes_",
+        "resultJobPages_",
+        "stageReceivers_",
+        "pendingJobs_",
+        "pendingPages_",
+        "activeWorkers_",
+    )
+
+    def __init__(self, name: str, socketPath: str, serviceTimes: Optional[ServiceTimeEstimator] = None):
+        self.name = name
+        self.socketPath_ = socketPath
+        self.serviceTimes_ = serviceTimes
+        self.reader_: Optional[asyncio.StreamReader] = None
+        self.writer_: Optional[asyncio.StreamWriter] = None
+        self.readerTask_: Optional[asyncio.Task] = None
+        self.resultPromises_: Dict[str, asyncio.Future[QueueJobResult]] = {}
+        self.resultJobTypes_: Dict[str, QueueJobType] = {}
+        self.resultJobPages_: Dict[str, int] = {}
+        self.stageReceivers_: Dict[str, Callable[[QueueJobResult], None]] = {}
+        self.pendingJobs_ = 0
+        self.pendingPages_ = 0
+        self.activeWorkers_ = 0
+
+    async def connect(self):
+        """
+        Connect to the pool, retry until the pool is listening (it may start later than this process)
+        """
+        funcName = self.connect.__name__
+        prefix = f"{self.name}.{funcName}[{self.socketPath_}]"
+        try:
+            deadlineSec = time.monotonic() + self.CONNECT_TIMEOUT_SEC
+            while True:
+                try:
+                    self.reader_, self.writer_ = await asyncio.open_unix_connection(self.socketPath_)
+                    break
+                except (FileNotFoundError, ConnectionRefusedError):
+                    if time.monotonic() >= deadlineSec:
+                        raise
+                    await asyncio.sleep(self.CONNECT_RETRY_SEC)
+            self.readerTask_ = asyncio.create_task(self.readerWorker_())
+            U.logI(f"{prefix} connected")
+        except Exception as e:
+            U.throwPrefix(prefix, e)
+
+    def pendingJobCount(self) -> int:
+        return max(self.pendingJobs_, sum([1 if not p.done() else 0 for p in self.resultPromises_.values()]))
+
+    def pendingPageCount(self) -> int:
+        localPendingPages = sum(
+            [self.resultJobPages_.get(k, 1) for k, p in self.resultPromises_.items() if not p.done()]
+        )
+        return max(self.pendingPages_, localPendingPages)
+
+    def activeWorkerCount(self) -> int:
+        return self.activeWorkers_
+
+    def enqueue(self, job: QueueJob):
+        funcName = self.enqueue.__name__
+        prefix = f"{funcName}[{job['id']}]"
+        try:
+            if self.writer_ is None or self.writer_.is_closing():
+                raise Exception(f"not connected to pool")
+            ## Reject early instead of a round trip, the pool rejects too (QUEUE_FULL) if other processes filled it
+            if self.pendingJobCount() >= self.activeWorkers_ + MultiProcessManager.JOB_QUEUE_MAX_SIZE:
+                raise queue.Full()
+
+            jobId = job["id"]
+            if jobId in self.resultPromises_:
+                raise Exception(f"jobId found in resultPromises_")
+            mpJob: MpQueueJob = {
+                "createEpms": job["createEpms"],
+                "id": jobId,
+                "jobData": job["jobData"],
+                "jobType": job["jobType"],
+                "promise": jobId,
+            }
+            if "onStage" in job:
+                mpJob["isStaged"] = True
+                self.stageReceivers_[jobId] = job["onStage"]
+            if "pages" in job:
+                mpJob["pages"] = job["pages"]
+            writeFrame(self.writer_, {"op": "enqueue", "job": mpJob})
+            self.resultPromises_[jobId] = job["promise"]
+            self.resultJobTypes_[jobId] = job["jobType"]
+            self.resultJobPages_[jobId] = jobPagesOf(job)
+            self.pendingJobs_ += 1
+            self.pendingPages_ += jobPagesOf(job)
+            job["promise"].add_done_callback(lambda _, jobId=jobId: self.onJobDone_(jobId))
+        except queue.Full:
+            ## NOTE: re-raise as it is, caller responds 503 for full queue
+            raise
+        except Exception as e:
+            U.throwPrefix(prefix, e)
+
+    async def stopAllProcesses(self, timeoutSec: float = 0):
+        """
+        Disconnect from the pool (the pool is owned and stopped by its own process)
+        """
+        if self.readerTask_ is not None:
+            self.readerTask_.cancel()
+        if self.writer_ is not None:
+            self.writer_.close()
+
+    async def readerWorker_(self):
+        funcName = self.readerWorker_.__name__
+        prefix = f"{self.name}.{funcName}"
+        try:
+            while True:
+                msg = await readFrame(self.reader_)
+                if msg["op"] == "load":
+                    self.pendingJobs_ = msg["pendingJobs"]
+                    self.pendingPages_ = msg["pendingPages"]
+                    self.activeWorkers_ = msg["activeWorkers"]
+                elif msg["op"] == "result":
+                    self.onResult_(msg["promiseId"], msg["result"])
+                elif msg["op"] == "stage":
+                    onStage = self.stageReceivers_.get(msg["promiseId"])
+                    if onStage is not None:
+                        onStage(msg["result"])
+        except asyncio.CancelledError:
+            pass
+        except asyncio.IncompleteReadError:
+            U.logW(f"{prefix} disconnected from pool")
+        except Exception as e:
+            U.logPrefixE(prefix, e)
+        finally:
+            ## jobs waiting for results of the lost connection
+            self.activeWorkers_ = 0
+            for promiseId in list(self.resultPromises_.keys()):
+                self.onResult_(
+                    promiseId, errorResult(QueueJobErrCode.ERR, "error processing job request (pool disconnected)")
+                )
+
+    def onJobDone_(self, jobId: str):
+        ## NOTE: a result removes the promise first, i.e. a promise still kept is done by others (cancelled)
+        if jobId not in self.resultPromises_:
+            return
+        self.resultPromises_.pop(jobId, None)
+        self.resultJobTypes_.pop(jobId, None)
+        self.resultJobPages_.pop(jobId, None)
+        self.stageReceivers_.pop(jobId, None)
+        if self.writer_ is not None and not self.writer_.is_closing():
+            writeFrame(self.writer_, {"op": "abort", "promiseId": jobId})
+
+    def onResult_(self, promiseId: str, result: QueueJobResult):
+        promise = self.resultPromises_.pop(promiseId, None)
+        jobType = self.resultJobTypes_.pop(promiseId, None)
+        jobPages = self.resultJobPages_.pop(promiseId, 1)
+        self.stageReceivers_.pop(promiseId, None)
+        if promise is None:
+            return
+        ## record service time for admission control
+        if self.serviceTimes_ is not None and jobType is not None and result["errCode"] == "":
+            self.serviceTimes_.record(jobType, result["processElapsedMs"], jobPages)
+        if not promise.done():
+            promise.set_result(result)
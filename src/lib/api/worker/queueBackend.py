@@ -0,0 +1,269 @@
+import os
+import json
+import time
+import queue
+import socket
+import sqlite3
+import multiprocessing
+from abc import ABC, abstractmethod
+from typing import Final, List, Dict, Any, Optional
+
+import util as U
+
+
+class QueueBackend(ABC):
+    """
+    Interface of a job/result queue used by MultiProcessManager and MultiProcessWorker
+
+    NOTE:
+    - put()/get() follow queue.Queue, i.e. raise queue.Full/queue.Empty
+    - Instances must be picklable since they are passed to worker processes
+    - A shared backend (isShared() is True) lets several API nodes submit to one pool of workers,
+      each node receives its results from its own named queue, refer to named()
+    - put()/get()/qsize()/named() are abstract, i.e. an incomplete backend fails on instantiation
+    """
+
+    @abstractmethod
+    def put(self, item: Any, block: bool = True, timeout: Optional[float] = None):
+        pass
+
+    @abstractmethod
+    def get(self, block: bool = True, timeout: Optional[float] = None) -> Any:
+        pass
+
+    @abstractmethod
+    def qsize(self) -> int:
+        pass
+
+    def isShared(self) -> bool:
+        return False
+
+    @abstractmethod
+    def named(self, queueName: str) -> "QueueBackend":
+        """
+        Get another queue of the same store, e.g. result queue of an API node
+        """
+
+    def workerEnd(self, workerName: str, runningJobId: Optional[Any] = None) -> "QueueBackend":
+        """
+        Queue a worker process reads its jobs from and puts its results to (default: this queue, shared by all workers)
+
+        Args:
+            runningJobId: multiprocessing.RawArray("c") the worker keeps the id of its running job in (if any)
+        """
+        return self
+
+    def heartbeat(self, workerName: str, isRunningJob: bool):
+        """
+        Worker reports it is alive, it is called periodically from the worker loop
+        """
+        pass
+
+    def activeWorkerCount(self) -> Optional[int]:
+        """
+        No. of alive workers of the queue (None if unknown, i.e. only local workers)
+        """
+        return None
+
+    def close(self):
+        """
+        Release resources of this process, items not yet consumed are discarded
+        """
+        pass
+
+    def flush(self):
+        """
+        Wait until items put by this process are sent, e.g. before the process exits by os._exit()
+        """
+        pass
+
+
+class InMemoryQueueBackend(QueueBackend):
+    """
+    Queue shared by the processes of one API process, i.e. multiprocessing.Queue
+    """
+
+    ## limit the instance variable
+    ## Why? avoid bugs some methods created wrong instance variable
+    __slots__ = ("queue_",)
+
+    def __init__(self, maxSize: int = 0):
+        self.queue_: multiprocessing.Queue = multiprocessing.Queue(maxsize=maxSize)
+
+    def put(self, item: Any, block: bool = True, timeout: Optional[float] = None):
+        self.queue_.put(item, block=block, timeout=timeout)
+
+    def get(self, block: bool = True, timeout: Optional[float] = None) -> Any:
+        return self.queue_.get(block=block, timeout=timeout)
+
+    def qsize(self) -> int:
+        try:
+            return self.queue_.qsize()
+        except NotImplementedError:
+            ## NOTE: qsize() is not implemented on macOS
+            return 0
+
+    def named(self, queueName: str) -> "QueueBackend":
+        ## NOTE: not shared, i.e. no job has replyTo
+        raise Exception(f"{type(self).__name__} is not shared, no named queue[{queueName}]")
+
+    def close(self):
+        ## NOTE: without cancel_join_thread(), exit waits for the feeder thread to flush items nobody consumes
+        self.queue_.close()
+        self.queue_.cancel_join_thread()
+
+    def flush(self):
+        ## NOTE: the feeder thread sends the items in background, join_thread() waits until it is done
+        self.queue_.close()
+        self.queue_.join_thread()
+
+
+class SqliteQueueBackend(QueueBackend):
+    """
+    Queue stored in a SQLite db file, so that several API processes/nodes (same host or shared volume)
+    submit to and receive results from a shared pool of workers
+
+    NOTE:
+    - Items are json encoded, i.e. MpQueueJob and (promiseId, QueueJobResult)
+    - get() claims the oldest item in an immediate transaction, thus an item is delivered to exactly one consumer
+    - get() polls the db, poll interval grows from POLL_MIN_SEC to POLL_MAX_SEC while the queue is empty
+    - db connection is opened lazily per process (connection is not picklable nor fork safe)
+    """
+
+    POLL_MIN_SEC: Final[float] = 0.01
+    POLL_MAX_SEC: Final[float] = 0.2
+    ## NOTE: worker sends no heartbeat while it is running a job, thus expiry must be longer than a typical job
+    HEARTBEAT_EXPIRY_MS: Final[int] = 60 * 1000
+
+    ## limit the instance variable
+    ## Why? avoid bugs some methods created wrong instance variable
+    __slots__ = ("dbPath_", "queueName_", "maxSize_", "conn_", "connPid_")
+
+    def __init__(self, dbPath: str, queueName: str, maxSize: int = 0):
+        funcName = f"{SqliteQueueBackend.__name__}.ctor"
+        prefix = funcName
+        try:
+            self.dbPath_ = dbPath
+            self.queueName_ = queueName
+            self.maxSize_ = maxSize
+            self.conn_: Optional[sqlite3.Connection] = None
+            self.connPid_ = 0
+            self.conn()
+        except Exception as e:
+            U.throwPrefix(prefix, e)
+
+    def __getstate__(self):
+        return {"dbPath_": self.dbPath_, "queueName_": self.queueName_, "maxSize_": self.maxSize_}
+
+    def __setstate__(self, state: Dict[str, Any]):
+        self.dbPath_ = state["dbPath_"]
+        self.queueName_ = state["queueName_"]
+        self.maxSize_ = state["maxSize_"]
+        self.conn_ = None
+        self.connPid_ = 0
+
+    def conn(self) -> sqlite3.Connection:
+        if self.conn_ is None or self.connPid_ != os.getpid():
+            dbDir = os.path.dirname(self.dbPath_)
+            if dbDir != "":
+                os.makedirs(dbDir, exist_ok=True)
+            ## isolation_level=None: transactions are explicit, i.e. BEGIN IMMEDIATE
+            conn = sqlite3.connect(self.dbPath_, timeout=10, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS queueItems ("
+                "seq INTEGER PRIMARY KEY AUTOINCREMENT, queueName TEXT NOT NULL, payload TEXT NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS queueItemsByName ON queueItems (queueName, seq)")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS workers ("
+                "workerKey TEXT PRIMARY KEY, queueName TEXT NOT NULL, isRunningJob INTEGER, lastSeenEpms INTEGER)"
+            )
+            self.conn_ = conn
+            self.connPid_ = os.getpid()
+        return self.conn_
+
+    def isShared(self) -> bool:
+        return True
+
+    def named(self, queueName: str) -> "SqliteQueueBackend":
+        return SqliteQueueBackend(self.dbPath_, queueName)
+
+    def put(self, item: Any, block: bool = True, timeout: Optional[float] = None):
+        payload = json.dumps(item)
+        conn = self.conn()
+        deadlineSec = None if timeout is None else time.monotonic() + timeout
+        pollSec = self.POLL_MIN_SEC
+        while True:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                if self.maxSize_ > 0:
+                    (count,) = conn.execute(
+                        "SELECT COUNT(*) FROM queueItems WHERE queueName=?", (self.queueName_,)
+                    ).fetchone()
+                    if count >= self.maxSize_:
+                        conn.execute("ROLLBACK")
+                        if not block or (deadlineSec is not None and time.monotonic() >= deadlineSec):
+                            raise queue.Full()
+                        time.sleep(pollSec)
+                        pollSec = min(pollSec * 2, self.POLL_MAX_SEC)
+                        continue
+                conn.execute("INSERT INTO queueItems (queueName, payload) VALUES (?, ?)", (self.queueName_, payload))
+                conn.execute("COMMIT")
+                return
+            except queue.Full:
+                raise
+            except Exception:
+                if conn.in_transaction:
+                    conn.execute("ROLLBACK")
+                raise
+
+    def get(self, block: bool = True, timeout: Optional[float] = None) -> Any:
+        conn = self.conn()
+        deadlineSec = None if timeout is None else time.monotonic() + timeout
+        pollSec = self.POLL_MIN_SEC
+        while True:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute(
+                    "SELECT seq, payload FROM queueItems WHERE queueName=? ORDER BY seq LIMIT 1", (self.queueName_,)
+                ).fetchone()
+                if row is not None:
+                    conn.execute("DELETE FROM queueItems WHERE seq=?", (row[0],))
+                conn.execute("COMMIT")
+            except Exception:
+                if conn.in_transaction:
+                    conn.execute("ROLLBACK")
+                raise
+            if row is not None:
+                return json.loads(row[1])
+            if not block or (deadlineSec is not None and time.monotonic() >= deadlineSec):
+                raise queue.Empty()
+            time.sleep(pollSec)
+            pollSec = min(pollSec * 2, self.POLL_MAX_SEC)
+
+    def qsize(self) -> int:
+        (count,) = (
+            self.conn().execute("SELECT COUNT(*) FROM queueItems WHERE queueName=?", (self.queueName_,)).fetchone()
+        )
+        return count
+
+    def heartbeat(self, workerName: str, isRunningJob: bool):
+        ## worker name is only unique in its host, thus host and pid are part of the key
+        workerKey = f"{socket.gethostname()}:{os.getpid()}:{workerName}"
+        self.conn().execute(
+            "INSERT OR REPLACE INTO workers (workerKey, queueName, isRunningJob, lastSeenEpms) VALUES (?, ?, ?, ?)",
+            (workerKey, self.queueName_, 1 if isRunningJob else 0, U.epochMs()),
+        )
+
+    def activeWorkerCount(self) -> Optional[int]:
+        (count,) = (
+            self.conn()
+            .execute(
+                "SELECT COUNT(*) FROM workers WHERE queueName=? AND lastSeenEpms>=?",
+                (self.queueName_, U.epochMs() - self.HEARTBEAT_EXPIRY_MS),
+            )
+            .fetchone()
+        )
+        return count
@@ -0,0 +1,117 @@
+import os
+import multiprocessing
+from typing import Final, TypedDict
+
+import util as U
+
+
+class RenderBudgetStats(TypedDict):
+    maxThreads: int
+    threadsInUse: int
+    activeJobs: int
+
+
+class RenderBudget:
+    """
+    Global budget of concurrent renderer subprocesses (pdftoppm) of all workers (threads and processes)
+
+    NOTE:
+    - Each render acquires threads before it starts, i.e. total renderer subprocesses never exceed maxThreads
+    - Granted threads adapt to the load: a job gets up to threadsPerJob when idle, down to 1 when busy
+      (fair share maxThreads / activeJobs), thus N workers x thread_count cannot oversubscribe the CPUs
+    - A render waits if the budget is used up
+    - Counters are in shared memory, the budget is shared by the processes started with it (pass it to the Process)
+    - Threads held by each process are tracked (up to MAX_HOLDERS processes), thus the threads of a process killed
+      in a render are given back by reclaim(pid), e.g. when the process is respawned
+    """
+
+    DEFAULT_THREADS_PER_JOB: Final[int] = 4
+    MAX_HOLDERS: Final[int] = 256
+
+    ## limit the instance variable
+    ## Why? avoid bugs some methods created wrong instance variable
+    __slots__ = ("maxThreads", "threadsPerJob", "cond_", "threadsInUse_", "activeJobs_", "holders_")
+
+    def __init__(self, maxThreads: int, threadsPerJob: int = DEFAULT_THREADS_PER_JOB):
+        funcName = f"{RenderBudget.__name__}.ctor"
+        prefix = funcName
+        try:
+            if maxThreads < 1 or threadsPerJob < 1:
+                raise Exception(f"invalid maxThreads={maxThreads}, threadsPerJob={threadsPerJob}")
+            self.maxThreads = maxThreads
+            self.threadsPerJob = threadsPerJob
+
+            ## NOTE: RawValue has no lock of its own, both are guarded by cond_
+            self.cond_ = multiprocessing.Condition()
+            self.threadsInUse_ = multiprocessing.RawValue("i", 0)
+            self.activeJobs_ = multiprocessing.RawValue("i", 0)
+            ## (pid, threads, jobs) of each process holding threads, pid 0 is a free slot
+            self.holders_ = multiprocessing.RawArray("i", self.MAX_HOLDERS * 3)
+        except Exception as e:
+            U.throwPrefix(prefix, e)
+
+    def acquire(self) -> int:
+        """
+        Wait until the budget has a free thread
+
+        Returns:
+            no. of threads granted to the render (thread_count), it must be given back by release()
+        """
+        with self.cond_:
+            while self.threadsInUse_.value >= self.maxThreads:
+                self.cond_.wait()
+            fairShare = max(1, self.maxThreads // (self.activeJobs_.value + 1))
+            threads = min(self.threadsPerJob, fairShare, self.maxThreads - self.threadsInUse_.value)
+            self.threadsInUse_.value += threads
+            self.activeJobs_.value += 1
+            self.hold_(os.getpid(), threads, 1)
+            return threads
+
+    def release(self, threads: int):
+        with self.cond_:
+            self.threadsInUse_.value -= threads
+            self.activeJobs_.value -= 1
+            self.hold_(os.getpid(), -threads, -1)
+            self.cond_.notify_all()
+
+    def reclaim(self, pid: int) -> int:
+        """
+        Give back the threads held by a process that exited (e.g. killed in a render)
+
+        Returns:
+            no. of threads given back
+        """
+        with self.cond_:
+            for i in range(0, len(self.holders_), 3):
+                if self.holders_[i] == pid:
+                    threads, jobs = self.holders_[i + 1], self.holders_[i + 2]
+                    self.threadsInUse_.value -= threads
+                    self.activeJobs_.value -= jobs
+                    self.holders_[i : i + 3] = [0, 0, 0]
+                    self.cond_.notify_all()
+                    return threads
+            return 0
+
+    def hold_(self, pid: int, threads: int, jobs: int):
+        ## NOTE: it must be called with cond_ held
+        freeIdx = -1
+        for i in range(0, len(self.holders_), 3):
+            if self.holders_[i] == pid:
+                self.holders_[i + 1] += threads
+                self.holders_[i + 2] += jobs
+                if self.holders_[i + 2] <= 0:
+                    self.holders_[i : i + 3] = [0, 0, 0]
+                return
+            if freeIdx < 0 and self.holders_[i] == 0:
+                freeIdx = i
+        ## NOTE: more than MAX_HOLDERS processes, the threads of this process cannot be reclaimed
+        if freeIdx >= 0 and jobs > 0:
+            self.holders_[freeIdx : freeIdx + 3] = [pid, threads, jobs]
+
+    def stats(self) -> RenderBudgetStats:
+        with self.cond_:
+            return {
+                "maxThreads": self.maxThreads,
+                "threadsInUse": self.threadsInUse_.value,
+                "activeJobs": self.activeJobs_.value,
+            }
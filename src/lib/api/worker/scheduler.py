@@ -0,0 +1,84 @@
+import time
+import heapq
+import queue
+import itertools
+from typing import Final, List, Tuple, Union
+
+from .types import MpQueueJob, QueueJob, QueueJobType
+from .admission import jobPagesOf
+from .jobHandlers import PDF2IMAGE_DEFAULT_DPI
+
+## Scheduling policy of a job queue
+## - "fifo": jobs are served in arrival order
+## - "sjf": shortest expected job first, with aging (refer to CostQueue)
+SCHEDULING_POLICIES: Final[Tuple[str, ...]] = ("fifo", "sjf")
+
+## ms of waiting that compensate 1 unit of cost (refer to CostQueue)
+SCHEDULING_AGING_MS: Final[int] = 500
+
+
+def jobCostOf(job: Union[QueueJob, MpQueueJob]) -> float:
+    """
+    Expected cost of a job, i.e. pages (refer to jobPagesOf) x dpi relative to PDF2IMAGE_DEFAULT_DPI
+
+    NOTE: 1 is a page at the default dpi, a job without page count (e.g. message) is 1
+    """
+    cost = float(jobPagesOf(job))
+    if job["jobType"] == QueueJobType.PDF2IMAGE:
+        cost *= job["jobData"].get("dpi", PDF2IMAGE_DEFAULT_DPI) / PDF2IMAGE_DEFAULT_DPI
+    return cost
+
+
+class CostQueue(queue.Queue):
+    """
+    queue.Queue serving the job of the lowest expected cost first (refer to jobCostOf), with aging
+
+    NOTE:
+    - Priority of a job is enqueueMs + cost x agingMs, i.e. a job waiting longer gains on cheaper jobs
+      and a cheaper job overtakes it only if it arrives less than (cost difference x agingMs) later.
+      Thus a 500-page job is never starved, it waits for at most 500 x agingMs of cheaper arrivals
+    - The priority is fixed on put() (waiting time is relative), thus a heap keeps the order
+    - Jobs of the same priority are served in arrival order
+    - Same interface as queue.Queue (put/get/qsize/mutex), thus a drop-in job queue of thread workers
+    """
+
+    ## limit the instance variable
+    ## Why? avoid bugs some methods created wrong instance variable
+    __slots__ = ("agingMs_", "seq_")
+
+    def __init__(self, maxsize: int = 0, agingMs: int = SCHEDULING_AGING_MS):
+        self.agingMs_ = agingMs
+        self.seq_ = itertools.count()
+        super().__init__(maxsize)
+
+    def jobs(self) -> List[Union[QueueJob, MpQueueJob]]:
+        """
+        Queued jobs (not in service order), the caller must hold .mutex
+        """
+        return [entry[2] for entry in self.queue]
+
+    ## NOTE: _init/_qsize/_put/_get are the extension points of queue.Queue (same as queue.PriorityQueue),
+    ## they are called with .mutex held
+    def _init(self, maxsize: int):
+        self.queue: List[Tuple[float, int, Union[QueueJob, MpQueueJob]]] = []
+
+    def _qsize(self) -> int:
+        return len(self.queue)
+
+    def _put(self, job: Union[QueueJob, MpQueueJob]):
+        priority = time.monotonic() * 1000 + jobCostOf(job) * self.agingMs_
+        heapq.heappush(self.queue, (priority, next(self.seq_), job))
+
+    def _get(self) -> Union[QueueJob, MpQueueJob]:
+        return heapq.heappop(self.queue)[2]
+
+
+def newJobQueue(policy: str, maxSize: int = 0, agingMs: int = SCHEDULING_AGING_MS) -> queue.Queue:
+    """
+    Job queue of thread workers by scheduling policy (refer to SCHEDULING_POLICIES)
+    """
+    if policy == "sjf":
+        return CostQueue(maxSize, agingMs)
+    if policy == "fifo":
+        return queue.Queue(maxSize)
+    raise Exception(f"invalid scheduling policy={policy}")
@@ -0,0 +1,164 @@
+import os
+import json
+import time
+import asyncio
+from collections import OrderedDict
+from typing import Final, List, Dict, Tuple, Optional
+
+import util as U
+from .types import QueueJob, QueueJobResult
+
+
+class Flight:
+    """
+    One execution of a job shared by all requests waiting for it
+    """
+
+    ## limit the instance variable
+    ## Why? avoid bugs some methods created wrong instance variable
+    __slots__ = ("key", "jobId", "promise", "waiters", "isKeepAlive", "stages")
+
+    def __init__(self, key: str, jobId: str, promise: asyncio.Future[QueueJobResult], isKeepAlive: bool):
+        self.key = key
+        self.jobId = jobId
+        self.promise = promise
+        self.waiters = 0
+        ## True=keep running even if all waiters are gone (e.g. a retry with the same idempotency key may wait again)
+        self.isKeepAlive = isKeepAlive
+        ## Stage results received so far (e.g. preview of a progressive job), refer to QueueJob.onStage
+        self.stages: List[QueueJobResult] = []
+
+
+class SingleFlight:
+    """
+    Coalesce concurrent identical jobs so that they share one execution
+
+    NOTE:
+    - A flight is keyed by content hash of the input file + job type + job parameters
+    - A client-supplied idempotency key maps to a flight, its result is kept for IDEMPOTENCY_TTL_SEC
+      so that a retry (e.g. after 504) gets the result of the original execution
+    - All methods must be called in the event loop thread, thus no lock is needed
+    """
+
+    IDEMPOTENCY_TTL_SEC: Final[float] = 10 * 60
+    HASH_CACHE_MAX_SIZE: Final[int] = 1024
+
+    ## limit the instance variable
+    ## Why? avoid bugs some methods created wrong instance variable
+    __slots__ = ("flights_", "idempotentFlights_", "hashCache_", "idempotencyTtlSec_")
+
+    def __init__(self, idempotencyTtlSec: float = IDEMPOTENCY_TTL_SEC):
+        self.flights_: Dict[str, Flight] = {}
+        ## idempotency key -> (flight, expirySec), in insertion order, i.e. expiry order
+        self.idempotentFlights_: OrderedDict[str, Tuple[Flight, float]] = OrderedDict()
+        ## (filePath, size, mtime) -> sha256
+        self.hashCache_: OrderedDict[Tuple[str, int, int], str] = OrderedDict()
+        self.idempotencyTtlSec_ = idempotencyTtlSec
+
+    async def contentHashOf(self, filePath: str) -> str:
+        """
+        Get sha256 of file content, cached by file path/size/mtime
+        """
+        funcName = self.contentHashOf.__name__
+        prefix = f"{funcName}[{filePath}]"
+        try:
+            st = os.stat(filePath)
+            cacheKey = (os.path.abspath(filePath), st.st_size, st.st_mtime_ns)
+            contentHash = self.hashCache_.get(cacheKey)
+            if contentHash is None:
+                ## Hashing a large file blocks, thus run it in pool thread
+                contentHash = await asyncio.to_thread(U.fileSha256, filePath)
+                self.hashCache_[cacheKey] = contentHash
+                if len(self.hashCache_) > self.HASH_CACHE_MAX_SIZE:
+                    self.hashCache_.popitem(last=False)
+            else:
+                self.hashCache_.move_to_end(cacheKey)
+            return contentHash
+        except Exception as e:
+            U.throwPrefix(prefix, e)
+
+    def flightKeyOf(self, contentHash: str, job: QueueJob) -> str:
+        ## file path is excluded since identical content in different paths is the same job
+        jobParams = {k: v for k, v in job["jobData"].items() if k != "pdfFilePath"}
+        return f"{contentHash}|{job['jobType'].value}|{json.dumps(jobParams, sort_keys=True, default=str)}"
+
+    def find(self, flightKey: str, idempotencyKey: str = "") -> Optional[Flight]:
+        """
+        Find the flight to join
+
+        Returns:
+            Flight, its promise may already be done (result kept for idempotency key); None if not found
+        """
+        ## housekeeping: expired idempotency keys are at the front
+        nowSec = time.monotonic()
+        while len(self.idempotentFlights_) > 0:
+            oldestKey, (_, expirySec) = next(iter(self.idempotentFlights_.items()))
+            if expirySec > nowSec:
+                break
+            del self.idempotentFlights_[oldestKey]
+
+        if idempotencyKey != "" and idempotencyKey in self.idempotentFlights_:
+            flight, _ = self.idempotentFlights_[idempotencyKey]
+            if flight.key == flightKey:
+                return flight
+            ## same idempotency key is reused for a different job, the new job replaces it
+            U.logW(f"idempotencyKey[{idempotencyKey}] reused for a different job, ignored")
+            del self.idempotentFlights_[idempotencyKey]
+
+        return self.flights_.get(flightKey)
+
+    @staticmethod
+    def collectStages(job: QueueJob) -> List[QueueJobResult]:
+        """
+        Collect stage results of a job (before it is submitted), pass the list to start()
+        """
+        stages: List[QueueJobResult] = []
+        job["onStage"] = stages.append
+        return stages
+
+    def start(
+        self, flightKey: str, job: QueueJob, idempotencyKey: str = "", stages: Optional[List[QueueJobResult]] = None
+    ) -> Flight:
+        """
+        Start a flight for the job (job must have been submitted to the worker)
+
+        Args:
+            stages: stage results of the job, refer to collectStages()
+        """
+        flight = Flight(flightKey, job["id"], job["promise"], idempotencyKey != "")
+        if stages is not None:
+            flight.stages = stages
+        self.flights_[flightKey] = flight
+        if idempotencyKey != "":
+            self.idempotentFlights_[idempotencyKey] = (flight, time.monotonic() + self.idempotencyTtlSec_)
+        job["promise"].add_done_callback(lambda _: self.onFlightDone_(flight, idempotencyKey))
+        return flight
+
+    def onFlightDone_(self, flight: Flight, idempotencyKey: str):
+        if self.flights_.get(flight.key) is flight:
+            del self.flights_[flight.key]
+
+        ## Failed job is not kept for idempotency key, thus a retry executes it again
+        promise = flight.promise
+        isFailed = promise.cancelled() or promise.exception() is not None or promise.result()["errCode"] != ""
+        if idempotencyKey != "" and isFailed:
+            entry = self.idempotentFlights_.get(idempotencyKey)
+            if entry is not None and entry[0] is flight:
+                del self.idempotentFlights_[idempotencyKey]
+
+    async def wait(self, flight: Flight) -> QueueJobResult:
+        """
+        Wait for the flight result
+
+        NOTE:
+        - The shared promise is shielded, thus timeout of one waiter does not cancel the others
+        - When the last waiter is gone, the promise is canceled so that the worker discards the job,
+          unless the flight is kept alive for idempotency key
+        """
+        flight.waiters += 1
+        try:
+            return await asyncio.shield(flight.promise)
+        finally:
+            flight.waiters -= 1
+            if flight.waiters == 0 and not flight.isKeepAlive and not flight.promise.done():
+                flight.promise.cancel()
@@ -13,6 +13,16 @@ class QueueEventType(str, Enum):
     STOP = "stop"
 
 
+class QueueJobErrCode(str, Enum):
+    ERR = "err"
+    ## job is not completed because the server is shutting down (it is replayed on restart if journal is enabled)
+    SHUTDOWN = "shutdown"
+    ## job is rejected by a full queue of a shared pool (refer to ProcessPoolServer)
+    QUEUE_FULL = "queueFull"
+    ## job exceeded the execution budget of its job type or nobody waits for its result, it is aborted
+    TIMEOUT = "timeout"
+
+
 class QueueJobEvent(TypedDict):
     tag: Literal[QueueJobType.EVENT]
     action: QueueEventType
@@ -27,6 +37,28 @@ class QueueJobMessage(TypedDict):
 class QueueJobPdf2Image(TypedDict):
     tag: Literal[QueueJobType.PDF2IMAGE]
     pdfFilePath: str
+    ## False: output is streamed to the client and removed afterwards (default: True)
+    persist: NotRequired[bool]
+    ## Pages to render, e.g. "1-3,5" (starts from 1, default: all pages)
+    pages: NotRequired[str]
+    ## Resolution of pages (default: PDF2IMAGE_DEFAULT_DPI)
+    dpi: NotRequired[int]
+    ## Longest side of a page in pixels, e.g. thumbnails (default: by dpi)
+    size: NotRequired[int]
+    grayscale: NotRequired[bool]
+    ## Progressive: pages are rendered at previewDpi first (stage "preview"), then at dpi
+    previewDpi: NotRequired[int]
+    ## No. of first pages of the preview (default: all pages)
+    previewPages: NotRequired[int]
+    ## Page count of the pdf probed on submit (refer to PdfInfoCache), the worker does not probe it again
+    pdfPages: NotRequired[int]
+
+
+class PdfInfo(TypedDict):
+    pages: int
+    ## (width, height) of each page in points
+    pageSizes: List[Tuple[float, float]]
+    isEncrypted: bool
 
 
 class QueueJob(TypedDict):
@@ -35,6 +67,14 @@ class QueueJob(TypedDict):
     jobType: QueueJobType
     jobData: Union[QueueJobMessage, QueueJobPdf2Image, QueueJobEvent]
     promise: asyncio.Future["QueueJobResult"]
+    ## Called in the event loop thread with the result of each stage before the final result (e.g. progressive render)
+    onStage: NotRequired[Callable[["QueueJobResult"], None]]
+    ## Metadata of the pdf of a pdf2image job (refer to PdfInfoCache)
+    pdfInfo: NotRequired[PdfInfo]
+    ## Cost of the job in pages for dispatch, admission and service times (default: 1, e.g. message or unknown page count)
+    pages: NotRequired[int]
+    ## Tenant of the job for fair queuing (refer to FairExecutor), it is not passed to workers
+    tenant: NotRequired[str]
 
 
 class MpQueueJob(TypedDict):
@@ -44,6 +84,12 @@ class MpQueueJob(TypedDict):
     jobData: Union[QueueJobMessage, QueueJobPdf2Image, QueueJobEvent]
     ## An string id to represent a promise
     promise: str
+    ## Name of the result queue of the API node that submits the job (shared queue backend only)
+    replyTo: NotRequired[str]
+    ## True: stage results are sent before the final result (refer to QueueJob.onStage)
+    isStaged: NotRequired[bool]
+    ## refer to QueueJob.pages
+    pages: NotRequired[int]
 
 
 class QueueJobResult(TypedDict):
@@ -54,3 +100,5 @@ class QueueJobResult(TypedDict):
     dequeueElapsedMs: int
     processElapsedMs: int
     totalElapsedMs: int
+    ## Stage of an intermediate result (e.g. "preview"), absent for the final result
+    stage: NotRequired[str]
@@ -1 +1,2 @@
+from .config import *
 from .server import *
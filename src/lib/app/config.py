@@ -0,0 +1,173 @@
+import os
+import json
+from typing import Final, Dict, Any, TypedDict, List, Tuple
+
+import util as U
+from api.worker import SCHEDULING_POLICIES, SCHEDULING_AGING_MS
+
+
+class ServerConfig(TypedDict):
+    ## CPUs this process can use (affinity, cgroup quota) or no. of workerCpus, defaults below are derived from it
+    cpuCount: int
+    ## message workers share one queue
+    messageWorkerCount: int
+    messageWorkerMaxQSize: int
+    ## Batch mode of the message worker (1: off), up to messageWorkerBatchMaxJobs jobs per batch,
+    ## waits up to messageWorkerBatchWaitMs for more jobs after the first one (refer to QueueWorkerOpts)
+    messageWorkerBatchMaxJobs: int
+    messageWorkerBatchWaitMs: int
+    pdfWorkerCount: int
+    pdfWorkerMaxQSize: int
+    mpWorkerCount: int
+    inlineMaxConcurrency: int
+    ## pdftoppm subprocesses of one render when the server is idle
+    renderThreadsPerJob: int
+    ## max concurrent pdftoppm subprocesses of all workers
+    renderThreadBudget: int
+    ## CPU affinity, empty means not pinned
+    ## - apiCpus: reserved for the event loop thread of API processes
+    ## - workerCpus: thread/process workers and their renderer subprocesses (default: usable CPUs except apiCpus)
+    apiCpus: List[int]
+    workerCpus: List[int]
+    ## "core": each process worker is pinned to one cpu of workerCpus (round robin), "set": all of workerCpus
+    workerPinning: str
+    ## Scheduling policy of the pdf thread pool and the pdf process pool, refer to SCHEDULING_POLICIES
+    ## - "fifo": arrival order
+    ## - "sjf": shortest expected job first (pages x dpi), with aging (schedulingAgingMs per unit of cost)
+    pdfThreadScheduling: str
+    pdfProcessScheduling: str
+    schedulingAgingMs: int
+    ## Per-tenant fair queuing in front of the pdf pools, "off" or "drr" (deficit round robin, refer to FairExecutor)
+    ## - tenantMaxInFlight: jobs of a tenant running at the same time (0: half of the workers of the pool)
+    ## - tenantMaxQueued: jobs of a tenant waiting, more are rejected (429)
+    ## - tenantQuantum: cost (pages at the default dpi) a tenant is given per round
+    fairQueuing: str
+    tenantMaxInFlight: int
+    tenantMaxQueued: int
+    tenantQuantum: int
+    ## Hedged execution of message jobs (messageThreads and inline executors), "off" or "on" (refer to HedgedExecutor)
+    ## - hedgingPercentile: a duplicate is sent after this percentile of recent elapsed ms, at least hedgingMinDelayMs
+    ## - hedgingBudgetPercent: max duplicates in percent of the jobs
+    hedging: str
+    hedgingPercentile: int
+    hedgingMinDelayMs: int
+    hedgingBudgetPercent: int
+
+
+## config key -> env name (same as the FastApiServer constant)
+SERVER_CONFIG_ENV_NAMES: Final[Dict[str, str]] = {
+    "cpuCount": "CPU_COUNT",
+    "messageWorkerCount": "MESSAGE_WORKER_COUNT",
+    "messageWorkerMaxQSize": "MESSAGE_WORKER_MAX_QSIZE",
+    "messageWorkerBatchMaxJobs": "MESSAGE_WORKER_BATCH_MAX_JOBS",
+    "messageWorkerBatchWaitMs": "MESSAGE_WORKER_BATCH_WAIT_MS",
+    "pdfWorkerCount": "PDF_WORKER_COUNT",
+    "pdfWorkerMaxQSize": "PDF_WORKER_MAX_QSIZE",
+    "mpWorkerCount": "MP_WORKER_COUNT",
+    "inlineMaxConcurrency": "INLINE_MAX_CONCURRENCY",
+    "renderThreadsPerJob": "RENDER_THREADS_PER_JOB",
+    "renderThreadBudget": "RENDER_THREAD_BUDGET",
+    "apiCpus": "API_CPUS",
+    "workerCpus": "WORKER_CPUS",
+    "workerPinning": "WORKER_PINNING",
+    "pdfThreadScheduling": "PDF_THREAD_SCHEDULING",
+    "pdfProcessScheduling": "PDF_PROCESS_SCHEDULING",
+    "schedulingAgingMs": "SCHEDULING_AGING_MS",
+    "fairQueuing": "FAIR_QUEUING",
+    "tenantMaxInFlight": "TENANT_MAX_IN_FLIGHT",
+    "tenantMaxQueued": "TENANT_MAX_QUEUED",
+    "tenantQuantum": "TENANT_QUANTUM",
+    "hedging": "HEDGING",
+    "hedgingPercentile": "HEDGING_PERCENTILE",
+    "hedgingMinDelayMs": "HEDGING_MIN_DELAY_MS",
+    "hedgingBudgetPercent": "HEDGING_BUDGET_PERCENT",
+}
+
+
+def loadServerConfig() -> ServerConfig:
+    """
+    Load pool sizes and render budget, in the order of precedence
+    1. env, e.g. PDF_WORKER_COUNT=4 (refer to SERVER_CONFIG_ENV_NAMES)
+    2. json file of env SERVER_CONFIG_PATH, e.g. {"pdfWorkerCount": 4}
+    3. defaults derived from the CPUs (util.cpuCount())
+
+    NOTE:
+    - defaults of a key may depend on other keys, e.g. queue size of pdf workers is 2x pdfWorkerCount
+    - cpu lists are in taskset format, e.g. API_CPUS="0-1", WORKER_CPUS="2-7"
+    - if workerCpus is set, pool sizes default to the no. of worker cpus
+    """
+    funcName = loadServerConfig.__name__
+    prefix = funcName
+    try:
+        overrides: Dict[str, Any] = {}
+        configPath = os.environ.get("SERVER_CONFIG_PATH", "")
+        if configPath != "":
+            with open(configPath) as f:
+                overrides.update(json.load(f))
+        for key, envName in SERVER_CONFIG_ENV_NAMES.items():
+            if envName in os.environ:
+                overrides[key] = os.environ[envName]
+        unknownKeys = [k for k in overrides if k not in SERVER_CONFIG_ENV_NAMES]
+        if len(unknownKeys) > 0:
+            raise Exception(f"unknown config keys={unknownKeys}")
+
+        def valueOf(key: str, default: int, minValue: int = 1) -> int:
+            value = int(overrides.get(key, default))
+            if value < minValue:
+                raise Exception(f"invalid {key}={value}, min={minValue}")
+            return value
+
+        def cpusOf(key: str, default: List[int]) -> List[int]:
+            value = overrides.get(key, default)
+            cpus = U.parseCpuList(value) if isinstance(value, str) else sorted(set(int(cpu) for cpu in value))
+            invalidCpus = [cpu for cpu in cpus if cpu not in usableCpus]
+            if len(invalidCpus) > 0:
+                raise Exception(f"invalid {key}, cpus={invalidCpus} are not usable, usable cpus={usableCpus}")
+            return cpus
+
+        def choiceOf(key: str, default: str, choices: Tuple[str, ...]) -> str:
+            value = str(overrides.get(key, default))
+            if value not in choices:
+                raise Exception(f"invalid {key}={value}, choices={choices}")
+            return value
+
+        usableCpus = U.usableCpus()
+        apiCpus = cpusOf("apiCpus", [])
+        workerCpus = cpusOf("workerCpus", [cpu for cpu in usableCpus if cpu not in apiCpus] if len(apiCpus) > 0 else [])
+        if len(apiCpus) > 0 and len(workerCpus) == 0:
+            raise Exception(f"no cpus left for workers, apiCpus={apiCpus}")
+        workerPinning = choiceOf("workerPinning", "core", ("core", "set"))
+
+        cpus = valueOf("cpuCount", len(workerCpus) if len(workerCpus) > 0 else U.cpuCount())
+        pdfWorkerCount = valueOf("pdfWorkerCount", cpus)
+        config: ServerConfig = {
+            "cpuCount": cpus,
+            "messageWorkerCount": valueOf("messageWorkerCount", 1),
+            "messageWorkerMaxQSize": valueOf("messageWorkerMaxQSize", 10),
+            "messageWorkerBatchMaxJobs": valueOf("messageWorkerBatchMaxJobs", 1),
+            "messageWorkerBatchWaitMs": valueOf("messageWorkerBatchWaitMs", 0, 0),
+            "pdfWorkerCount": pdfWorkerCount,
+            "pdfWorkerMaxQSize": valueOf("pdfWorkerMaxQSize", max(10, 2 * pdfWorkerCount)),
+            ## NOTE: 0 is allowed, i.e. an API node without its own process workers (shared queue backend)
+            "mpWorkerCount": valueOf("mpWorkerCount", cpus, 0),
+            "inlineMaxConcurrency": valueOf("inlineMaxConcurrency", cpus),
+            "renderThreadsPerJob": valueOf("renderThreadsPerJob", min(4, cpus)),
+            "renderThreadBudget": valueOf("renderThreadBudget", cpus),
+            "apiCpus": apiCpus,
+            "workerCpus": workerCpus,
+            "workerPinning": workerPinning,
+            "pdfThreadScheduling": choiceOf("pdfThreadScheduling", "fifo", SCHEDULING_POLICIES),
+            "pdfProcessScheduling": choiceOf("pdfProcessScheduling", "fifo", SCHEDULING_POLICIES),
+            "schedulingAgingMs": valueOf("schedulingAgingMs", SCHEDULING_AGING_MS, 0),
+            "fairQueuing": choiceOf("fairQueuing", "off", ("off", "drr")),
+            "tenantMaxInFlight": valueOf("tenantMaxInFlight", 0, 0),
+            "tenantMaxQueued": valueOf("tenantMaxQueued", 10),
+            "tenantQuantum": valueOf("tenantQuantum", 4),
+            "hedging": choiceOf("hedging", "off", ("off", "on")),
+            "hedgingPercentile": valueOf("hedgingPercentile", 95),
+            "hedgingMinDelayMs": valueOf("hedgingMinDelayMs", 500, 0),
+            "hedgingBudgetPercent": valueOf("hedgingBudgetPercent", 10),
+        }
+        return config
+    except Exception as e:
+        U.throwPrefix(prefix, e)
@@ -1,94 +1,430 @@
 import sys
 import os
+import time
 import asyncio
 import queue
 import signal
+import socket
+import shutil
 from fastapi import FastAPI, Body, HTTPException, File, UploadFile, Form, Depends
 from contextlib import asynccontextmanager
 from pydantic import BaseModel
-from typing import Final, Union, Callable, TypeVar, List, TypedDict, Dict, Any, NoReturn, Annotated
+from typing import Final, Union, Callable, TypeVar, List, TypedDict, Dict, Any, NoReturn, Annotated, Optional
 
 import util as U
-from api.worker import MultiThreadQueueWorker, MultiProcessManager
+from api.worker import MultiThreadQueueWorker, MultiProcessManager, ServiceTimeEstimator, SingleFlight
+from api.worker import (
+    QueueBackend,
+    SqliteQueueBackend,
+    JobJournal,
+    JournalEntry,
+    QueueJob,
+    QueueJobType,
+    QueueJobResult,
+)
+from api.worker import QueueJobErrCode, RemoteProcessManager
+from api.worker import JobExecutor, ThreadExecutor, ProcessExecutor, InlineExecutor, RenderBudget, setRenderBudget
+from api.worker import setJobBudgets
+from api.worker import FairExecutor, HedgedExecutor
+from api.worker import pdf2imageOutDirOf, PDF2IMAGE_OUT_DIR, OutputStore, PdfInfoCache, newJobQueue
 from api import initAllEndpoints
+from .config import ServerConfig, loadServerConfig
 
 
 class FastApiServer:
-    MESSAGE_WORKER_MAX_QSIZE = 10
-    PDF_WORKER_MAX_QSIZE = 10
-    PDF_WORKER_COUNT = 8
+    ## Pool sizes and render budget, defaults are derived from the CPUs of this process (refer to config.py)
+    ## NOTE: override by env (e.g. PDF_WORKER_COUNT=4) or json file of env SERVER_CONFIG_PATH
+    CONFIG: Final[ServerConfig] = loadServerConfig()
+    MESSAGE_WORKER_COUNT = CONFIG["messageWorkerCount"]
+    MESSAGE_WORKER_MAX_QSIZE = CONFIG["messageWorkerMaxQSize"]
+    ## Batch mode of the message worker, off if MESSAGE_WORKER_BATCH_MAX_JOBS is 1 (refer to QueueWorkerOpts)
+    MESSAGE_WORKER_BATCH_MAX_JOBS = CONFIG["messageWorkerBatchMaxJobs"]
+    MESSAGE_WORKER_BATCH_WAIT_MS = CONFIG["messageWorkerBatchWaitMs"]
+    PDF_WORKER_MAX_QSIZE = CONFIG["pdfWorkerMaxQSize"]
+    PDF_WORKER_COUNT = CONFIG["pdfWorkerCount"]
+    MP_WORKER_COUNT = CONFIG["mpWorkerCount"]
     IS_PDF_WORKER_SINGLE_QUEUE = True
+    ## Scheduling policy of queued pdf jobs per pool, "fifo" or "sjf" (shortest expected job first, refer to CostQueue)
+    PDF_THREAD_SCHEDULING = CONFIG["pdfThreadScheduling"]
+    PDF_PROCESS_SCHEDULING = CONFIG["pdfProcessScheduling"]
+    SCHEDULING_AGING_MS = CONFIG["schedulingAgingMs"]
+    ## Per-tenant fair queuing in front of the pdf pools (FAIR_QUEUING=drr), tenant is X-Tenant-Id, X-API-Key or client ip
+    FAIR_QUEUING = CONFIG["fairQueuing"]
+    ## Hedged execution of message jobs (HEDGING=on), a duplicate of a slow job runs on an idle worker (refer to HedgedExecutor)
+    HEDGING = CONFIG["hedging"]
+
+    ## Queue backend of multi-process workers
+    ## - "memory": multiprocessing.Queue, workers are owned by this API process
+    ## - "sqlite": queue in a SQLite db, several API processes/nodes share one pool of workers (refer to src/mpWorkers.py)
+    ##   NOTE: set MP_WORKER_COUNT=0 for an API node without its own workers
+    ## - "pool": workers are owned by a ProcessPoolServer (e.g. in uvicorn supervisor), connected by unix socket
+    ##   NOTE: main.py sets it when API_WORKER_COUNT > 1
+    MP_QUEUE_BACKEND = os.environ.get("MP_QUEUE_BACKEND", "memory")
+    MP_QUEUE_SQLITE_PATH = os.environ.get("MP_QUEUE_SQLITE_PATH", "./out/mpQueue.db")
+    MP_JOB_QUEUE_NAME = "jobs.pdf2image"
+    MP_POOL_SOCKET_PATH = os.environ.get("MP_POOL_SOCKET_PATH", "./out/mpPool.sock")
+    ## IPC of "memory" backend and of the shared pool, "queue" (multiprocessing.Queue) or "pipe" (a pipe per worker, refer to PipeHub)
+    MP_TRANSPORT = os.environ.get("MP_TRANSPORT", "queue")
+
+    ## Executor of each job type (e.g. /multiThread), executors are:
+    ## - "messageThreads", "pdfThreads": thread workers
+    ## - "pdfProcesses": multi-process workers (also used by /multiProcess)
+    ## - "inline": pool threads of the event loop (asyncio.to_thread, also used by /pdf2image)
+    ## NOTE: override by env without code changes, e.g. JOB_EXECUTORS="pdf2image=pdfProcesses,message=inline"
+    JOB_EXECUTORS: Dict[str, str] = {
+        QueueJobType.MESSAGE.value: "messageThreads",
+        QueueJobType.PDF2IMAGE.value: "pdfThreads",
+        **dict(kv.split("=", 1) for kv in os.environ.get("JOB_EXECUTORS", "").split(",") if "=" in kv),
+    }
+    ## Execution budget of each job type in ms (0: none), a job running longer is aborted and resolves with a timeout error
+    ## - thread/inline workers: the handler aborts at its next stage boundary, renderer subprocesses are killed
+    ## - process workers: same, the process is killed and respawned if the job does not abort (refer to MultiProcessWorker)
+    ## NOTE: override by env, e.g. JOB_BUDGETS_MS="pdf2image=120000,message=0"
+    JOB_BUDGETS_MS: Dict[str, int] = {
+        QueueJobType.MESSAGE.value: 5000,
+        QueueJobType.PDF2IMAGE.value: 60000,
+        **{
+            k: int(v)
+            for k, v in (kv.split("=", 1) for kv in os.environ.get("JOB_BUDGETS_MS", "").split(",") if "=" in kv)
+        },
+    }
+    INLINE_MAX_CONCURRENCY = CONFIG["inlineMaxConcurrency"]
+
+    ## All renders (threads, inline and local processes) share one budget of renderer subprocesses,
+    ## thread_count of each render adapts to the load (refer to RenderBudget)
+    ## NOTE: with API_WORKER_COUNT > 1, the shared process pool has its own budget
+    RENDER_THREADS_PER_JOB = CONFIG["renderThreadsPerJob"]
+    RENDER_THREAD_BUDGET = CONFIG["renderThreadBudget"]
+
+    ## No. of API processes (uvicorn workers), they share one pool of multi-process workers
+    API_WORKER_COUNT = int(os.environ.get("API_WORKER_COUNT", "1"))
+
+    ## Journal of accepted jobs, jobs not completed before shutdown/crash are replayed on startup
+    ## NOTE: disabled if empty
+    JOB_JOURNAL_PATH = os.environ.get("JOB_JOURNAL_PATH", "")
+    JOB_REPLAY_RETRY_SEC = 0.5
+
+    ## Outputs (./out/pdf2image/{id}, ./out/uploads/{id}) are kept within a quota, least recently used
+    ## or older than OUTPUT_TTL_SEC are removed in background (refer to OutputStore)
+    ## NOTE: 0 disables the limit
+    OUTPUT_DIRS: Final[Dict[str, str]] = {"pdf2image": PDF2IMAGE_OUT_DIR, "uploads": "./out/uploads"}
+    OUTPUT_MAX_BYTES = int(os.environ.get("OUTPUT_MAX_BYTES", str(10 * 1024**3)))
+    OUTPUT_MAX_FILES = int(os.environ.get("OUTPUT_MAX_FILES", "100000"))
+    OUTPUT_TTL_SEC = float(os.environ.get("OUTPUT_TTL_SEC", str(7 * 24 * 3600)))
+
+    ## On shutdown, new jobs are rejected and accepted jobs are given DRAIN_TIMEOUT_SEC to complete
+    ## NOTE: the same deadline covers in-flight http requests (uvicorn timeout_graceful_shutdown, refer to main.py)
+    DRAIN_TIMEOUT_SEC = float(os.environ.get("DRAIN_TIMEOUT_SEC", "30"))
+    ## idle workers need a moment to notice the stop request
+    WORKER_STOP_GRACE_SEC = 2
+    ## uvicorn waits a bit longer than the drain deadline, thus requests of aborted jobs can respond 503
+    DRAIN_RESPONSE_MARGIN_SEC = 2
 
     app: FastAPI
-    messageWorker: MultiThreadQueueWorker
-    pdfWorkers: List[MultiThreadQueueWorker]
-    mpManager: MultiProcessManager
+    messageWorkers: List[MultiThreadQueueWorker] = []
+    pdfWorkers: List[MultiThreadQueueWorker] = []
+    mpManager: Union[MultiProcessManager, RemoteProcessManager]
+    serviceTimes: ServiceTimeEstimator
+    singleFlight: SingleFlight
+    pdfInfos: PdfInfoCache
+    journal: Optional[JobJournal] = None
+    executors: Dict[str, JobExecutor] = {}
+    renderBudget: RenderBudget
+    outputStore: OutputStore
+
+    ## Jobs submitted to workers and not yet done, jobId -> job
+    acceptedJobs: Dict[str, QueueJob] = {}
+    isDraining: bool = False
+    drainDeadlineSec: float = 0
+    unfinishedJobs: List[QueueJob] = []
+
+    ## Workers are started in background after the server starts listening
+    ## NOTE: endpoints that need workers respond 503 until workers are ready
+    isWorkersReady: bool = False
+    ## NOTE: not empty if workers failed to start, /status responds 503 so that the orchestrator restarts the process
+    workersStartError: str = ""
+    workersStartTask: Optional[asyncio.Task] = None
+    startupEpms: int = 0
+    startupPhasesMs: Dict[str, int] = {}
+
+    @classmethod
+    def markStartupPhase(cls, phase: str, phaseStartSec: float):
+        """
+        Record elapsed ms of a startup phase
+        """
+        cls.startupPhasesMs[phase] = int((time.perf_counter() - phaseStartSec) * 1000)
+        U.logI(f"startup phase[{phase}] {cls.startupPhasesMs[phase]}ms")
+
+    @classmethod
+    def executorOf(cls, jobType: QueueJobType) -> JobExecutor:
+        """
+        Get the executor of a job type, refer to JOB_EXECUTORS
+        """
+        executorName = cls.JOB_EXECUTORS.get(jobType.value, "")
+        if executorName not in cls.executors:
+            raise Exception(f"executor not found, jobType={jobType.value}, executor={executorName}")
+        return cls.executors[executorName]
+
+    @classmethod
+    def withFairQueuing(cls, executor: JobExecutor, workerCount: int, scheduling: str) -> JobExecutor:
+        """
+        Put per-tenant fair queuing in front of the executor of a pool if FAIR_QUEUING is enabled
+
+        Args:
+            workerCount/scheduling: pool size (default of tenantMaxInFlight) and scheduling policy of the pool
+        """
+        if cls.FAIR_QUEUING == "off":
+            return executor
+        maxInFlight = cls.CONFIG["tenantMaxInFlight"] or max(1, workerCount // 2)
+        U.logW(f"Use fair queuing for {executor.name}, tenant maxInFlight={maxInFlight}")
+        return FairExecutor(
+            executor,
+            maxInFlight,
+            cls.CONFIG["tenantMaxQueued"],
+            cls.CONFIG["tenantQuantum"],
+            scheduling,
+            cls.SCHEDULING_AGING_MS,
+        )
+
+    @classmethod
+    def withHedging(cls, executor: JobExecutor, workerCount: int) -> JobExecutor:
+        """
+        Put hedged execution in front of the executor of a pool if HEDGING is enabled
+
+        NOTE: a pool of 1 worker is not hedged, its duplicate would always be skipped (no idle worker)
+        """
+        if cls.HEDGING == "off":
+            return executor
+        if workerCount < 2:
+            U.logW(f"No hedging for {executor.name}, it needs at least 2 workers, workerCount={workerCount}")
+            return executor
+        U.logW(f"Use hedging for {executor.name}, percentile={cls.CONFIG['hedgingPercentile']}")
+        return HedgedExecutor(
+            executor,
+            cls.CONFIG["hedgingPercentile"],
+            cls.CONFIG["hedgingMinDelayMs"],
+            cls.CONFIG["hedgingBudgetPercent"],
+        )
+
+    @classmethod
+    def onJobAccepted(cls, job: QueueJob, executorName: str, flightKey: str = "", idempotencyKey: str = ""):
+        """
+        Track a job submitted to an executor until it is done (for drain on shutdown), and journal it if enabled
+        """
+        jobId = job["id"]
+        cls.acceptedJobs[jobId] = job
+        job["promise"].add_done_callback(lambda _: cls.acceptedJobs.pop(jobId, None))
+        cls.addJobOutputOnDone(job)
+        if cls.journal is not None:
+            cls.journal.accepted(job, executorName, flightKey, idempotencyKey)
+
+    @classmethod
+    def addJobOutputOnDone(cls, job: QueueJob):
+        """
+        Add output of a pdf2image job to the output store once the job is done
+
+        NOTE: output of a not persisted job is removed after streaming, output of an aborted job by cleanPartialOutputs()
+        """
+        if job["jobType"] != QueueJobType.PDF2IMAGE or job["jobData"].get("persist", True) is False:
+            return
+
+        def onDone(promise: asyncio.Future[QueueJobResult]):
+            if not promise.cancelled() and promise.result()["errCode"] != QueueJobErrCode.SHUTDOWN:
+                cls.outputStore.add("pdf2image", job["id"])
+
+        job["promise"].add_done_callback(onDone)
+
+    @classmethod
+    def startDrain(cls):
+        """
+        Stop admitting new jobs, the drain deadline starts now
+
+        NOTE: it is called on SIGTERM/SIGINT (before in-flight http requests are awaited by uvicorn) and on lifespan shutdown
+        """
+        if not cls.isDraining:
+            cls.isDraining = True
+            cls.drainDeadlineSec = time.monotonic() + cls.DRAIN_TIMEOUT_SEC
+            U.logW(f"draining, new jobs are rejected, deadline in {cls.DRAIN_TIMEOUT_SEC}s")
+
+            ## Abort unfinished jobs on the deadline, thus waiting requests respond before uvicorn cancels them
+            try:
+                asyncio.get_running_loop().call_later(cls.DRAIN_TIMEOUT_SEC, cls.abortUnfinishedJobs_)
+            except RuntimeError:
+                ## no running loop, jobs are aborted by drainJobs()
+                pass
+
+    @classmethod
+    def drainRemainingSec(cls) -> float:
+        return max(0, cls.drainDeadlineSec - time.monotonic())
 
     @classmethod
-    def stopAllThreadWorkers(cls):
-        funcName = cls.stopAllThreadWorkers.__name__
+    async def drainJobs(cls) -> List[QueueJob]:
+        """
+        Wait for accepted jobs to complete until the drain deadline
+
+        Returns:
+            jobs not completed, they are resolved with errCode=QueueJobErrCode.SHUTDOWN
+        """
+        funcName = cls.drainJobs.__name__
         prefix = funcName
         try:
-            U.logW(f"{prefix} stopping all multi-thread Workers...")
-            mTWorkers = [cls.messageWorker] + [p for p in cls.pdfWorkers]
-            for w in mTWorkers:
-                w.stop()
-            for w in mTWorkers:
-                w.join()
-            U.logW(f"{prefix} all multi-thread workers stopped")
+            jobs = list(cls.acceptedJobs.values())
+            if len(jobs) > 0:
+                U.logW(f"{prefix} waiting {len(jobs)} jobs to complete, timeoutSec={cls.drainRemainingSec():.1f}...")
+                await asyncio.wait([job["promise"] for job in jobs], timeout=cls.drainRemainingSec())
+            cls.abortUnfinishedJobs_()
+            U.logW(f"{prefix} drained, unfinished={len(cls.unfinishedJobs)}")
+            return cls.unfinishedJobs
         except Exception as e:
             U.logPrefixE(prefix, e)
+            return []
+
+    @classmethod
+    def abortUnfinishedJobs_(cls):
+        for job in list(cls.acceptedJobs.values()):
+            if job["promise"].done():
+                continue
+            ## NOTE: thread workers skip a queued job whose promise is done
+            job["promise"].set_result(
+                {
+                    "errCode": QueueJobErrCode.SHUTDOWN,
+                    "err": "server is shutting down, job not completed",
+                    "workerName": "",
+                    "data": "",
+                    "dequeueElapsedMs": 0,
+                    "processElapsedMs": 0,
+                    "totalElapsedMs": U.epochMs() - job["createEpms"],
+                }
+            )
+            cls.unfinishedJobs.append(job)
+
+    @classmethod
+    def cleanPartialOutputs(cls, jobs: List[QueueJob]):
+        """
+        Remove output of jobs that did not complete (e.g. worker terminated in the middle of rendering)
+        """
+        for job in jobs:
+            outDir = pdf2imageOutDirOf(job["id"])
+            if job["jobType"] == QueueJobType.PDF2IMAGE and os.path.isdir(outDir):
+                U.logW(f"removing partial output {outDir}")
+                shutil.rmtree(outDir, ignore_errors=True)
+
+    @classmethod
+    async def submitReplayedJob_(cls, job: QueueJob, executor: JobExecutor):
+        ## Worker queues are small, retry until there is space rather than dropping the job
+        while True:
+            try:
+                executor.submit(job)
+                return
+            except queue.Full:
+                await asyncio.sleep(cls.JOB_REPLAY_RETRY_SEC)
 
     @classmethod
-    async def stopAllProcessWorkers(cls):
-        funcName = cls.stopAllProcessWorkers.__name__
+    async def replayJournal(cls):
+        """
+        Re-submit jobs accepted but not completed before the last shutdown/crash
+
+        NOTE:
+        - Replayed job keeps its job id, i.e. same output dir, partial output of the interrupted execution is removed
+        - Replayed job is registered to SingleFlight, thus a client retry with the same Idempotency-Key joins it
+        """
+        funcName = cls.replayJournal.__name__
         prefix = funcName
         try:
-            await cls.mpManager.stopAllProcesses()
+            if cls.journal is None:
+                return
+            entries: List[JournalEntry] = cls.journal.pendingJobs()
+            if len(entries) == 0:
+                return
+            U.logW(f"{prefix} replaying {len(entries)} jobs accepted before restart...")
+
+            for entry in entries:
+                ## Output of a not persisted job was streamed to its client, the client is gone after restart
+                if entry["jobData"].get("persist", True) is False:
+                    cls.journal.completed(entry["id"])
+                    shutil.rmtree(pdf2imageOutDirOf(entry["id"]), ignore_errors=True)
+                    continue
+
+                resultPromise: asyncio.Future[QueueJobResult] = asyncio.Future()
+                job: QueueJob = {
+                    "createEpms": U.epochMs(),
+                    "id": entry["id"],
+                    "jobType": QueueJobType(entry["jobType"]),
+                    "jobData": entry["jobData"],
+                    "promise": resultPromise,
+                }
+                if job["jobType"] == QueueJobType.PDF2IMAGE:
+                    shutil.rmtree(pdf2imageOutDirOf(entry["id"]), ignore_errors=True)
+
+                ## NOTE: executor config may have changed since the job was accepted
+                executor = cls.executors.get(entry["executor"]) or cls.executorOf(job["jobType"])
+                await cls.submitReplayedJob_(job, executor)
+                cls.onJobAccepted(job, executor.name, entry["flightKey"], entry["idempotencyKey"])
+                if entry["flightKey"] != "":
+                    cls.singleFlight.start(entry["flightKey"], job, entry["idempotencyKey"])
+                resultPromise.add_done_callback(
+                    lambda p, jobId=entry["id"]: U.logI(
+                        f"{prefix} replayed job[{jobId}] done, errCode={p.result()['errCode'] if not p.cancelled() else 'canceled'}"
+                    )
+                )
+            U.logW(f"{prefix} {len(entries)} jobs re-submitted")
         except Exception as e:
             U.logPrefixE(prefix, e)
 
     @classmethod
-    @asynccontextmanager
-    async def fastApiLifeSpan(cls, application: FastAPI):
-        funcName = cls.fastApiLifeSpan.__name__
+    async def stopExecutors(cls, timeoutSec: float = 0):
+        """
+        Stop workers of all executors, each worker exits after its running job
+
+        Args:
+            timeoutSec: max time waiting for running jobs, processes still running are terminated
+        """
+        funcName = cls.stopExecutors.__name__
         prefix = funcName
         try:
-            U.logW(f"{prefix} >>>>>>> onStart")
-            yield
-            U.logW(f"{prefix} >>>>>>> onShutdown")
-            await cls.stopAllProcessWorkers()
-            cls.stopAllThreadWorkers()
-
-            ## important note:
-            ## https://github.com/simonw/datasette-scale-to-zero/issues/2
-            ## - normal exit causes a lot of strange error messages
-            ## - sys.exit(0) also has the same issue
-            ## - calling os._exit(0) will ignore the error messages since it will NOT call handlers on exit
-            os._exit(0)
+            U.logW(f"{prefix} stopping executors {list(cls.executors.keys())}...")
+            results = await asyncio.gather(
+                *[executor.stop(timeoutSec) for executor in cls.executors.values()], return_exceptions=True
+            )
+            for executorName, result in zip(cls.executors.keys(), results):
+                if isinstance(result, Exception):
+                    U.logPrefixE(f"{prefix}[{executorName}]", result)
         except Exception as e:
             U.logPrefixE(prefix, e)
 
     @classmethod
-    async def initServer(cls):
-        funcName = cls.initServer.__name__
+    async def startThreadWorkers(cls):
+        funcName = cls.startThreadWorkers.__name__
         prefix = funcName
         try:
+            phaseStartSec = time.perf_counter()
 
-            ## Create a FastAPI instance
-            cls.app = FastAPI(lifespan=cls.fastApiLifeSpan)
-
-            ## Start a message worker in separated thread
-            messageWorkerStartPromise = asyncio.Future()
-            cls.messageWorker = MultiThreadQueueWorker(
-                "messageWorker", messageWorkerStartPromise, {"queueMaxSize": cls.MESSAGE_WORKER_MAX_QSIZE}
-            )
-            cls.messageWorker.start()
+            ## Start message workers in separated threads, sharing one queue
+            messageWorkerQueue = queue.Queue(maxsize=cls.MESSAGE_WORKER_MAX_QSIZE)
+            messageWorkerStartPromises = [asyncio.Future() for i in range(cls.MESSAGE_WORKER_COUNT)]
+            cls.messageWorkers = [
+                MultiThreadQueueWorker(
+                    "messageWorker" if i == 0 else f"messageWorker{i+1}",
+                    messageWorkerStartPromises[i],
+                    {
+                        "queueMaxSize": cls.MESSAGE_WORKER_MAX_QSIZE,
+                        "queue": messageWorkerQueue,
+                        "serviceTimes": cls.serviceTimes,
+                        "cpus": cls.CONFIG["workerCpus"],
+                        "batchMaxJobs": cls.MESSAGE_WORKER_BATCH_MAX_JOBS,
+                        "batchWaitMs": cls.MESSAGE_WORKER_BATCH_WAIT_MS,
+                        "queueWorkers": cls.MESSAGE_WORKER_COUNT,
+                    },
+                )
+                for i in range(cls.MESSAGE_WORKER_COUNT)
+            ]
+            for worker in cls.messageWorkers:
+                worker.start()
 
             ## Start a pool of pdf workers, each running in its own thread
             if cls.IS_PDF_WORKER_SINGLE_QUEUE:
                 U.logW(f"Use single queue for pdf worker!")
-                pdfWorkerSingleQueue = queue.Queue()
+                pdfWorkerSingleQueue = newJobQueue(cls.PDF_THREAD_SCHEDULING, 0, cls.SCHEDULING_AGING_MS)
             pdfWorkerStartPromises = [asyncio.Future() for i in range(cls.PDF_WORKER_COUNT)]
             cls.pdfWorkers = [
                 MultiThreadQueueWorker(
@@ -96,7 +432,15 @@ class FastApiServer:
                     pdfWorkerStartPromises[i],
                     {
                         "queueMaxSize": cls.PDF_WORKER_MAX_QSIZE,
-                        "queue": pdfWorkerSingleQueue if cls.IS_PDF_WORKER_SINGLE_QUEUE else None,
+                        "queue": (
+                            pdfWorkerSingleQueue
+                            if cls.IS_PDF_WORKER_SINGLE_QUEUE
+                            else newJobQueue(
+                                cls.PDF_THREAD_SCHEDULING, cls.PDF_WORKER_MAX_QSIZE, cls.SCHEDULING_AGING_MS
+                            )
+                        ),
+                        "serviceTimes": cls.serviceTimes,
+                        "cpus": cls.CONFIG["workerCpus"],
                     },
                 )
                 for i in range(cls.PDF_WORKER_COUNT)
@@ -104,18 +448,189 @@ class FastApiServer:
             for i in range(cls.PDF_WORKER_COUNT):
                 cls.pdfWorkers[i].start()
 
-            ## await until workers are running
-            await messageWorkerStartPromise
-            for i in range(cls.PDF_WORKER_COUNT):
-                await pdfWorkerStartPromises[i]
+            ## await until all workers are running (concurrently, not one by one)
+            await asyncio.gather(*messageWorkerStartPromises, *pdfWorkerStartPromises)
+            cls.executors["messageThreads"] = cls.withHedging(
+                ThreadExecutor("messageThreads", cls.messageWorkers), cls.MESSAGE_WORKER_COUNT
+            )
+            cls.executors["pdfThreads"] = cls.withFairQueuing(
+                ThreadExecutor("pdfThreads", cls.pdfWorkers), cls.PDF_WORKER_COUNT, cls.PDF_THREAD_SCHEDULING
+            )
+            cls.markStartupPhase("threadWorkers", phaseStartSec)
+        except Exception as e:
+            U.throwPrefix(prefix, e)
+
+    @classmethod
+    async def startProcessWorkers(cls):
+        funcName = cls.startProcessWorkers.__name__
+        prefix = funcName
+        try:
+            phaseStartSec = time.perf_counter()
 
             ## Start a pool of multi-process pdf2image workers
-            cls.mpManager = MultiProcessManager("mpMgr")
-            for i in range(8):
-                cls.mpManager.startProcess(f"pdfWorker{i+1}")
+            ## NOTE: process start (especially spawn on Windows) blocks, thus processes are started in pool threads concurrently
+            jobQueue: Optional[QueueBackend] = None
+            resultQueue: Optional[QueueBackend] = None
+            if cls.MP_QUEUE_BACKEND == "pool":
+                ## workers are not owned by this process
+                U.logW(f"Use shared pool of multi-process workers, socket={cls.MP_POOL_SOCKET_PATH}")
+                cls.mpManager = RemoteProcessManager("mpMgr", cls.MP_POOL_SOCKET_PATH, cls.serviceTimes)
+                await cls.mpManager.connect()
+                cls.executors["pdfProcesses"] = cls.withFairQueuing(
+                    ProcessExecutor("pdfProcesses", cls.mpManager), cls.MP_WORKER_COUNT, cls.PDF_PROCESS_SCHEDULING
+                )
+                cls.markStartupPhase("processWorkers", phaseStartSec)
+                return
+            elif cls.MP_QUEUE_BACKEND == "sqlite":
+                ## Each API process has its own result queue, workers reply to the node that submits the job
+                U.logW(f"Use sqlite queue backend for multi-process workers, db={cls.MP_QUEUE_SQLITE_PATH}")
+                jobQueue = SqliteQueueBackend(
+                    cls.MP_QUEUE_SQLITE_PATH, cls.MP_JOB_QUEUE_NAME, MultiProcessManager.JOB_QUEUE_MAX_SIZE
+                )
+                resultQueue = SqliteQueueBackend(
+                    cls.MP_QUEUE_SQLITE_PATH, f"results.{socket.gethostname()}.{os.getpid()}"
+                )
+            elif cls.MP_QUEUE_BACKEND != "memory":
+                raise Exception(f"invalid MP_QUEUE_BACKEND={cls.MP_QUEUE_BACKEND}")
+            cls.mpManager = MultiProcessManager(
+                "mpMgr",
+                serviceTimes=cls.serviceTimes,
+                jobQueue=jobQueue,
+                resultQueue=resultQueue,
+                renderBudget=cls.renderBudget,
+                workerCpus=cls.CONFIG["workerCpus"],
+                workerPinning=cls.CONFIG["workerPinning"],
+                scheduling=cls.PDF_PROCESS_SCHEDULING,
+                schedulingAgingMs=cls.SCHEDULING_AGING_MS,
+                transport=cls.MP_TRANSPORT if cls.MP_QUEUE_BACKEND == "memory" else "queue",
+            )
+            await asyncio.gather(
+                *[asyncio.to_thread(cls.mpManager.startProcess, f"pdfWorker{i+1}") for i in range(cls.MP_WORKER_COUNT)]
+            )
+            cls.executors["pdfProcesses"] = cls.withFairQueuing(
+                ProcessExecutor("pdfProcesses", cls.mpManager), cls.MP_WORKER_COUNT, cls.PDF_PROCESS_SCHEDULING
+            )
+            cls.markStartupPhase("processWorkers", phaseStartSec)
+        except Exception as e:
+            U.throwPrefix(prefix, e)
+
+    @classmethod
+    async def startWorkers(cls):
+        funcName = cls.startWorkers.__name__
+        prefix = funcName
+        try:
+            phaseStartSec = time.perf_counter()
+
+            ## thread and process worker pools are brought up concurrently
+            await asyncio.gather(cls.startThreadWorkers(), cls.startProcessWorkers())
+            cls.isWorkersReady = True
+            cls.markStartupPhase("workers", phaseStartSec)
+            cls.startupPhasesMs["total"] = U.epochMs() - cls.startupEpms
+            U.logI(f"{prefix} all workers ready, startupPhasesMs={cls.startupPhasesMs}")
+
+            ## accepted work survives restart
+            await cls.replayJournal()
+        except Exception as e:
+            if not cls.isWorkersReady:
+                cls.workersStartError = f"{type(e).__name__}: {e}"
+            U.logPrefixE(prefix, e)
+
+    @classmethod
+    @asynccontextmanager
+    async def fastApiLifeSpan(cls, application: FastAPI):
+        funcName = cls.fastApiLifeSpan.__name__
+        prefix = funcName
+        try:
+            U.logW(f"{prefix} >>>>>>> onStart")
+
+            ## Reserve cpus for the event loop thread, workers are pinned to the other cpus (workerCpus)
+            ## NOTE: threads created by the loop thread afterwards inherit it, workers set their own affinity
+            if U.setCpuAffinity(cls.CONFIG["apiCpus"]):
+                U.logI(f"{prefix} event loop pinned to cpus={cls.CONFIG['apiCpus']}")
+
+            ## Workers are started in background, thus the http listener comes up without waiting for them
+            cls.workersStartTask = asyncio.create_task(cls.startWorkers())
+
+            ## Existing outputs are indexed in background
+            cls.outputStore.start()
+            yield
+            U.logW(f"{prefix} >>>>>>> onShutdown")
+
+            ## Drain: reject new jobs, let accepted jobs complete until the deadline
+            cls.startDrain()
+            await cls.workersStartTask
+            unfinishedJobs = await cls.drainJobs()
+
+            ## Workers exit after their running job, those still running after the deadline are terminated
+            await cls.stopExecutors(max(cls.drainRemainingSec(), cls.WORKER_STOP_GRACE_SEC))
+            cls.cleanPartialOutputs(unfinishedJobs)
+
+            ## commit the pending journal batch, i.e. unfinished jobs are replayed on next startup
+            ## NOTE: yield to the event loop first, thus done callbacks of drained jobs are run
+            await asyncio.sleep(0)
+            if cls.journal is not None:
+                cls.journal.close()
+            await cls.outputStore.stop()
+
+            ## NOTE: workers are stopped and jobs are drained above, thus the process exits normally
+            ## (it was os._exit(0) to hide errors of killed workers on exit)
+            U.logW(f"{prefix} >>>>>>> stopped")
+        except Exception as e:
+            U.logPrefixE(prefix, e)
+
+    @classmethod
+    def initServer(cls):
+        """
+        Create the FastAPI instance with all endpoints
+
+        NOTE:
+        - Only lightweight objects are created here, i.e. it returns quickly
+        - Workers are started on lifespan startup in background, refer to startWorkers()
+        """
+        funcName = cls.initServer.__name__
+        prefix = funcName
+        try:
+            cls.startupEpms = U.epochMs()
+            phaseStartSec = time.perf_counter()
+
+            ## Create a FastAPI instance
+            cls.app = FastAPI(lifespan=cls.fastApiLifeSpan)
+
+            ## Measured service time of all workers, used for admission control
+            cls.serviceTimes = ServiceTimeEstimator()
+
+            ## Identical jobs running concurrently share one execution
+            cls.singleFlight = SingleFlight()
+
+            ## Page count/sizes of pdfs by content hash, i.e. cost of pdf2image jobs in pages
+            cls.pdfInfos = PdfInfoCache()
+
+            ## Budget of renderer subprocesses shared by all workers of this process (and its worker processes)
+            cls.renderBudget = RenderBudget(cls.RENDER_THREAD_BUDGET, cls.RENDER_THREADS_PER_JOB)
+            setRenderBudget(cls.renderBudget)
+
+            ## Execution budgets of job types, set before worker processes are started
+            setJobBudgets(cls.JOB_BUDGETS_MS)
+
+            ## Jobs run in pool threads of the event loop, no workers to start
+            cls.executors["inline"] = cls.withHedging(
+                InlineExecutor("inline", cls.INLINE_MAX_CONCURRENCY, cls.serviceTimes, cls.CONFIG["workerCpus"]),
+                cls.INLINE_MAX_CONCURRENCY,
+            )
+
+            ## Index of outputs (the scan of existing outputs is deferred to lifespan startup)
+            cls.outputStore = OutputStore(
+                cls.OUTPUT_DIRS, cls.OUTPUT_MAX_BYTES, cls.OUTPUT_MAX_FILES, cls.OUTPUT_TTL_SEC
+            )
+
+            ## Journal of accepted jobs (optional)
+            if cls.JOB_JOURNAL_PATH != "":
+                U.logW(f"Use job journal, db={cls.JOB_JOURNAL_PATH}")
+                cls.journal = JobJournal(cls.JOB_JOURNAL_PATH)
 
             ## init all endpoints
             initAllEndpoints(cls.app)
+            cls.markStartupPhase("endpoints", phaseStartSec)
 
             ## FastAPI instance is returned
             return cls.app
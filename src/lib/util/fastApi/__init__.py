@@ -1 +1,4 @@
-from .util import *
\ No newline at end of file
+from .util import *
+from .rateLimit import *
+from .response import *
+from .stream import *
@@ -0,0 +1,163 @@
+import math
+import time
+import threading
+from collections import OrderedDict
+from http import HTTPStatus
+from typing import Final, List, Dict, Tuple, TypedDict, Optional, NotRequired
+from fastapi import FastAPI
+from fastapi.responses import JSONResponse
+from starlette.types import ASGIApp, Scope, Receive, Send
+import util as U
+
+
+class RateLimitRule(TypedDict):
+    ## sustained rate, i.e. no. of requests allowed per periodSec
+    requests: int
+    periodSec: float
+    ## max no. of requests that can be made in a burst (default: requests)
+    burst: NotRequired[int]
+
+
+class TokenBucketRateLimiter:
+    """
+    Per-client token bucket rate limiter
+
+    NOTE:
+    - Buckets are sharded by key hash and each shard has its own lock, so concurrent requests rarely contend
+    - Each shard is an OrderedDict in least-recently-used order
+      - acquire() is O(1): lookup, refill, take token, move bucket to the end
+      - idle buckets are always at the front, thus eviction pops from the front until it finds a recent one
+    """
+
+    SHARD_COUNT: Final[int] = 16
+    IDLE_EVICT_SEC: Final[float] = 10 * 60
+
+    ## limit the instance variable
+    ## Why? avoid bugs some methods created wrong instance variable
+    __slots__ = ("shards_", "shardLocks_", "idleEvictSec_")
+
+    def __init__(self, shardCount: int = SHARD_COUNT, idleEvictSec: float = IDLE_EVICT_SEC):
+        funcName = f"{TokenBucketRateLimiter.__name__}.ctor"
+        prefix = funcName
+        try:
+            ## bucket is [tokens, lastRefillSec]
+            self.shards_: List[OrderedDict[str, List[float]]] = [OrderedDict() for _ in range(shardCount)]
+            self.shardLocks_ = [threading.Lock() for _ in range(shardCount)]
+            self.idleEvictSec_ = idleEvictSec
+        except Exception as e:
+            U.throwPrefix(prefix, e)
+
+    def bucketCount(self):
+        return sum([len(shard) for shard in self.shards_])
+
+    def acquire(self, key: str, rule: RateLimitRule) -> Tuple[bool, float]:
+        """
+        Take a token from the bucket of the key
+
+        Returns:
+            (isAllowed, retryAfterSec) retryAfterSec is 0 if allowed
+        """
+        burst = float(rule.get("burst", rule["requests"]))
+        refillPerSec = rule["requests"] / rule["periodSec"]
+        nowSec = time.monotonic()
+
+        shardIdx = hash(key) % len(self.shards_)
+        shard = self.shards_[shardIdx]
+        with self.shardLocks_[shardIdx]:
+            bucket = shard.get(key)
+            if bucket is None:
+                ## new client starts with a full bucket
+                bucket = [burst, nowSec]
+                shard[key] = bucket
+            else:
+                bucket[0] = min(burst, bucket[0] + (nowSec - bucket[1]) * refillPerSec)
+                bucket[1] = nowSec
+                shard.move_to_end(key)
+
+            ## housekeeping: evict idle buckets (at most a few per call as they are at the front)
+            while len(shard) > 1:
+                oldestKey, oldestBucket = next(iter(shard.items()))
+                if nowSec - oldestBucket[1] < self.idleEvictSec_:
+                    break
+                del shard[oldestKey]
+
+            if bucket[0] >= 1.0:
+                bucket[0] -= 1.0
+                return True, 0
+            return False, (1.0 - bucket[0]) / refillPerSec
+
+
+class RateLimitMiddleware:
+    """
+    Pure ASGI middleware that applies per-route token bucket rate limits per client
+
+    NOTE:
+    - client key is the x-api-key header if present, otherwise the client ip
+    - routeRules are keyed by path prefix, the longest matching prefix wins
+    - a rule of None means the route is not rate limited
+    """
+
+    API_KEY_HEADER: Final[bytes] = b"x-api-key"
+
+    def __init__(
+        self,
+        app: ASGIApp,
+        limiter: TokenBucketRateLimiter,
+        defaultRule: Optional[RateLimitRule],
+        routeRules: Dict[str, Optional[RateLimitRule]],
+    ):
+        self.app = app
+        self.limiter = limiter
+        self.defaultRule = defaultRule
+        ## longest prefix first
+        self.routeRules = sorted(routeRules.items(), key=lambda kv: len(kv[0]), reverse=True)
+
+    def ruleOf(self, path: str) -> Tuple[str, Optional[RateLimitRule]]:
+        for routePrefix, rule in self.routeRules:
+            if path.startswith(routePrefix):
+                return routePrefix, rule
+        return "*", self.defaultRule
+
+    def clientKeyOf(self, scope: Scope) -> str:
+        for k, v in scope.get("headers", []):
+            if k == self.API_KEY_HEADER:
+                return f"key:{v.decode('latin-1')}"
+        client = scope.get("client")
+        return f"ip:{client[0]}" if client else "ip:unknown"
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        routeKey, rule = self.ruleOf(scope["path"])
+        if rule is not None:
+            isAllowed, retryAfterSec = self.limiter.acquire(f"{routeKey}|{self.clientKeyOf(scope)}", rule)
+            if not isAllowed:
+                response = JSONResponse(
+                    status_code=HTTPStatus.TOO_MANY_REQUESTS,
+                    content={"detail": "[--] too many requests (rate limit exceeded)"},
+                    headers={"Retry-After": str(max(1, math.ceil(retryAfterSec)))},
+                )
+                await response(scope, receive, send)
+                return
+
+        await self.app(scope, receive, send)
+
+
+def useRateLimitMiddleware(
+    app: FastAPI, defaultRule: Optional[RateLimitRule], routeRules: Dict[str, Optional[RateLimitRule]] = {}
+):
+    """
+    Use per-client rate limit for FastAPI
+    - Requests exceeding the limit are responded with 429 and Retry-After header
+    """
+    funcName = useRateLimitMiddleware.__name__
+    prefix = funcName
+    try:
+        app.add_middleware(
+            RateLimitMiddleware, limiter=TokenBucketRateLimiter(), defaultRule=defaultRule, routeRules=routeRules
+        )
+        U.logW(f"Use middleware[{RateLimitMiddleware.__name__}] default={defaultRule}, routes={routeRules}")
+    except Exception as e:
+        U.logPrefixE(prefix, e)
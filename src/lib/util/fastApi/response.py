@@ -0,0 +1,193 @@
+import os
+import json
+import asyncio
+import email.utils
+from http import HTTPStatus
+from typing import Any, Final, List, Optional, Tuple
+from fastapi import Response
+from starlette.datastructures import Headers
+from starlette.types import Scope, Receive, Send
+from fastapi.encoders import jsonable_encoder
+
+## pydantic v2 serializes python objects and BaseModel instances to json bytes in rust
+## NOTE: it is not available for pydantic v1, fallback to jsonable_encoder + json
+try:
+    from pydantic_core import to_json as pydanticToJson_
+except ImportError:
+    pydanticToJson_ = None
+
+
+def toJsonBytes(content: Any) -> bytes:
+    """
+    Serialize content (dict/list/BaseModel/...) to json bytes
+
+    NOTE: BaseModel is serialized directly by its compiled serializer, i.e. no jsonable_encoder and no re-validation
+    """
+    if pydanticToJson_ is not None:
+        return pydanticToJson_(content)
+    return json.dumps(jsonable_encoder(content), ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+class FastJSONResponse(Response):
+    """
+    JSON response that skips FastAPI response_model validation and jsonable_encoder
+
+    NOTE:
+    - Returning a Response from an endpoint bypasses response_model, response_model is still used for openapi docs
+    - Use it only if the content is already validated, e.g. a BaseModel of the request payload
+    """
+
+    media_type = "application/json"
+
+    def render(self, content: Any) -> bytes:
+        return toJsonBytes(content)
+
+
+class CachedJSONResponse:
+    """
+    Immutable json response that is serialized once and reused for every request
+    """
+
+    ## limit the instance variable
+    ## Why? avoid bugs some methods created wrong instance variable
+    __slots__ = ("body_", "statusCode_")
+
+    def __init__(self, content: Any, statusCode: int = HTTPStatus.OK):
+        self.body_ = toJsonBytes(content)
+        self.statusCode_ = statusCode
+
+    def response(self) -> Response:
+        return Response(content=self.body_, status_code=self.statusCode_, media_type="application/json")
+
+
+class StaticFileResponse(Response):
+    """
+    Response of an immutable file (e.g. a rendered page) with conditional requests and Range support
+
+    NOTE:
+    - ETag/Last-Modified: If-None-Match/If-Modified-Since of a repeat fetch is answered with 304 (no body)
+    - Range: a single byte range is answered with 206, an unsatisfiable range with 416, If-Range is honoured
+      Multiple ranges are answered with the whole file (200), it is allowed by RFC 9110
+    - The body is sent by the ASGI zero-copy extension (http.response.zerocopysend, i.e. sendfile) if the server
+      supports it, otherwise it is read by os.pread() in large chunks in pool thread
+    - The file must not change once it is served (immutable), thus it is cached by the client for a year
+    """
+
+    CHUNK_SIZE: Final[int] = 1024 * 1024
+    CACHE_CONTROL: Final[str] = "public, max-age=31536000, immutable"
+
+    def __init__(self, filePath: str, stat: os.stat_result, mediaType: str):
+        ## NOTE: Response.__init__ is not called, the response is sent by __call__ (no render of content)
+        self.filePath_ = filePath
+        self.stat_ = stat
+        self.media_type = mediaType
+        self.status_code = HTTPStatus.OK
+        self.background = None
+
+    def etag(self) -> str:
+        st = self.stat_
+        return f'"{st.st_ino:x}-{st.st_size:x}-{st.st_mtime_ns:x}"'
+
+    def isNotModified_(self, requestHeaders: Headers) -> bool:
+        ifNoneMatch = requestHeaders.get("if-none-match")
+        if ifNoneMatch is not None:
+            etags = [tag.strip().removeprefix("W/") for tag in ifNoneMatch.split(",")]
+            return "*" in etags or self.etag() in etags
+        ifModifiedSince = requestHeaders.get("if-modified-since")
+        if ifModifiedSince is not None:
+            try:
+                return int(self.stat_.st_mtime) <= email.utils.parsedate_to_datetime(ifModifiedSince).timestamp()
+            except (TypeError, ValueError):
+                return False
+        return False
+
+    def rangeOf_(self, requestHeaders: Headers) -> Optional[Tuple[int, int]]:
+        """
+        Returns:
+            (start, end) inclusive byte range, None for the whole file
+
+        Raises:
+            ValueError if the range is unsatisfiable
+        """
+        rangeHeader = requestHeaders.get("range")
+        if rangeHeader is None or not rangeHeader.startswith("bytes=") or "," in rangeHeader:
+            return None
+        ## If-Range: the range applies only if the client has the current version
+        ifRange = requestHeaders.get("if-range")
+        if ifRange is not None and ifRange.strip() != self.etag():
+            return None
+
+        size = self.stat_.st_size
+        startStr, _, endStr = rangeHeader[len("bytes=") :].strip().partition("-")
+        try:
+            if startStr == "":
+                ## suffix range, e.g. bytes=-500 is the last 500 bytes
+                start, end = max(0, size - int(endStr)), size - 1
+            else:
+                start = int(startStr)
+                end = min(int(endStr), size - 1) if endStr != "" else size - 1
+        except ValueError:
+            return None
+        if start >= size or start > end:
+            raise ValueError(f"unsatisfiable range={rangeHeader}, size={size}")
+        return start, end
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        requestHeaders = Headers(scope=scope)
+        size = self.stat_.st_size
+        headers: List[Tuple[bytes, bytes]] = [
+            (b"etag", self.etag().encode()),
+            (b"last-modified", email.utils.formatdate(self.stat_.st_mtime, usegmt=True).encode()),
+            (b"cache-control", self.CACHE_CONTROL.encode()),
+            (b"accept-ranges", b"bytes"),
+        ]
+
+        if self.isNotModified_(requestHeaders):
+            await send({"type": "http.response.start", "status": HTTPStatus.NOT_MODIFIED, "headers": headers})
+            await send({"type": "http.response.body", "body": b""})
+            return
+
+        status = HTTPStatus.OK
+        start, end = 0, size - 1
+        try:
+            byteRange = self.rangeOf_(requestHeaders)
+        except ValueError:
+            headers.append((b"content-range", f"bytes */{size}".encode()))
+            headers.append((b"content-length", b"0"))
+            await send(
+                {
+                    "type": "http.response.start",
+                    "status": HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE,
+                    "headers": headers,
+                }
+            )
+            await send({"type": "http.response.body", "body": b""})
+            return
+        if byteRange is not None:
+            status = HTTPStatus.PARTIAL_CONTENT
+            start, end = byteRange
+            headers.append((b"content-range", f"bytes {start}-{end}/{size}".encode()))
+        count = end - start + 1
+        headers.append((b"content-type", self.media_type.encode()))
+        headers.append((b"content-length", str(count).encode()))
+
+        await send({"type": "http.response.start", "status": status, "headers": headers})
+        if scope["method"] == "HEAD" or count == 0:
+            await send({"type": "http.response.body", "body": b""})
+            return
+
+        fd = await asyncio.to_thread(os.open, self.filePath_, os.O_RDONLY)
+        try:
+            if "http.response.zerocopysend" in scope.get("extensions", {}):
+                with os.fdopen(fd, "rb", closefd=False) as f:
+                    await send({"type": "http.response.zerocopysend", "file": f, "offset": start, "count": count})
+                return
+            offset = start
+            while offset <= end:
+                chunk = await asyncio.to_thread(os.pread, fd, min(self.CHUNK_SIZE, end - offset + 1), offset)
+                if len(chunk) == 0:
+                    raise Exception(f"file truncated while sending, file={self.filePath_}")
+                offset += len(chunk)
+                await send({"type": "http.response.body", "body": chunk, "more_body": offset <= end})
+        finally:
+            os.close(fd)
@@ -0,0 +1,100 @@
+import os
+import zipfile
+import asyncio
+from typing import Final, AsyncIterator, Tuple
+
+## chunk size reading a file to stream
+STREAM_CHUNK_SIZE: Final[int] = 256 * 1024
+
+
+class ZipStreamBuffer_:
+    """
+    Write-only file object for zipfile.ZipFile, written bytes are taken out by the stream after each write
+
+    NOTE: it has tell() but no seek(), thus zipfile writes sizes/crc in data descriptors after each file,
+    i.e. the archive is produced in one pass without being kept in memory
+    """
+
+    ## limit the instance variable
+    ## Why? avoid bugs some methods created wrong instance variable
+    __slots__ = ("buffer_", "position_")
+
+    def __init__(self):
+        self.buffer_ = bytearray()
+        self.position_ = 0
+
+    def write(self, data: bytes) -> int:
+        self.buffer_ += data
+        self.position_ += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self.position_
+
+    def flush(self):
+        pass
+
+    def take(self) -> bytes:
+        data = bytes(self.buffer_)
+        self.buffer_.clear()
+        return data
+
+
+async def readFileChunks(filePath: str, chunkSize: int = STREAM_CHUNK_SIZE) -> AsyncIterator[bytes]:
+    """
+    Read a file in chunks, each read runs in pool thread (does not block the event loop)
+    """
+    f = await asyncio.to_thread(open, filePath, "rb")
+    try:
+        while True:
+            chunk = await asyncio.to_thread(f.read, chunkSize)
+            if len(chunk) == 0:
+                break
+            yield chunk
+    finally:
+        f.close()
+
+
+async def zipStream(files: AsyncIterator[Tuple[str, str]]) -> AsyncIterator[bytes]:
+    """
+    Stream a zip archive of files, each file is added as soon as it is yielded by files
+
+    Args:
+        files: (nameInArchive, filePath)
+
+    NOTE: files are stored (no compression), e.g. png is already compressed
+    """
+    buffer = ZipStreamBuffer_()
+    with zipfile.ZipFile(buffer, "w", compression=zipfile.ZIP_STORED) as zf:
+        async for name, filePath in files:
+            with zf.open(name, "w", force_zip64=True) as entry:
+                async for chunk in readFileChunks(filePath):
+                    entry.write(chunk)
+                    yield buffer.take()
+            ## data descriptor of the file
+            yield buffer.take()
+    ## central directory is written on close
+    yield buffer.take()
+
+
+async def multipartStream(
+    files: AsyncIterator[Tuple[str, str]], boundary: str, contentType: str = "application/octet-stream"
+) -> AsyncIterator[bytes]:
+    """
+    Stream files as multipart/mixed body parts, each part is sent as soon as the file is yielded by files
+
+    Args:
+        files: (fileName, filePath)
+    """
+    async for name, filePath in files:
+        size = await asyncio.to_thread(os.path.getsize, filePath)
+        yield (
+            f"--{boundary}\r\n"
+            f"Content-Type: {contentType}\r\n"
+            f'Content-Disposition: attachment; filename="{name}"\r\n'
+            f"Content-Length: {size}\r\n\r\n"
+        ).encode()
+        async for chunk in readFileChunks(filePath):
+            yield chunk
+        yield b"\r\n"
+    yield f"--{boundary}--\r\n".encode()
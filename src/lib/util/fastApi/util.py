@@ -1,39 +1,65 @@
 import asyncio
 from http import HTTPStatus
-from starlette.middleware.base import BaseHTTPMiddleware
+from starlette.types import ASGIApp, Scope, Receive, Send, Message
 from fastapi import HTTPException, FastAPI, Request
 from fastapi.responses import JSONResponse
 from typing import Final, Union, Callable, TypeVar, List, TypedDict, Dict, Any, NoReturn, Annotated
 import util as U
 
 
+class ExceptionHandlerMiddleware:
+    """
+    Global exception handler as a pure ASGI middleware
+
+    NOTE:
+    - Unlike BaseHTTPMiddleware, it does not create a task and memory streams per request,
+      and streaming responses are passed through unbuffered
+    - If the response has already started (e.g. streaming), an error response cannot be sent anymore.
+      The exception is logged and the connection is closed by the server
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        isResponseStarted = False
+
+        async def sendWrapper(message: Message):
+            nonlocal isResponseStarted
+            if message["type"] == "http.response.start":
+                isResponseStarted = True
+            await send(message)
+
+        try:
+            await self.app(scope, receive, sendWrapper)
+        except Exception as e:
+            U.logPrefixE(f"{ExceptionHandlerMiddleware.__name__}", e)
+            if isResponseStarted:
+                return
+            response = JSONResponse(
+                status_code=500, content={"error": e.__class__.__name__, "messages": U.Log.toExceptionStr(e)}
+            )
+            await response(scope, receive, send)
+
+
 def useExceptionHandlerMiddleware(app: FastAPI):
-    '''
+    """
     Use global exception handler for FastAPI
     - If the endpoint has no try/except block to handle exception, this will handle
     - This also suppresses messy error messages from the ASGI layer, e.g.
       ERROR:    Exception in ASGI application
-    '''
+    """
     funcName = useExceptionHandlerMiddleware.__name__
     prefix = funcName
     try:
-        class ExceptionHandlerMiddleware(BaseHTTPMiddleware):
-            async def dispatch(self, request: Request, call_next):
-                try:
-                    return await call_next(request)
-                except Exception as e:
-                    U.logPrefixE(f"{ExceptionHandlerMiddleware.__name__}", e)
-                    return JSONResponse(
-                        status_code=500, 
-                        content={
-                            'error': e.__class__.__name__, 
-                            'messages': U.Log.toExceptionStr(e)
-                        }
-                    )
         app.add_middleware(ExceptionHandlerMiddleware)
         U.logW(f"Use middleware[{ExceptionHandlerMiddleware.__name__}]")
     except Exception as e:
-        U.logPrefixE(prefix,e)
+        U.logPrefixE(prefix, e)
 
 
 ## A helper function to raise HTTPException
@@ -45,12 +71,15 @@ def throwHttpPrefix(prefix: str, e: Union[Exception, str], id: str = "") -> NoRe
     ## default is 500 internal server error
     httpStatusCode = HTTPStatus.INTERNAL_SERVER_ERROR
     httpErr = f"[{id}] internal server error"
+    httpHeaders = None
 
     internalErrStr = U.Log.toExceptionStr(e)
     if isinstance(e, HTTPException):
         internalErrStr = e.detail
         httpStatusCode = e.status_code
         httpErr = f"[{id}] {internalErrStr}"
+        ## keep headers, e.g. Retry-After
+        httpHeaders = e.headers
     elif isinstance(e, asyncio.TimeoutError):
         internalErrStr = f"gateway timeout (async await)"
         httpStatusCode = HTTPStatus.GATEWAY_TIMEOUT
@@ -60,6 +89,6 @@ def throwHttpPrefix(prefix: str, e: Union[Exception, str], id: str = "") -> NoRe
     U.logPrefixE(prefix, internalErrStr)
 
     ## raise HTTPException (visible to public)
-    raise HTTPException(status_code=httpStatusCode, detail=httpErr)
+    raise HTTPException(status_code=httpStatusCode, detail=httpErr, headers=httpHeaders)
 
 
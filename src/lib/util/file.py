@@ -1,6 +1,7 @@
 import os
 import sys
 import datetime
+import hashlib
 from typing import Union, NoReturn, TypedDict, Literal, overload
 from .log import logI, logD, logW, logE, logPrefixE, throwPrefix
 
@@ -145,3 +146,24 @@ def chCwdFromFilePath(filePath: str, isThrow: bool = False):
             throwPrefix(prefix, e)
         logPrefixE(funcName, e)
     return isOk
+
+
+def fileSha256(filePath: str, chunkSize: int = 1024 * 1024) -> str:
+    """
+    Get sha256 hex digest of file content
+
+    NOTE: file is read in chunks, thus it is safe for large files
+    """
+    funcName = fileSha256.__name__
+    prefix = funcName
+    try:
+        h = hashlib.sha256()
+        with open(filePath, "rb") as f:
+            while True:
+                chunk = f.read(chunkSize)
+                if not chunk:
+                    break
+                h.update(chunk)
+        return h.hexdigest()
+    except Exception as e:
+        throwPrefix(prefix, e)
@@ -1,8 +1,10 @@
+import os
+import math
 import platform
 import sys
 import time
 import uuid as PyUuid_
-from typing import Union, Dict, TypedDict
+from typing import Union, Dict, TypedDict, List
 
 
 def pythonVer():
@@ -77,4 +79,79 @@ def isWindows() -> bool:
     return platform.system() == "Windows"
 
 def platformName() -> str:
-    return platform.system()
\ No newline at end of file
+    return platform.system()
+
+def cpuCount() -> int:
+    """
+    No. of CPUs this process can actually use, i.e. the least of
+    - os.cpu_count(): CPUs of the host
+    - CPU affinity of the process (e.g. taskset)
+    - cgroup CPU quota (e.g. docker --cpus=2, k8s cpu limit), rounded up
+
+    NOTE: os.cpu_count() alone sees all host CPUs in a container, pools sized by it oversubscribe the quota
+    """
+    count = os.cpu_count() or 1
+    if hasattr(os, "sched_getaffinity"):
+        count = min(count, len(os.sched_getaffinity(0)))
+
+    ## cgroup v2: "max 100000" or "<quota> <period>"
+    ## cgroup v1: cpu.cfs_quota_us is -1 if unlimited
+    quotaFiles = [
+        ("/sys/fs/cgroup/cpu.max", None),
+        ("/sys/fs/cgroup/cpu/cpu.cfs_quota_us", "/sys/fs/cgroup/cpu/cpu.cfs_period_us"),
+    ]
+    for quotaFile, periodFile in quotaFiles:
+        try:
+            with open(quotaFile) as f:
+                values = f.read().split()
+            if periodFile is not None:
+                with open(periodFile) as f:
+                    values.append(f.read().strip())
+            if len(values) >= 2 and values[0] not in ("max", "-1"):
+                count = min(count, max(1, math.ceil(int(values[0]) / int(values[1]))))
+            break
+        except (OSError, ValueError):
+            continue
+    return max(1, count)
+
+
+def parseCpuList(s: str) -> List[int]:
+    """
+    Parse cpu list of taskset/cpuset format, e.g. "0-3,6" -> [0, 1, 2, 3, 6], "" -> []
+    """
+    cpus: List[int] = []
+    for part in s.replace(" ", "").split(","):
+        if part == "":
+            continue
+        if "-" in part:
+            first, last = part.split("-", 1)
+            cpus.extend(range(int(first), int(last) + 1))
+        else:
+            cpus.append(int(part))
+    return sorted(set(cpus))
+
+
+def setCpuAffinity(cpus: List[int]) -> bool:
+    """
+    Pin the calling thread to the cpus, threads and subprocesses created by it afterwards inherit the affinity
+
+    NOTE:
+    - On Linux, affinity is per thread, i.e. other threads of the process are not affected
+    - No-op if cpus is empty or the platform has no sched_setaffinity (e.g. Windows, macOS)
+
+    Returns:
+        True if the affinity is set
+    """
+    if len(cpus) == 0 or not hasattr(os, "sched_setaffinity"):
+        return False
+    os.sched_setaffinity(0, cpus)
+    return True
+
+
+def usableCpus() -> List[int]:
+    """
+    CPUs the calling thread may run on (all CPUs if the platform has no CPU affinity)
+    """
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
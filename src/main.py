@@ -32,15 +32,80 @@ if len(sysDirsToAppend) == 0:
 ########################################################
 import util as U
 from app import FastApiServer
+from api.worker import ProcessPoolServer, RenderBudget, setJobBudgets
+
+
+class DrainingUvicornServer(uvicorn.Server):
+    """
+    Start draining (reject new jobs) as soon as SIGTERM/SIGINT is received
+    NOTE: uvicorn awaits in-flight requests before lifespan shutdown, new jobs must be rejected in the meantime
+    """
+
+    def handle_exit(self, sig, frame):
+        FastApiServer.startDrain()
+        super().handle_exit(sig, frame)
+
+
+def runApiWorkers():
+    """
+    Run API_WORKER_COUNT API processes (uvicorn workers) sharing one pool of multi-process workers
+
+    NOTE:
+    - The pool is owned by this process (uvicorn supervisor), API processes submit jobs over a unix socket
+    - Each API process creates its own app (FastApiServer.initServer), all state is per process except the pool
+    - API processes are run by uvicorn.run(workers=...), i.e. plain uvicorn servers (not DrainingUvicornServer):
+      they start draining at lifespan shutdown, after uvicorn has closed its listeners and awaited in-flight requests
+    """
+    funcName = runApiWorkers.__name__
+    prefix = funcName
+    setJobBudgets(FastApiServer.JOB_BUDGETS_MS)
+    pool = ProcessPoolServer(
+        FastApiServer.MP_POOL_SOCKET_PATH,
+        FastApiServer.MP_WORKER_COUNT,
+        RenderBudget(FastApiServer.RENDER_THREAD_BUDGET, FastApiServer.RENDER_THREADS_PER_JOB),
+        FastApiServer.CONFIG["workerCpus"],
+        FastApiServer.CONFIG["workerPinning"],
+        FastApiServer.PDF_PROCESS_SCHEDULING,
+        FastApiServer.SCHEDULING_AGING_MS,
+        FastApiServer.MP_TRANSPORT,
+    )
+    try:
+        pool.start()
+
+        ## NOTE: API processes are spawned, they inherit the environment (i.e. use the pool) and sys.path
+        os.environ["MP_QUEUE_BACKEND"] = "pool"
+        uvicorn.run(
+            "app:FastApiServer.initServer",
+            factory=True,
+            host="0.0.0.0",
+            port=8000,
+            workers=FastApiServer.API_WORKER_COUNT,
+            timeout_graceful_shutdown=int(FastApiServer.DRAIN_TIMEOUT_SEC + FastApiServer.DRAIN_RESPONSE_MARGIN_SEC),
+        )
+    except Exception as e:
+        U.logPrefixE(prefix, e)
+    finally:
+        ## API processes have drained their jobs, pool workers exit after their running job
+        pool.stop(FastApiServer.WORKER_STOP_GRACE_SEC)
 
 
 def main():
     funcName = main.__name__
     prefix = funcName
     try:
-        ## NOTE: asyncio.run(xxx) blocks until the async function xxx finishes running
-        fastApiServer = asyncio.run(FastApiServer.initServer())
-        uvicorn.run(fastApiServer, host="0.0.0.0", port=8000)
+        if FastApiServer.API_WORKER_COUNT > 1:
+            runApiWorkers()
+            return
+
+        ## NOTE: workers are started in background on lifespan startup, i.e. the server listens without waiting for them
+        fastApiServer = FastApiServer.initServer()
+        config = uvicorn.Config(
+            fastApiServer,
+            host="0.0.0.0",
+            port=8000,
+            timeout_graceful_shutdown=int(FastApiServer.DRAIN_TIMEOUT_SEC + FastApiServer.DRAIN_RESPONSE_MARGIN_SEC),
+        )
+        DrainingUvicornServer(config).run()
     except Exception as e:
         U.logPrefixE(prefix, e)
 
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+
+import sys
+import os
+import argparse
+import signal
+import multiprocessing
+from multiprocessing import Process
+from typing import List
+
+########################################################
+## Change to project root dir
+########################################################
+projRootDir = f"{os.path.dirname(__file__)}/.."
+os.chdir(projRootDir)
+
+########################################################
+## Explicitly appends the search paths, where self-developed modules/packages are resided
+## This helps consistent imports, without using relative paths.
+########################################################
+importDirs = ["./src/lib"]
+sysDirsToAppend: List[str] = []
+for importDir in importDirs:
+    if os.path.exists(importDir) and os.path.isdir(importDir):
+        sys.path.append(importDir)
+        sysDirsToAppend.append(importDir)
+if len(sysDirsToAppend) == 0:
+    raise Exception(f"import dirs not found, targetPaths={importDirs}")
+
+########################################################
+## import self-developed modules/packages
+########################################################
+import util as U
+from app import FastApiServer
+from api.worker import MultiProcessWorker, MultiProcessManager, SqliteQueueBackend, RenderBudget, setJobBudgets
+from api.worker import killRendererGroup
+
+
+def main():
+    """
+    Run a pool of multi-process pdf2image workers shared by API nodes (sqlite queue backend)
+
+    Example:
+        $ python src/mpWorkers.py --workers 8
+        $ MP_QUEUE_BACKEND=sqlite MP_WORKER_COUNT=0 python src/main.py
+    """
+    funcName = main.__name__
+    prefix = funcName
+    try:
+        parser = argparse.ArgumentParser(description="shared multi-process pdf2image workers")
+        parser.add_argument(
+            "--workers", type=int, default=FastApiServer.CONFIG["cpuCount"], help="no. of worker processes"
+        )
+        parser.add_argument("--db", type=str, default=FastApiServer.MP_QUEUE_SQLITE_PATH, help="sqlite queue db")
+        args = parser.parse_args()
+        ## NOTE: a node without workers is an API node (MP_WORKER_COUNT=0 python src/main.py), not a pool
+        if args.workers < 1:
+            parser.error(f"--workers must be 1 or more, got {args.workers}")
+
+        jobQueue = SqliteQueueBackend(args.db, FastApiServer.MP_JOB_QUEUE_NAME)
+        ## NOTE: results are sent to the result queue named by each job (replyTo)
+        resultQueue = SqliteQueueBackend(args.db, "results")
+
+        ## SIGTERM: each worker exits after its running job (graceful stop), i.e. no job is lost on redeploy
+        stopEvent = multiprocessing.Event()
+        signal.signal(signal.SIGTERM, lambda sig, frame: stopEvent.set())
+
+        ## renderer subprocesses of all workers of this node are capped by one budget
+        renderBudget = RenderBudget(FastApiServer.RENDER_THREAD_BUDGET, FastApiServer.RENDER_THREADS_PER_JOB)
+        ## execution budgets of job types, a worker over budget kills itself (refer to MultiProcessWorker)
+        setJobBudgets(FastApiServer.JOB_BUDGETS_MS)
+
+        def startProcess(i: int) -> Process:
+            p = Process(
+                target=MultiProcessWorker(
+                    "mpShared",
+                    f"pdfWorker{i+1}",
+                    jobQueue,
+                    resultQueue,
+                    stopEvent,
+                    renderBudget,
+                    ## CPU affinity by WORKER_CPUS/WORKER_PINNING
+                    MultiProcessManager.workerCpusOf(
+                        FastApiServer.CONFIG["workerCpus"], FastApiServer.CONFIG["workerPinning"], i
+                    ),
+                ).mpWorker,
+                daemon=True,
+            )
+            p.start()
+            return p
+
+        processes: List[Process] = [startProcess(i) for i in range(args.workers)]
+        U.logI(f"{prefix} {args.workers} workers running, db={args.db}")
+        ## a worker killed (e.g. over its job budget) is respawned, a stopped one (exit code 0) is not
+        while not stopEvent.is_set() or any([p.is_alive() for p in processes]):
+            for i, p in enumerate(processes):
+                p.join(MultiProcessManager.MONITOR_INTERVAL_SEC / len(processes))
+                if p.exitcode not in (None, 0) and not stopEvent.is_set():
+                    U.logW(f"{prefix} pdfWorker{i+1} exited, exitcode={p.exitcode}, respawn")
+                    ## its renderer subprocesses and render budget threads are reclaimed
+                    killRendererGroup(p.pid)
+                    renderBudget.reclaim(p.pid)
+                    processes[i] = startProcess(i)
+        U.logW(f"{prefix} all workers stopped")
+    except KeyboardInterrupt:
+        U.logW(f"{prefix} KeyboardInterrupt")
+    except Exception as e:
+        U.logPrefixE(prefix, e)
+
+
+if __name__ == "__main__":
+    main()